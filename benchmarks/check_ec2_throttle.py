@@ -0,0 +1,119 @@
+"""Checks of the master's ec2 api throttling against FaultyEC2Client: the
+shared token bucket backs off when the api refuses calls with
+RequestLimitExceeded and every call still gets through, retried launches keep
+their idempotency token, and calls that are not safe to repeat are not
+retried after a server error. No ec2 server is needed, the fake api wraps a
+stub client.
+"""
+import os
+import sys
+import threading
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "master"))
+
+from ec2_throttle import ThrottledEC2Client
+from fake_ec2 import FaultyEC2Client
+
+
+def internal_error(operation):
+    return ClientError({
+        "Error": {
+            "Code": "InternalError",
+            "Message": "An internal error has occurred."
+        }
+    }, operation)
+
+
+class StubEC2Client(object):
+    # answers describe_instances with nothing, run_instances fails once with
+    # a server side error and then launches one instance, create_subnet
+    # always fails with one
+    def __init__(self):
+        self.client_tokens = []
+        self.create_subnet_calls = 0
+
+    def describe_instances(self, **kwargs):
+        return {"Reservations": []}
+
+    def create_subnet(self, **kwargs):
+        self.create_subnet_calls += 1
+        raise internal_error("create_subnet")
+
+    def run_instances(self, **kwargs):
+        self.client_tokens.append(kwargs.get("ClientToken"))
+        if len(self.client_tokens) == 1:
+            raise internal_error("run_instances")
+        return {"Instances": [{"InstanceId": "i-1"}]}
+
+
+def check_backoff():
+    # the api takes 5 calls a second, the wrapper starts out at 50
+    faulty = FaultyEC2Client(
+        StubEC2Client(), latency=0, jitter=0, rate=5, burst=5)
+    throttled = ThrottledEC2Client(
+        faulty, rate=50, burst=10, base_delay=0.05, max_delay=0.5)
+    errors = []
+
+    def call():
+        for _ in xrange(5):
+            try:
+                throttled.describe_instances()
+            except Exception as e:
+                errors.append(e)
+
+    callers = [threading.Thread(target=call) for _ in xrange(6)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    stats = throttled.stats()
+    assert not errors, errors
+    assert stats["calls"] == 30, stats
+    assert stats["throttle_errors"] > 0, stats
+    assert stats["retries"] == stats["throttle_errors"], stats
+    assert stats["current_rate"] < 50, stats
+    print("ok   token bucket backed off to %.1f calls/s after %d "
+          "RequestLimitExceeded, all 30 calls went through" %
+          (stats["current_rate"], stats["throttle_errors"]))
+
+
+def check_client_token():
+    stub = StubEC2Client()
+    throttled = ThrottledEC2Client(stub, base_delay=0.01)
+    throttled.run_instances(ImageId="ami-1", MinCount=1, MaxCount=1)
+    assert len(stub.client_tokens) == 2, stub.client_tokens
+    assert stub.client_tokens[0], stub.client_tokens
+    assert stub.client_tokens[0] == stub.client_tokens[1], stub.client_tokens
+    stats = throttled.stats()
+    assert stats["server_errors"] == 1 and stats["throttle_errors"] == 0, stats
+    assert stats["current_rate"] == 10, stats
+    print("ok   run_instances retried after InternalError with the same "
+          "client token")
+
+
+def check_no_server_error_retry():
+    # a subnet may have been created before the error came back
+    stub = StubEC2Client()
+    throttled = ThrottledEC2Client(stub, base_delay=0.01)
+    try:
+        throttled.create_subnet(VpcId="vpc-1", CidrBlock="10.0.0.0/24")
+    except ClientError:
+        pass
+    else:
+        raise AssertionError("create_subnet did not fail")
+    assert stub.create_subnet_calls == 1, stub.create_subnet_calls
+    print("ok   create_subnet not retried after InternalError")
+
+
+def main():
+    check_backoff()
+    check_client_token()
+    check_no_server_error_retry()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Checks of the master's pooled ssh connections against the fake sshd: one
+connection per host shared by all channels, reconnecting once it drops, and
+connect retries with backoff.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+
+sys.path.insert(0,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "master"))
+
+from fake_ec2 import free_port
+from fake_ssh import FakeSSHServer, LocalSSHSessions, Workload
+from ssh_pool import SSHSessionManager
+
+# the fake sshd closes the channel of any other command right away, at times
+# before exec_command has its answer
+TRAINER_CMD = "TRAINING_ROLE=TRAINER TRAINER_INDEX=%d train"
+
+
+def check_reuse(sessions):
+    client = sessions.connect("node_a")
+    assert sessions.connect("node_a") is client
+    for index in xrange(3):
+        exit_code, _, _ = sessions.run(
+            "node_a", TRAINER_CMD % index, timeout=10)
+        assert exit_code == 0
+    stats = sessions.stats()
+    assert stats["connections"] == 1, stats
+    assert stats["reconnects"] == 0, stats
+    print("ok   pool reuse: 3 commands over one connection")
+
+
+def check_multiplexing(sessions, workload):
+    # trainer commands stream output at the same time over one transport
+    transport = sessions.connect("node_b").get_transport()
+    lines = {}
+
+    def read(index):
+        stdin, stdout, stderr = sessions.exec_command("node_b",
+                                                      TRAINER_CMD % index)
+        lines[index] = len(stdout.readlines()) + len(stderr.readlines())
+
+    readers = [threading.Thread(target=read, args=(i, )) for i in xrange(4)]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    assert sessions.connect("node_b").get_transport() is transport
+    expected = workload.lines_per_second * workload.duration
+    for index, count in lines.iteritems():
+        assert count >= expected * 0.9, (index, count)
+    print("ok   channel multiplexing: 4 trainer streams on one transport")
+
+
+def check_reconnect(sessions):
+    client = sessions.connect("node_c")
+    client.get_transport().close()
+    exit_code, _, _ = sessions.run("node_c", TRAINER_CMD % 0, timeout=10)
+    assert exit_code == 0
+    assert sessions.connect("node_c") is not client
+    assert sessions.stats()["reconnects"] == 1, sessions.stats()
+    print("ok   reconnect after the connection dropped")
+
+
+def check_keepalive(sessions):
+    transport = sessions.connect("node_d").get_transport()
+    # paramiko keeps the interval on the packetizer only
+    interval = transport.packetizer._Packetizer__keepalive_interval
+    assert interval == sessions.keepalive_interval, interval
+    print("ok   keepalive every %ds" % interval)
+
+
+def check_retries(pem_path):
+    # nothing listens on the port, every attempt is refused right away
+    sessions = SSHSessionManager(
+        pem_path, connect_retries=2, retry_interval=0.2)
+    started = time.time()
+    try:
+        sessions.connect("127.0.0.1", port=free_port())
+    except socket.error:
+        pass
+    else:
+        raise AssertionError("connect to a closed port succeeded")
+    elapsed = time.time() - started
+    # two retries, 0.2s and then 0.4s apart
+    assert 0.6 <= elapsed < 5, elapsed
+    started = time.time()
+    try:
+        sessions.connect("127.0.0.1", port=free_port(), retries=0)
+    except socket.error:
+        pass
+    assert time.time() - started < 0.2
+    print("ok   connect retries with backoff, none when asked")
+
+
+def main():
+    workload = Workload(lines_per_second=100, duration=0.5)
+    server = FakeSSHServer(workload).start()
+    LocalSSHSessions.port = server.port
+    pem = tempfile.NamedTemporaryFile(suffix=".pem", delete=False)
+    pem.close()
+    paramiko.RSAKey.generate(2048).write_private_key_file(pem.name)
+    sessions = LocalSSHSessions(pem.name, keepalive_interval=15)
+    try:
+        check_reuse(sessions)
+        check_multiplexing(sessions, workload)
+        check_reconnect(sessions)
+        check_keepalive(sessions)
+        check_retries(pem.name)
+    finally:
+        sessions.close()
+        server.stop()
+        os.remove(pem.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Checks of the master's straggler detection on made up metrics lines: a
+slow trainer stands out in a fleet of three, where no z-score can reach the
+threshold, and in a larger fleet, while an even fleet has no stragglers.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "master"))
+
+from stragglers import StragglerDetector
+
+
+def feed(detector, step_times, steps=10):
+    # one metrics line per step from each trainer, step_times[i] seconds
+    # apart for trainer i
+    now = time.time() - max(step_times) * steps
+    for index, step_time in enumerate(step_times):
+        for step in xrange(steps + 1):
+            detector.observe("trainer_%d" % index,
+                             [("step", float(step))],
+                             now + step * step_time)
+
+
+def check_three_trainers():
+    detector = StragglerDetector(window=600, counter_keys=("step", ))
+    feed(detector, [1.0, 1.05, 1.6])
+    report = detector.report()
+    assert report["stragglers"] == ["trainer_2"], report
+    entry = report["nodes"]["trainer_2"]["step_time"]
+    assert abs(entry["z"]) < detector.z_threshold, entry
+    print("ok   slow trainer of three flagged at %.2fx the median of the "
+          "others" % entry["vs_median"])
+
+
+def check_large_fleet():
+    detector = StragglerDetector(window=600, counter_keys=("step", ))
+    feed(detector, [1.0, 1.02, 0.98, 1.01, 0.99, 1.0, 1.03, 1.8])
+    report = detector.report()
+    assert report["stragglers"] == ["trainer_7"], report
+    print("ok   slow trainer of eight flagged at z %.2f" %
+          report["nodes"]["trainer_7"]["step_time"]["z"])
+
+
+def check_even_fleet():
+    detector = StragglerDetector(window=600, counter_keys=("step", ))
+    feed(detector, [1.0, 1.1, 1.2])
+    report = detector.report()
+    assert report["stragglers"] == [], report
+    print("ok   no stragglers in an even fleet of three")
+
+
+def main():
+    check_three_trainers()
+    check_large_fleet()
+    check_even_fleet()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import boto3
+from botocore.exceptions import ClientError
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class MotoServer(object):
+    # moto's standalone ec2 server in a child process, so the time it spends
+    # is not counted as the master's
+    def __init__(self, port=0, region="us-east-1"):
+        self.port = port or free_port()
+        self.region = region
+        self.url = "http://127.0.0.1:%d" % self.port
+        self.process = None
+
+    def start(self, timeout=30):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "moto.server", "ec2", "-p",
+             str(self.port)],
+            stdout=open("/dev/null", "w"),
+            stderr=subprocess.STDOUT)
+        deadline = time.time() + timeout
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return self
+            except socket.error:
+                if self.process.poll() is not None or time.time() > deadline:
+                    raise Exception("moto server did not come up on port %d" %
+                                    self.port)
+                time.sleep(0.2)
+
+    def client(self):
+        return boto3.client(
+            "ec2",
+            endpoint_url=self.url,
+            region_name=self.region,
+            aws_access_key_id="bench",
+            aws_secret_access_key="bench")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+def create_fixtures(client, key_name="bench"):
+    # what a task needs to exist in the account: a default vpc, a security
+    # group, a key pair and an image
+    vpcs = client.describe_vpcs(Filters=[{
+        "Name": "isDefault",
+        "Values": ["true"]
+    }])["Vpcs"]
+    if not vpcs:
+        raise Exception("moto has no default vpc in this region")
+    security_group_id = client.create_security_group(
+        GroupName="bench_%d" % int(time.time() * 1000),
+        Description="benchmarks",
+        VpcId=vpcs[0]["VpcId"])["GroupId"]
+    try:
+        client.create_key_pair(KeyName=key_name)
+    except ClientError:
+        pass
+    images = client.describe_images()["Images"]
+    return {
+        "security_group_id": security_group_id,
+        "key_name": key_name,
+        "image_id": images[0]["ImageId"] if images else "ami-12c6146b"
+    }
+
+
+class FaultyEC2Client(object):
+    # stands in for a boto3 ec2 client and makes it behave more like the
+    # real api: every call takes `latency` (+- jitter) seconds, and calls
+    # beyond `rate` per second (with bursts of `burst`) are refused with
+    # RequestLimitExceeded. waiters and paginators go straight to the client.
+    def __init__(self, client, latency=0.05, jitter=0.02, rate=None,
+                 burst=None):
+        self.client = client
+        self.latency = latency
+        self.jitter = jitter
+        self.rate = rate
+        self.burst = float(burst or rate or 1)
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+        self.counters = {"calls": 0, "throttled": 0}
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in ("get_waiter", "get_paginator",
+                                          "can_paginate"):
+            return attr
+
+        def call(*args, **kwargs):
+            self._count("calls")
+            if not self._take_token():
+                self._count("throttled")
+                raise ClientError({
+                    "Error": {
+                        "Code": "RequestLimitExceeded",
+                        "Message": "Request limit exceeded."
+                    }
+                }, name)
+            time.sleep(
+                max(0, self.latency + random.uniform(-self.jitter,
+                                                     self.jitter)))
+            return attr(*args, **kwargs)
+
+        return call
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def _take_token(self):
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            self.counters = {"calls": 0, "throttled": 0}
+        return stats
@@ -0,0 +1,160 @@
+import multiprocessing
+import Queue
+import re
+import socket
+import threading
+import time
+
+import paramiko
+
+from ssh_pool import SSHSessionManager
+
+
+class Workload(object):
+    # what a fake node prints for a kickoff command: trainers print
+    # lines_per_second lines for duration seconds, every metrics_every-th of
+    # them a metrics line and every stderr_every-th to stderr. anything else
+    # (pserver kickoff, docker pull, probes) exits right away.
+    def __init__(self,
+                 lines_per_second=200,
+                 duration=10,
+                 metrics_every=10,
+                 stderr_every=20,
+                 line_bytes=120,
+                 metric_data_identifier="**metrics_data: "):
+        self.lines_per_second = lines_per_second
+        self.duration = duration
+        self.metrics_every = metrics_every
+        self.stderr_every = stderr_every
+        self.line_bytes = line_bytes
+        self.metric_data_identifier = metric_data_identifier
+
+    def run(self, channel, command, results):
+        result = {"exec_time": time.time(), "command": command[:200]}
+        role = re.search(r"TRAINING_ROLE=(\w+)", command)
+        result["role"] = role.group(1) if role else "other"
+        if result["role"] == "TRAINER":
+            result["index"] = int(
+                re.search(r"TRAINER_INDEX=(\d+)", command).group(1))
+            result.update(self._train(channel))
+        try:
+            channel.send_exit_status(0)
+            channel.close()
+        except Exception:
+            pass
+        result["finish_time"] = time.time()
+        results.put(result)
+
+    def _line(self, n):
+        if self.metrics_every and n % self.metrics_every == 0:
+            return "%sloss=%f,step=%d\n" % (self.metric_data_identifier,
+                                             1.0 / (n + 1), n)
+        line = "step %d " % n
+        return line + "x" * max(0, self.line_bytes - len(line) - 1) + "\n"
+
+    def _train(self, channel):
+        counts = {"lines": 0, "stderr_lines": 0, "metric_lines": 0}
+        tick = 0.05
+        started = time.time()
+        owed = 0.0
+        n = 0
+        try:
+            while time.time() - started < self.duration:
+                owed += self.lines_per_second * tick
+                stdout, stderr = [], []
+                while owed >= 1:
+                    owed -= 1
+                    n += 1
+                    line = self._line(n)
+                    if line.startswith(self.metric_data_identifier):
+                        counts["metric_lines"] += 1
+                        stdout.append(line)
+                    elif self.stderr_every and n % self.stderr_every == 0:
+                        stderr.append(line)
+                    else:
+                        stdout.append(line)
+                if stdout:
+                    channel.sendall("".join(stdout))
+                if stderr:
+                    channel.sendall_stderr("".join(stderr))
+                counts["lines"] += len(stdout)
+                counts["stderr_lines"] += len(stderr)
+                time.sleep(tick)
+        except socket.error:
+            counts["disconnected"] = True
+        return counts
+
+
+class _Node(paramiko.ServerInterface):
+    def __init__(self, workload, results):
+        self.workload = workload
+        self.results = results
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        command_thread = threading.Thread(
+            target=self.workload.run, args=(channel, command, self.results))
+        command_thread.daemon = True
+        command_thread.start()
+        return True
+
+
+def _serve(sock, workload, results):
+    host_key = paramiko.RSAKey.generate(2048)
+    while True:
+        conn, _ = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(host_key)
+        transport.start_server(server=_Node(workload, results))
+
+
+class FakeSSHServer(object):
+    # one sshd on localhost standing in for every node, in a child process
+    # so its cpu time is not counted as the master's. each finished command
+    # is reported through results().
+    def __init__(self, workload):
+        self.workload = workload
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(256)
+        self.port = self.sock.getsockname()[1]
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(self.sock, self.workload, self.queue))
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+        return self
+
+    def results(self, timeout=1.0):
+        # everything reported since the last call
+        results = []
+        while True:
+            try:
+                results.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                return results
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+class LocalSSHSessions(SSHSessionManager):
+    # connects to the fake server whatever host is asked for, the pool is
+    # still keyed by host so there is one connection per node as usual
+    port = 22
+
+    def _connect_with_retries(self, host, port, retries=None, timeout=None):
+        return SSHSessionManager._connect_with_retries(
+            self, "127.0.0.1", self.port, retries, timeout)
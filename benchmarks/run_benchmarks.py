@@ -0,0 +1,446 @@
+"""Benchmarks for cluster bring-up, node log ingest, metrics parsing and log
+serving, run against a moto ec2 server and a fake ssh server on localhost.
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+import paramiko
+
+sys.path.insert(0,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "..", "master"))
+
+from fake_ec2 import FaultyEC2Client, MotoServer, create_fixtures, free_port
+from fake_ssh import FakeSSHServer, LocalSSHSessions, Workload
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument(
+    '--trainers',
+    type=str,
+    default="1,16,128",
+    help="comma separated trainer counts, one bring-up scenario each")
+parser.add_argument(
+    '--pservers', type=int, default=1, help="pserver count in scenarios")
+parser.add_argument(
+    '--lines_per_second',
+    type=float,
+    default=200,
+    help="lines each fake trainer prints per second")
+parser.add_argument(
+    '--duration',
+    type=float,
+    default=10,
+    help="seconds each fake trainer keeps printing")
+parser.add_argument(
+    '--metrics_every',
+    type=int,
+    default=10,
+    help="every n-th trainer line is a metrics line")
+parser.add_argument(
+    '--line_bytes', type=int, default=120, help="length of trainer lines")
+parser.add_argument(
+    '--ec2_latency',
+    type=float,
+    default=0.05,
+    help="seconds added to every ec2 api call")
+parser.add_argument(
+    '--ec2_jitter',
+    type=float,
+    default=0.02,
+    help="random +- seconds on top of ec2_latency")
+parser.add_argument(
+    '--ec2_rate',
+    type=float,
+    default=20,
+    help="ec2 api calls per second before RequestLimitExceeded, 0 for no limit"
+)
+parser.add_argument(
+    '--ec2_burst', type=float, default=40, help="ec2 api burst size")
+parser.add_argument(
+    '--task_args',
+    type=str,
+    default="{}",
+    help="json object of extra cluster_master flags for scenario tasks, e.g. {\"batch_trainer_provisioning\": true}"
+)
+parser.add_argument(
+    '--micro_lines',
+    type=int,
+    default=200000,
+    help="lines fed through log_to_file and save_metrics_data")
+parser.add_argument(
+    '--http_file_mb',
+    type=int,
+    default=64,
+    help="size of the log file fetched in the log serving benchmark")
+parser.add_argument(
+    '--only',
+    type=str,
+    default="",
+    help="comma separated subset of scenarios,run_instances,log_to_file,save_metrics_data,log_serving"
+)
+parser.add_argument(
+    '--output', type=str, default="", help="write results as json here")
+parser.add_argument(
+    '--baseline',
+    type=str,
+    default="",
+    help="json results of an earlier run to compare against")
+
+bench_args = parser.parse_args()
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+
+work_dir = tempfile.mkdtemp(prefix="aws_benchmark_")
+pem_path = os.path.join(work_dir, "bench.pem")
+paramiko.RSAKey.generate(2048).write_private_key_file(pem_path)
+
+# cluster_master parses its flags on import
+sys.argv = [
+    "cluster_master.py", "--action", "test", "--online_mode", "true",
+    "--echo_node_logs", "false", "--availability_zone",
+    os.environ["AWS_DEFAULT_REGION"] + "a"
+]
+import cluster_master
+
+cluster_master.args.log_path = os.path.join(work_dir, "logs", "")
+os.makedirs(cluster_master.args.log_path)
+for handler in list(cluster_master.logging.getLogger().handlers):
+    if not isinstance(handler, cluster_master.RingLogHandler):
+        cluster_master.logging.getLogger().removeHandler(handler)
+master_log = cluster_master.logging.FileHandler(
+    cluster_master.args.log_path + "master.log")
+master_log.setFormatter(
+    cluster_master.logging.Formatter('%(asctime)s %(message)s'))
+cluster_master.logging.getLogger().addHandler(master_log)
+# every node connection ends up on the fake ssh server
+cluster_master.SSHSessionManager = LocalSSHSessions
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+class ResourceSampler(object):
+    # cpu used and peak memory of this process while running
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak_rss_mb = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak_rss_mb = max(self.peak_rss_mb, rss_mb())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.started = time.time()
+        self.cpu_started = cpu_seconds()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.wall_seconds = time.time() - self.started
+        self.cpu_seconds = cpu_seconds() - self.cpu_started
+
+    def report(self):
+        return {
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "cpu_cores": round(self.cpu_seconds / self.wall_seconds, 3),
+            "peak_rss_mb": round(self.peak_rss_mb, 1)
+        }
+
+
+def new_task(name, overrides=None):
+    task_overrides = {
+        "task_name": "%s_%d" % (name, int(time.time() * 1000)),
+        "pem_path": pem_path
+    }
+    task_overrides.update(overrides or {})
+    return cluster_master.Task(
+        cluster_master.task_args_from_json(task_overrides))
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as log_file:
+        return sum(1 for _ in log_file)
+
+
+def run_scenario(fixtures, trainer_count, faulty_client):
+    workload = Workload(
+        lines_per_second=bench_args.lines_per_second,
+        duration=bench_args.duration,
+        metrics_every=bench_args.metrics_every,
+        line_bytes=bench_args.line_bytes)
+    ssh_server = FakeSSHServer(workload).start()
+    LocalSSHSessions.port = ssh_server.port
+    overrides = {
+        "key_name": fixtures["key_name"],
+        "security_group_id": fixtures["security_group_id"],
+        "pserver_image_id": fixtures["image_id"],
+        "trainer_image_id": fixtures["image_id"],
+        "trainer_count": trainer_count,
+        "pserver_count": bench_args.pservers,
+        "metric_data_identifier": workload.metric_data_identifier
+    }
+    overrides.update(json.loads(bench_args.task_args))
+    task = new_task("bench_%d" % trainer_count, overrides)
+    faulty_client.stats()
+    try:
+        with ResourceSampler() as sampler:
+            started = time.time()
+            task.create_cluster()
+        results = ssh_server.results()
+    finally:
+        ssh_server.stop()
+
+    trainers = [r for r in results if r["role"] == "TRAINER"]
+    kickoffs = [r["exec_time"] - started for r in trainers]
+    emitted = sum(r["lines"] + r["stderr_lines"] for r in trainers)
+    received = sum(
+        count_lines(task.log_path + "trainer_%d.log" % r["index"]) +
+        count_lines(task.log_path + "trainer_%d_err.log" % r["index"])
+        for r in trainers)
+    metrics_emitted = sum(r["metric_lines"] for r in trainers)
+    metrics_stored = task.metrics_store.describe()["counts"].get("loss", 0)
+    ingest_seconds = (max([r["finish_time"] for r in trainers] or [0]) -
+                      min([r["exec_time"] for r in trainers] or [0]))
+
+    report = {
+        "trainers": trainer_count,
+        "trainers_kicked_off": len(trainers),
+        "time_to_first_kickoff": round(min(kickoffs or [0]), 3),
+        "time_to_kickoff_p50": round(percentile(kickoffs, 0.5) or 0, 3),
+        "time_to_all_kicked_off": round(max(kickoffs or [0]), 3),
+        "lines_emitted": emitted,
+        "lines_received": received,
+        "dropped_lines": emitted - received,
+        "metric_lines_emitted": metrics_emitted,
+        "dropped_metric_lines": metrics_emitted - metrics_stored,
+        "ingest_lines_per_second":
+        round(received / ingest_seconds, 1) if ingest_seconds > 0 else None,
+        "log_queue_full_waits":
+        task.log_writer.stats()["queue_full_waits"],
+        "ec2": faulty_client.stats()
+    }
+    report.update(sampler.report())
+    return report
+
+
+def bench_run_instances(fixtures, count=16):
+    # one run_instances call per trainer against one batched call, launch
+    # only, readiness is covered by the scenarios
+    task = new_task("bench_run_instances", {
+        "key_name": fixtures["key_name"],
+        "security_group_id": fixtures["security_group_id"]
+    })
+    task.args.subnet_id = task.create_subnet()
+    report = {"count": count}
+    for mode in ("per_instance", "batched"):
+        started = time.time()
+        if mode == "per_instance":
+            instances = []
+            for _ in xrange(count):
+                instances.extend(
+                    task.launch_instances(fixtures["image_id"], "c5.large", 1,
+                                          "TRAINER"))
+        else:
+            instances = task.launch_instances(fixtures["image_id"],
+                                              "c5.large", count, "TRAINER")
+        report[mode + "_seconds"] = round(time.time() - started, 3)
+        cluster_master.ec2client.terminate_instances(
+            InstanceIds=[i["InstanceId"] for i in instances])
+    return report
+
+
+def synthetic_lines(count):
+    lines = []
+    for n in xrange(count):
+        if bench_args.metrics_every and n % bench_args.metrics_every == 0:
+            lines.append("**metrics_data: loss=%f,step=%d\n" %
+                         (1.0 / (n + 1), n))
+        else:
+            lines.append("step %d %s\n" % (n, "x" * bench_args.line_bytes))
+    return "".join(lines)
+
+
+def bench_log_to_file():
+    task = new_task("bench_log_to_file")
+    source = StringIO.StringIO(synthetic_lines(bench_args.micro_lines))
+    with ResourceSampler() as sampler:
+        task.log_to_file(source, "trainer_0.log")
+        task.log_writer.flush()
+    report = {
+        "lines": bench_args.micro_lines,
+        "lines_per_second":
+        round(bench_args.micro_lines / sampler.wall_seconds, 1),
+        "lines_written": task.log_writer.stats()["lines_written"]
+    }
+    report.update(sampler.report())
+    return report
+
+
+def bench_save_metrics_data():
+    task = new_task("bench_save_metrics_data")
+    messages = [
+        "loss=%f,acc=%f,step=%d" % (1.0 / (n + 1), n / 1e6, n)
+        for n in xrange(bench_args.micro_lines)
+    ]
+    with ResourceSampler() as sampler:
+        for message in messages:
+            task.save_metrics_data(message, "trainer_0")
+        task.metrics_store.flush()
+    report = {
+        "messages": len(messages),
+        "messages_per_second": round(len(messages) / sampler.wall_seconds, 1)
+    }
+    report.update(sampler.report())
+    return report
+
+
+def bench_log_serving(clients=8, rounds=4):
+    task = new_task("bench_log_serving")
+    chunk = synthetic_lines(10000)
+    with open(task.log_path + "trainer_0.log", "w") as log_file:
+        written = 0
+        while written < bench_args.http_file_mb * 1024 * 1024:
+            log_file.write(chunk)
+            written += len(chunk)
+    cluster_master.default_task = task
+    cluster_master.args.master_server_port = free_port()
+    server_thread = threading.Thread(
+        target=cluster_master.start_server, args=(cluster_master.args, ))
+    server_thread.daemon = True
+    server_thread.start()
+    url = "http://127.0.0.1:%d/log/trainer_0.log" % (
+        cluster_master.args.master_server_port)
+    for _ in xrange(50):
+        try:
+            urllib2.urlopen(url + "?offset=%d" % written).read()
+            break
+        except Exception:
+            time.sleep(0.1)
+
+    received = [0] * clients
+
+    def fetch(i):
+        for _ in xrange(rounds):
+            response = urllib2.urlopen(url)
+            while True:
+                data = response.read(256 * 1024)
+                if not data:
+                    break
+                received[i] += len(data)
+
+    with ResourceSampler() as sampler:
+        fetch_threads = [
+            threading.Thread(target=fetch, args=(i, )) for i in xrange(clients)
+        ]
+        for fetch_thread in fetch_threads:
+            fetch_thread.start()
+        for fetch_thread in fetch_threads:
+            fetch_thread.join()
+    report = {
+        "clients": clients,
+        "bytes": sum(received),
+        "mb_per_second":
+        round(sum(received) / 1024.0 / 1024 / sampler.wall_seconds, 1)
+    }
+    report.update(sampler.report())
+    return report
+
+
+def compare(results, baseline, prefix=""):
+    # prints every number that changed against the baseline
+    for key, value in sorted(results.iteritems()):
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare(value, old or {}, prefix + key + ".")
+        elif isinstance(value, (int, float)) and isinstance(
+                old, (int, float)) and old != value:
+            change = ("%+.1f%%" % (100.0 * (value - old) / old)) if old else ""
+            print("%-50s %12s -> %-12s %s" % (prefix + key, old, value,
+                                              change))
+
+
+def main():
+    only = set(filter(None, bench_args.only.split(",")))
+
+    def wanted(name):
+        return not only or name in only
+
+    results = {}
+    moto = None
+    try:
+        if wanted("scenarios") or wanted("run_instances"):
+            moto = MotoServer(region=os.environ["AWS_DEFAULT_REGION"]).start()
+            faulty_client = FaultyEC2Client(
+                moto.client(),
+                latency=bench_args.ec2_latency,
+                jitter=bench_args.ec2_jitter,
+                rate=bench_args.ec2_rate,
+                burst=bench_args.ec2_burst)
+            cluster_master.ec2_api.client = faulty_client
+            fixtures = create_fixtures(moto.client())
+
+        if wanted("log_to_file"):
+            results["log_to_file"] = bench_log_to_file()
+        if wanted("save_metrics_data"):
+            results["save_metrics_data"] = bench_save_metrics_data()
+        if wanted("log_serving"):
+            results["log_serving"] = bench_log_serving()
+        if wanted("run_instances"):
+            results["run_instances"] = bench_run_instances(fixtures)
+        if wanted("scenarios"):
+            for trainer_count in bench_args.trainers.split(","):
+                results["trainers_%s" % trainer_count] = run_scenario(
+                    fixtures, int(trainer_count), faulty_client)
+    finally:
+        if moto is not None:
+            moto.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if bench_args.output:
+        with open(bench_args.output, "w") as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if bench_args.baseline:
+        with open(bench_args.baseline) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == "__main__":
+    main()
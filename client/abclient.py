@@ -1,27 +1,33 @@
 import argparse
 import os
 import time
-import math
 import logging
 import copy
 import threading
 
-import netaddr
 import boto3
 import namesgenerator
 import paramiko
+from botocore.exceptions import ClientError
 from scp import SCPClient
 import requests
 
+from ec2_cache import CachingEC2Client
+from ec2_throttle import ThrottledEC2Client
+from subnet_allocator import SubnetAllocator
+
 #Ab stands for aws benchmark
 
 class Abclient(object):
-    def __init__(self, args, log_handler, thread_lock = threading.Lock()):
+    def __init__(self, args, log_handler, subnet_allocator=None):
         self.args = args
         self.init_args()
         self.log_handler = log_handler
-        self.ec2client = boto3.client('ec2')
-        self.thread_lock = thread_lock
+        self.ec2client = CachingEC2Client(
+            ThrottledEC2Client(boto3.client('ec2')))
+        # clients sharing one allocator never pick the same subnet block
+        self.subnet_allocator = subnet_allocator or SubnetAllocator(
+            self.ec2client)
 
     def init_args(self):
         args = self.args
@@ -41,93 +47,15 @@ class Abclient(object):
         return namesgenerator.get_random_name()
     
     def create_subnet(self):
-        with self.thread_lock:
-            args = self.args
-            # if no vpc id provided, list vpcs
-            logging.info("start creating subnet")
-            if not args.vpc_id:
-                logging.info("no vpc provided, trying to find the default one")
-                vpcs_desc = self.ec2client.describe_vpcs(
-                    Filters=[{
-                        "Name": "isDefault",
-                        "Values": ["true", ]
-                    }], )
-                if len(vpcs_desc["Vpcs"]) == 0:
-                    raise ValueError('No default VPC')
-                args.vpc_id = vpcs_desc["Vpcs"][0]["VpcId"]
-                vpc_cidrBlock = vpcs_desc["Vpcs"][0]["CidrBlock"]
-
-                logging.info("default vpc fount with id %s and CidrBlock %s" %
-                            (args.vpc_id, vpc_cidrBlock))
-
-            if not vpc_cidrBlock:
-                logging.info("trying to find cidrblock for vpc")
-                vpcs_desc = self.ec2client.describe_vpcs(
-                    Filters=[{
-                        "Name": "vpc-id",
-                        "Values": [args.vpc_id, ],
-                    }], )
-                if len(vpcs_desc["Vpcs"]) == 0:
-                    raise ValueError('No VPC found')
-                vpc_cidrBlock = vpcs_desc["Vpcs"][0]["CidrBlock"]
-                logging.info("cidrblock for vpc is %s" % vpc_cidrBlock)
-
-            # list subnets in vpc in order to create a new one
-
-            logging.info("trying to find ip blocks for new subnet")
-            subnets_desc = self.ec2client.describe_subnets(
-                Filters=[{
-                    "Name": "vpc-id",
-                    "Values": [args.vpc_id, ],
-                }], )
-
-            ips_taken = []
-            for subnet_dec in subnets_desc["Subnets"]:
-                ips_taken.append(subnet_dec["CidrBlock"])
-
-            ip_blocks_avaliable = netaddr.IPSet(
-                [vpc_cidrBlock]) ^ netaddr.IPSet(ips_taken)
-            # adding 10 addresses as buffer
-            cidr_prefix = 32 - math.ceil(
-                math.log(args.pserver_count + args.trainer_count + 10, 2))
-            if cidr_prefix <= 16:
-                raise ValueError('Too many nodes to fit in current VPC')
-
-            for ipnetwork in ip_blocks_avaliable.iter_cidrs():
-                try:
-                    subnet_cidr = ipnetwork.subnet(int(cidr_prefix)).next()
-                    logging.info("subnet ip block found %s" % (subnet_cidr))
-                    break
-                except Exception:
-                    pass
-
-            if not subnet_cidr:
-                raise ValueError(
-                    'No avaliable subnet to fit required nodes in current VPC')
-
-            logging.info("trying to create subnet")
-            subnet_desc = self.ec2client.create_subnet(
-                CidrBlock=str(subnet_cidr),
-                VpcId=args.vpc_id,
-                AvailabilityZone=args.availability_zone)
-
-            subnet_id = subnet_desc["Subnet"]["SubnetId"]
-
-            subnet_waiter = self.ec2client.get_waiter('subnet_available')
-            # sleep for 1s before checking its state
-            time.sleep(1)
-            subnet_waiter.wait(SubnetIds=[subnet_id, ])
-
-            logging.info("subnet created")
-
-            logging.info("adding tags to newly created subnet")
-            self.ec2client.create_tags(
-                Resources=[subnet_id, ],
-                Tags=[{
-                    "Key": "Task_name",
-                    'Value': args.task_name
-                }])
-            return subnet_id
+        args = self.args
+        logging.info("start creating subnet")
+        if not args.vpc_id:
+            args.vpc_id = self.subnet_allocator.default_vpc()
+        subnet_id = self.subnet_allocator.create_subnet(
+            args.vpc_id, args.availability_zone,
+            args.pserver_count + args.trainer_count, args.task_name)
+        logging.info("subnet %s created" % subnet_id)
+        return subnet_id
 
     def run_instances(self, image_id, instance_type, count=1, role="MASTER", cmd=""):
         args = self.args
@@ -188,7 +116,8 @@ class Abclient(object):
 
         return instances_response["Reservations"][0]["Instances"]
 
-    def create(self):
+    def create(self, master_action="create", master_args=None):
+        # master_args overrides what is passed on to the master
         args = self.args
         self.init_args()
 
@@ -227,6 +156,21 @@ class Abclient(object):
 
         logging.info("credentials and pem copied to master")
 
+        registry_mirror = ""
+        if args.seed_registry_mirror:
+            # nodes pull layers from the docker hub once through this cache
+            # instead of each of them pulling them from the docker hub
+            stdin, stdout, stderr = ssh_client.exec_command(
+                command="docker run -d --restart=always -p 5000:5000"
+                " -e REGISTRY_PROXY_REMOTEURL=https://registry-1.docker.io"
+                " --name registry_mirror registry:2")
+            if stdout.channel.recv_exit_status() == 0:
+                registry_mirror = args.master_server_ip + ":5000"
+                logging.info("registry mirror started at " + registry_mirror)
+            else:
+                logging.info("could not start registry mirror: " +
+                             stderr.read())
+
         # set arguments and start docker
         if args.online_mode:
             kick_off_cmd = "docker run -i -v /home/ubuntu/.aws:/root/.aws/"
@@ -240,11 +184,18 @@ class Abclient(object):
         kick_off_cmd += " " + args.master_docker_image
 
         args_to_pass = copy.copy(args)
-        args_to_pass.action = "create"
+        args_to_pass.action = master_action
         del args_to_pass.pem_path
         del args_to_pass.security_group_ids
         del args_to_pass.master_docker_image
         del args_to_pass.master_server_public_ip
+        del args_to_pass.seed_registry_mirror
+        args_to_pass.registry_mirror = registry_mirror
+        for arg in vars(args).keys():
+            if arg.startswith("sweep_"):
+                delattr(args_to_pass, arg)
+        for arg, value in (master_args or {}).iteritems():
+            setattr(args_to_pass, arg, value)
         for arg, value in sorted(vars(args_to_pass).iteritems()):
             if str(value):
                 kick_off_cmd += ' --%s %s' % (arg, value)
@@ -321,6 +272,44 @@ class Abclient(object):
         return
         
 
+    def terminate_warm_pool(self, pool_name):
+        instances_response = self.ec2client.describe_instances(Filters=[{
+            "Name": "tag:Warm_pool",
+            "Values": [pool_name]
+        }, {
+            "Name": "instance-state-name",
+            "Values": ["pending", "running", "stopping", "stopped"]
+        }])
+        instance_ids = []
+        for reservation in instances_response["Reservations"]:
+            for instance in reservation["Instances"]:
+                instance_ids.append(instance["InstanceId"])
+        if instance_ids:
+            logging.info("terminating %d instance(s) of warm pool %s" %
+                         (len(instance_ids), pool_name))
+            self.ec2client.terminate_instances(InstanceIds=instance_ids)
+            self.ec2client.get_waiter('instance_terminated').wait(
+                InstanceIds=instance_ids)
+
+        # subnets the pool took over from tasks whose instances it kept
+        subnets = self.ec2client.describe_subnets(Filters=[{
+            "Name": "tag:Warm_pool",
+            "Values": [pool_name]
+        }])
+        for subnet in subnets["Subnets"]:
+            # interfaces of terminated instances take a moment to go away
+            for attempt in xrange(30):
+                try:
+                    self.ec2client.delete_subnet(SubnetId=subnet["SubnetId"])
+                    break
+                except ClientError as e:
+                    if e.response.get("Error", {}).get(
+                            "Code") != "DependencyViolation" or attempt == 29:
+                        raise
+                    time.sleep(10)
+            logging.info("subnet %s of warm pool %s deleted" %
+                         (subnet["SubnetId"], pool_name))
+
     def cleanup(self):
         if self.args.online_mode:
             logging.info("online mode: true, hard cleanup")
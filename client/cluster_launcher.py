@@ -4,6 +4,7 @@ import csv
 import os
 
 from abclient import Abclient
+from sweep import Sweep, generate_trials, parse_space
 
 
 def str2bool(v):
@@ -92,7 +93,42 @@ parser.add_argument(
     '--pserver_count', type=int, default=1, help="Pserver count")
 
 parser.add_argument(
-    '--action', type=str, default="create", help="create|cleanup|status")
+    '--trainer_market',
+    type=str,
+    default="on-demand",
+    help="on-demand|spot|spot-fallback, capacity trainers are launched on, spot-fallback asks for on-demand when no spot capacity is left"
+)
+
+parser.add_argument(
+    '--trainer_fallback_instance_types',
+    type=str,
+    default="",
+    help="comma separated instance types tried in order when trainer_instance_type has no capacity"
+)
+
+parser.add_argument(
+    '--fallback_availability_zones',
+    type=str,
+    default="",
+    help="comma separated zones trainers are launched in when availability_zone has no capacity"
+)
+
+parser.add_argument(
+    '--spot_max_price',
+    type=str,
+    default="",
+    help="max hourly price for spot trainers, empty for up to the on-demand price"
+)
+
+parser.add_argument(
+    '--use_ec2_fleet',
+    type=str2bool,
+    default=False,
+    help="launch trainers with one ec2 fleet instant request over all instance types and zones"
+)
+
+parser.add_argument(
+    '--action', type=str, default="create", help="create|cleanup|status|sweep")
 
 parser.add_argument('--pem_path', type=str, help="private key file")
 
@@ -114,6 +150,85 @@ parser.add_argument(
     default="putcn/paddle_aws_master:latest",
     help="master docker image id")
 
+parser.add_argument(
+    '--seed_registry_mirror',
+    type=str2bool,
+    default=False,
+    help="run a docker hub pull-through cache on the master node and have all nodes pull through it"
+)
+
+parser.add_argument(
+    '--sweep_space',
+    type=str,
+    default="",
+    help="sweep mode, trainer command parameters to sweep, e.g. batch_size:32|64,lr:0.0001~0.1:log"
+)
+
+parser.add_argument(
+    '--sweep_mode',
+    type=str,
+    default="grid",
+    help="grid|random, random samples --sweep_trials configs from the space")
+
+parser.add_argument(
+    '--sweep_trials',
+    type=int,
+    default=0,
+    help="number of configs to try, 0 for the whole grid")
+
+parser.add_argument(
+    '--sweep_seed', type=int, default=None, help="seed for random sweeps")
+
+parser.add_argument(
+    '--sweep_parallelism',
+    type=int,
+    default=4,
+    help="how many trial clusters run at the same time")
+
+parser.add_argument(
+    '--sweep_reuse_instances',
+    type=str2bool,
+    default=True,
+    help="hand instances of finished trials on to the next trial instead of terminating them"
+)
+
+parser.add_argument(
+    '--sweep_metric',
+    type=str,
+    default="",
+    help="metric reported by trainers that ranks trials and drives early stopping"
+)
+
+parser.add_argument(
+    '--sweep_goal',
+    type=str,
+    default="min",
+    help="min|max, whether lower or higher sweep_metric is better")
+
+parser.add_argument(
+    '--sweep_stop_threshold',
+    type=float,
+    default=None,
+    help="stop a trial whose recent sweep_metric is worse than this")
+
+parser.add_argument(
+    '--sweep_grace_period',
+    type=float,
+    default=600,
+    help="seconds a trial runs before it can be stopped early")
+
+parser.add_argument(
+    '--sweep_window',
+    type=float,
+    default=120,
+    help="seconds of recent metrics averaged for early stopping")
+
+parser.add_argument(
+    '--sweep_poll_interval',
+    type=float,
+    default=30,
+    help="seconds between checks of trial progress")
+
 parser.add_argument(
     '--no_clean_up',
     type=str2bool,
@@ -182,6 +297,54 @@ def log_handler(source, id):
 
 abclient = Abclient(args, log_handler)
 
+def run_sweep():
+    trials = generate_trials(
+        parse_space(args.sweep_space), args.sweep_mode, args.sweep_trials,
+        args.sweep_seed)
+    logging.info("sweeping %d configs, %d at a time" %
+                 (len(trials), args.sweep_parallelism))
+
+    # one master runs all trials as tasks and tears each one down when it
+    # ends, so it runs detached from this client
+    args.online_mode = False
+    master_args = {"max_running_tasks": args.sweep_parallelism}
+    pool_name = args.task_name + "_pool"
+    if args.sweep_reuse_instances:
+        # instances of a finished trial stay up for the next one
+        master_args.update({
+            "warm_pool": pool_name,
+            "warm_pool_size": args.sweep_parallelism *
+            (args.trainer_count + args.pserver_count),
+            "warm_pool_stop": False
+        })
+    abclient.create(master_action="scheduler", master_args=master_args)
+
+    sweep = Sweep(
+        abclient.get_master_web_url(""),
+        args.task_name,
+        args.trainer_command,
+        trials,
+        metric=args.sweep_metric,
+        goal=args.sweep_goal,
+        stop_threshold=args.sweep_stop_threshold,
+        grace_period=args.sweep_grace_period,
+        window=args.sweep_window,
+        poll_interval=args.sweep_poll_interval)
+    try:
+        sweep.submit()
+        sweep.wait()
+    finally:
+        print(sweep.format_table())
+        sweep.write_csv(log_path + args.task_name + "_sweep.csv")
+        logging.info("sweep results saved to " + log_path + args.task_name +
+                     "_sweep.csv")
+        if not args.no_clean_up:
+            sweep.wait_for_teardown()
+            if args.sweep_reuse_instances:
+                abclient.terminate_warm_pool(pool_name)
+            abclient._hard_cleanup()
+
+
 def print_arguments():
     print('-----------  Configuration Arguments -----------')
     for arg, value in sorted(vars(args).iteritems()):
@@ -192,4 +355,6 @@ def print_arguments():
 if __name__ == "__main__":
     print_arguments()
     if args.action == "create":
-        abclient.create()
\ No newline at end of file
+        abclient.create()
+    elif args.action == "sweep":
+        run_sweep()
\ No newline at end of file
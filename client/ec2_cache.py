@@ -0,0 +1,205 @@
+import copy
+import json
+import threading
+import time
+
+from botocore import xform_name
+from botocore.exceptions import ClientError
+from botocore.waiter import NormalizedOperationMethod, Waiter
+
+# describe calls asking about explicit instance ids that can be merged into
+# one bulk request, with the key holding the per-instance results
+BATCHABLE_CALLS = {
+    "describe_instance_status": "InstanceStatuses",
+    "describe_instances": "Reservations",
+}
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Batch(_Call):
+    def __init__(self):
+        _Call.__init__(self)
+        self.instance_ids = set()
+
+
+def _filter_response(operation, response, instance_ids):
+    instance_ids = set(instance_ids)
+    filtered = dict(response)
+    if operation == "describe_instances":
+        reservations = []
+        for reservation in response["Reservations"]:
+            instances = [
+                i for i in reservation["Instances"]
+                if i["InstanceId"] in instance_ids
+            ]
+            if instances:
+                reservation = dict(reservation)
+                reservation["Instances"] = instances
+                reservations.append(reservation)
+        filtered["Reservations"] = reservations
+    else:
+        filtered["InstanceStatuses"] = [
+            s for s in response["InstanceStatuses"]
+            if s["InstanceId"] in instance_ids
+        ]
+    return filtered
+
+
+class CachingEC2Client(object):
+    # drop-in wrapper around a boto3 ec2 client shared by all threads:
+    # - describe_* results are memoized for `ttl` seconds
+    # - identical describe calls in flight at the same time share one request
+    # - describe_instances / describe_instance_status calls that only ask
+    #   about instance ids are merged, within `batch_window` seconds, into one
+    #   bulk request and each caller gets its own instances back
+    # - any other call goes straight through and drops the cache, since it
+    #   may have changed what describe would return
+    def __init__(self, client, ttl=2.0, batch_window=0.2, max_batch=100):
+        self.client = client
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.inflight = {}
+        self.batches = {}
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "coalesced": 0,
+            "batched_requests": 0,
+            "batch_calls": 0,
+            "invalidations": 0,
+        }
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in ("get_paginator", "can_paginate"):
+            return attr
+        if name.startswith("describe_"):
+            return lambda **kwargs: self._describe(name, kwargs)
+
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.invalidate()
+
+        return call
+
+    def get_waiter(self, name):
+        # polls share cached, in flight and batched describe calls
+        waiter = self.client.get_waiter(name)
+        return Waiter(waiter.name, waiter.config,
+                      NormalizedOperationMethod(
+                          getattr(self, xform_name(waiter.config.operation))))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cached_entries"] = len(self.cache)
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_rate"] = (
+            float(stats["hits"] + stats["coalesced"]) / lookups
+            if lookups else 0.0)
+        return stats
+
+    def invalidate(self):
+        with self.lock:
+            self.cache = {}
+            self.counters["invalidations"] += 1
+
+    def _count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def _describe(self, operation, kwargs):
+        if (operation in BATCHABLE_CALLS and kwargs.get("InstanceIds") and
+                not set(kwargs) - set(["InstanceIds", "IncludeAllInstances"])):
+            return self._batched(operation, kwargs)
+
+        key = (operation, json.dumps(kwargs, sort_keys=True))
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and time.time() - cached[0] < self.ttl:
+                self.counters["hits"] += 1
+                return copy.deepcopy(cached[1])
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.inflight[key] = call
+                self.counters["misses"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if leader:
+            try:
+                call.result = getattr(self.client, operation)(**kwargs)
+                with self.lock:
+                    self.cache[key] = (time.time(), call.result)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return copy.deepcopy(call.result)
+
+    def _batched(self, operation, kwargs):
+        instance_ids = kwargs["InstanceIds"]
+        extra = dict((k, v) for k, v in kwargs.iteritems()
+                     if k != "InstanceIds")
+        key = (operation, json.dumps(extra, sort_keys=True))
+        with self.lock:
+            batch = self.batches.get(key)
+            leader = batch is None
+            if leader:
+                batch = _Batch()
+                self.batches[key] = batch
+            batch.instance_ids.update(instance_ids)
+            self.counters["batched_requests"] += 1
+
+        if leader:
+            # give other threads a moment to join this batch
+            time.sleep(self.batch_window)
+            with self.lock:
+                del self.batches[key]
+            try:
+                batch.result = self._bulk_call(
+                    operation, sorted(batch.instance_ids), extra)
+            except Exception as e:
+                batch.error = e
+            batch.event.set()
+        else:
+            batch.event.wait()
+
+        if isinstance(batch.error, ClientError):
+            # one unknown id fails the whole bulk call, ask on our own
+            return getattr(self.client, operation)(**kwargs)
+        if batch.error is not None:
+            raise batch.error
+        return _filter_response(operation, batch.result, instance_ids)
+
+    def _bulk_call(self, operation, instance_ids, extra):
+        result_key = BATCHABLE_CALLS[operation]
+        merged = {result_key: []}
+        for start in xrange(0, len(instance_ids), self.max_batch):
+            self._count("batch_calls")
+            response = getattr(self.client, operation)(
+                InstanceIds=instance_ids[start:start + self.max_batch],
+                **extra)
+            merged[result_key].extend(response[result_key])
+        return merged
@@ -0,0 +1,262 @@
+import contextlib
+import logging
+import random
+import threading
+import time
+import uuid
+
+from botocore import xform_name
+from botocore.exceptions import ClientError
+from botocore.waiter import NormalizedOperationMethod, Waiter
+
+# the api asks us to slow down
+THROTTLE_ERRORS = ("RequestLimitExceeded", "Throttling", "ThrottlingException")
+# transient failures on the api's side. the call may still have gone
+# through, so only calls that are safe to repeat are retried.
+SERVER_ERRORS = ("InternalError", "Unavailable", "ServiceUnavailable")
+# no capacity right now, usually worth a few slower retries
+CAPACITY_ERRORS = ("InsufficientInstanceCapacity", "InsufficientHostCapacity",
+                   "InsufficientAddressCapacity")
+
+# upper bounds in seconds of the per-call latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# launches made idempotent with a client token, so a retry after a server
+# side error does not launch the instances twice
+IDEMPOTENT_CALLS = ("run_instances", "create_fleet")
+# calls that change nothing and can always be repeated
+READ_ONLY_PREFIXES = ("describe_", "get_", "list_")
+
+# how many calls of each operation may be in flight at once
+DEFAULT_CONCURRENCY = {
+    "run_instances": 4,
+    "create_subnet": 2,
+    "terminate_instances": 2,
+    "delete_subnet": 2,
+}
+
+
+class TokenBucket(object):
+    # shared rate limit for all threads. the refill rate backs off
+    # multiplicatively when the api throttles us and creeps back up on
+    # success.
+    def __init__(self, rate, burst, min_rate=1.0):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        # returns the seconds spent waiting for a token
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def on_throttle(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * 0.7)
+
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate,
+                                self.rate + self.max_rate / 20)
+
+
+class ThrottledEC2Client(object):
+    # wraps a boto3 ec2 client so every api call takes a token from a shared
+    # bucket, respects a per-operation concurrency cap and is retried with
+    # jittered exponential backoff on throttling and capacity errors, and on
+    # server errors of calls that are safe to repeat
+    def __init__(self,
+                 client,
+                 rate=10,
+                 burst=20,
+                 max_retries=8,
+                 max_capacity_retries=3,
+                 base_delay=0.5,
+                 capacity_base_delay=15,
+                 max_delay=60,
+                 concurrency=None):
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.max_capacity_retries = max_capacity_retries
+        self.base_delay = base_delay
+        self.capacity_base_delay = capacity_base_delay
+        self.max_delay = max_delay
+
+        if concurrency is None:
+            concurrency = DEFAULT_CONCURRENCY
+        self.semaphores = dict((op, threading.Semaphore(limit))
+                               for op, limit in concurrency.iteritems())
+
+        # per thread override of max_capacity_retries, see capacity_retries
+        self.local = threading.local()
+
+        self.lock = threading.Lock()
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "throttle_errors": 0,
+            "server_errors": 0,
+            "capacity_errors": 0,
+            "failed_calls": 0,
+            # seconds spent waiting for tokens, concurrency slots and in
+            # backoff
+            "throttled_seconds": 0.0,
+        }
+        self.by_operation = {}
+        # per operation [counts per bucket + one for slower, total seconds]
+        self.latency = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+        if not callable(attr) or name in ("get_paginator", "can_paginate"):
+            return attr
+        return lambda *args, **kwargs: self._call(name, attr, args, kwargs)
+
+    def get_waiter(self, name):
+        # polls take tokens like any other call
+        waiter = self.client.get_waiter(name)
+        return Waiter(waiter.name, waiter.config,
+                      NormalizedOperationMethod(
+                          getattr(self, xform_name(waiter.config.operation))))
+
+    @contextlib.contextmanager
+    def capacity_retries(self, retries):
+        # calls this thread makes inside the block get `retries` capacity
+        # retries instead of max_capacity_retries, e.g. none for a caller
+        # that has other capacity to fall back to
+        previous = getattr(self.local, "capacity_retries", None)
+        self.local.capacity_retries = retries
+        try:
+            yield
+        finally:
+            self.local.capacity_retries = previous
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["operations"] = dict(
+                (op, dict(counts))
+                for op, counts in self.by_operation.iteritems())
+        stats["current_rate"] = self.bucket.rate
+        return stats
+
+    def latency_histograms(self):
+        # {operation: (bucket counts, total seconds)} of every api attempt,
+        # not counting time spent throttled
+        with self.lock:
+            return dict((op, (list(counts), total))
+                        for op, (counts, total) in self.latency.iteritems())
+
+    def _observe(self, operation, seconds):
+        with self.lock:
+            if operation not in self.latency:
+                self.latency[operation] = [[0] * (len(LATENCY_BUCKETS) + 1),
+                                           0.0]
+            histogram = self.latency[operation]
+            bucket = len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    bucket = i
+                    break
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+
+    def _count(self, operation, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+            counts = self.by_operation.setdefault(operation, {})
+            counts[counter] = counts.get(counter, 0) + amount
+
+    def _backoff(self, attempt, base_delay):
+        # full jitter
+        return random.uniform(0, min(self.max_delay, base_delay * 2**attempt))
+
+    def _call(self, operation, method, args, kwargs):
+        self._count(operation, "calls")
+        semaphore = self.semaphores.get(operation)
+        throttle_attempts = 0
+        server_attempts = 0
+        capacity_attempts = 0
+        max_capacity_retries = getattr(self.local, "capacity_retries", None)
+        if max_capacity_retries is None:
+            max_capacity_retries = self.max_capacity_retries
+        new_token = operation in IDEMPOTENT_CALLS and \
+            "ClientToken" not in kwargs
+        repeatable = operation in IDEMPOTENT_CALLS or \
+            operation.startswith(READ_ONLY_PREFIXES)
+        if new_token:
+            kwargs = dict(kwargs, ClientToken=uuid.uuid4().hex)
+        while True:
+            waited = self.bucket.acquire()
+            if semaphore is not None:
+                started = time.time()
+                semaphore.acquire()
+                waited += time.time() - started
+            if waited:
+                self._count(operation, "throttled_seconds", waited)
+            attempt_started = time.time()
+            try:
+                result = method(*args, **kwargs)
+                self._observe(operation, time.time() - attempt_started)
+                self.bucket.on_success()
+                return result
+            except ClientError as e:
+                self._observe(operation, time.time() - attempt_started)
+                code = e.response.get("Error", {}).get("Code", "")
+                if code in THROTTLE_ERRORS:
+                    self._count(operation, "throttle_errors")
+                    self.bucket.on_throttle()
+                    throttle_attempts += 1
+                    if throttle_attempts > self.max_retries:
+                        self._count(operation, "failed_calls")
+                        raise
+                    delay = self._backoff(throttle_attempts, self.base_delay)
+                elif code in SERVER_ERRORS:
+                    self._count(operation, "server_errors")
+                    server_attempts += 1
+                    if not repeatable or server_attempts > self.max_retries:
+                        self._count(operation, "failed_calls")
+                        raise
+                    delay = self._backoff(server_attempts, self.base_delay)
+                elif code in CAPACITY_ERRORS:
+                    self._count(operation, "capacity_errors")
+                    capacity_attempts += 1
+                    if capacity_attempts > max_capacity_retries:
+                        self._count(operation, "failed_calls")
+                        raise
+                    delay = self._backoff(capacity_attempts,
+                                          self.capacity_base_delay)
+                    # ec2 would answer the same token with the same error
+                    if new_token:
+                        kwargs = dict(kwargs, ClientToken=uuid.uuid4().hex)
+                else:
+                    self._count(operation, "failed_calls")
+                    raise
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+            logging.info("%s failed with %s, retrying in %.1fs" %
+                         (operation, code, delay))
+            self._count(operation, "retries")
+            self._count(operation, "throttled_seconds", delay)
+            time.sleep(delay)
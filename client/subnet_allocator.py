@@ -0,0 +1,221 @@
+import logging
+import math
+import threading
+import time
+
+import netaddr
+from botocore.exceptions import ClientError
+
+# ec2 takes 5 addresses of every subnet, 10 more are left as buffer
+ADDRESS_BUFFER = 10
+# a subnet as big as a whole /16 vpc leaves nothing for anyone else
+MAX_SUBNET_PREFIX = 16
+# create_subnet errors meaning the block was taken behind our back
+CONFLICT_ERRORS = ("InvalidSubnet.Conflict", "InvalidSubnet.Range")
+
+
+def prefix_for(node_count):
+    prefix = 32 - int(
+        math.ceil(math.log(node_count + ADDRESS_BUFFER, 2)))
+    if prefix <= MAX_SUBNET_PREFIX:
+        raise ValueError('Too many nodes to fit in current VPC')
+    return prefix
+
+
+class SubnetAllocator(object):
+    # hands out subnet cidr blocks from an in-memory index of each vpc's
+    # free address space instead of describing every subnet of the vpc for
+    # each new subnet. the index is the vpc cidr blocks minus the subnets
+    # found when it was loaded, minus the blocks reserved since. blocks are
+    # reserved under a lock, so tasks launching at the same time never pick
+    # the same one, and picked best fit: the first block of the smallest
+    # free range that holds it, keeping large ranges whole.
+    #
+    # the index only ever goes stale on the safe side (deleted subnets are
+    # seen as taken) until it is reloaded after `ttl` seconds. a subnet
+    # created by someone else in the mean time shows up as a conflict from
+    # create_subnet, which reloads the index and picks another block. the
+    # conflicting block is kept out of the index for `ttl` seconds, since
+    # describe_subnets may not list the new subnet yet.
+    def __init__(self, ec2client, ttl=300, conflict_retries=3):
+        self.ec2client = ec2client
+        self.ttl = ttl
+        self.conflict_retries = conflict_retries
+
+        self.lock = threading.Lock()
+        self.default_vpc_id = None
+        # vpc id -> {"free": IPSet, "loaded_at": time}
+        self.spaces = {}
+        # vpc id -> IPSet of blocks reserved and not created yet
+        self.reserved = {}
+        # vpc id -> {block: time} of blocks create_subnet found taken
+        self.conflicts = {}
+
+    def default_vpc(self):
+        with self.lock:
+            if self.default_vpc_id is None:
+                logging.info("no vpc provided, trying to find the default one")
+                vpcs_desc = self.ec2client.describe_vpcs(
+                    Filters=[{
+                        "Name": "isDefault",
+                        "Values": ["true", ]
+                    }], )
+                if len(vpcs_desc["Vpcs"]) == 0:
+                    raise ValueError('No default VPC')
+                self.default_vpc_id = vpcs_desc["Vpcs"][0]["VpcId"]
+                logging.info("default vpc found with id %s" %
+                             self.default_vpc_id)
+            return self.default_vpc_id
+
+    def invalidate(self, vpc_id=None):
+        with self.lock:
+            if vpc_id is None:
+                self.spaces = {}
+            else:
+                self.spaces.pop(vpc_id, None)
+
+    def _space(self, vpc_id):
+        space = self.spaces.get(vpc_id)
+        if space is None or time.time() - space["loaded_at"] > self.ttl:
+            space = self.spaces[vpc_id] = self._load(vpc_id)
+        return space
+
+    def _load(self, vpc_id):
+        vpcs_desc = self.ec2client.describe_vpcs(VpcIds=[vpc_id])
+        if len(vpcs_desc["Vpcs"]) == 0:
+            raise ValueError('No VPC found')
+        vpc = vpcs_desc["Vpcs"][0]
+        # a vpc may have secondary cidr blocks besides the primary one
+        blocks = netaddr.IPSet([
+            association["CidrBlock"]
+            for association in vpc.get("CidrBlockAssociationSet", [])
+            if association.get("CidrBlockState", {}).get("State") ==
+            "associated"
+        ] or [vpc["CidrBlock"]])
+
+        subnets_desc = self.ec2client.describe_subnets(
+            Filters=[{
+                "Name": "vpc-id",
+                "Values": [vpc_id, ],
+            }], )
+        taken = netaddr.IPSet(
+            [subnet["CidrBlock"] for subnet in subnets_desc["Subnets"]])
+        conflicts = self.conflicts.get(vpc_id, {})
+        for cidr, found_at in conflicts.items():
+            if time.time() - found_at > self.ttl:
+                del conflicts[cidr]
+        free = blocks - taken - self.reserved.get(
+            vpc_id, netaddr.IPSet()) - netaddr.IPSet(conflicts.keys())
+        logging.info("vpc %s has %d subnet(s), %d free address(es)" %
+                     (vpc_id, len(subnets_desc["Subnets"]), free.size))
+        return {"free": free, "loaded_at": time.time()}
+
+    def reserve(self, vpc_id, prefix, count=1):
+        # count blocks of /prefix, taken out of the free space together
+        with self.lock:
+            space = self._space(vpc_id)
+            cidrs = []
+            for _ in xrange(count):
+                candidates = [
+                    c for c in space["free"].iter_cidrs()
+                    if c.prefixlen <= prefix
+                ]
+                if not candidates:
+                    for cidr in cidrs:
+                        self._unreserve(vpc_id, cidr)
+                    raise ValueError(
+                        'No avaliable subnet to fit required nodes in current VPC'
+                    )
+                best = max(candidates,
+                           key=lambda c: (c.prefixlen, -c.first))
+                cidr = netaddr.IPNetwork("%s/%d" % (best.network, prefix))
+                space["free"].remove(cidr)
+                self.reserved.setdefault(vpc_id, netaddr.IPSet()).add(cidr)
+                cidrs.append(cidr)
+            return cidrs
+
+    def release(self, vpc_id, cidr):
+        # a reserved block that did not become a subnet
+        with self.lock:
+            self._unreserve(vpc_id, cidr)
+
+    def _unreserve(self, vpc_id, cidr):
+        self.reserved.get(vpc_id, netaddr.IPSet()).remove(cidr)
+        space = self.spaces.get(vpc_id)
+        if space is not None:
+            space["free"].add(cidr)
+
+    def _created(self, vpc_id, cidr):
+        # the block is a real subnet now, a reload will see it as taken
+        with self.lock:
+            self.reserved.get(vpc_id, netaddr.IPSet()).remove(cidr)
+
+    def create_subnets(self, vpc_id, zones, node_count, task_name):
+        # one subnet per zone, each big enough for node_count nodes, tagged
+        # with the task. returns {zone: subnet id} once all are available.
+        prefix = prefix_for(node_count)
+        cidrs = self.reserve(vpc_id, prefix, len(zones))
+        subnet_ids = {}
+        try:
+            for zone, cidr in zip(zones, cidrs):
+                subnet_ids[zone] = self._create(vpc_id, zone, cidr, prefix)
+        except Exception:
+            # the failed block is released already, the ones after it were
+            # never tried
+            for cidr in cidrs[len(subnet_ids) + 1:]:
+                self.release(vpc_id, cidr)
+            if subnet_ids:
+                logging.info("deleting subnet(s) %s of the incomplete set" %
+                             ",".join(subnet_ids.values()))
+                for subnet_id in subnet_ids.values():
+                    self.ec2client.delete_subnet(SubnetId=subnet_id)
+            raise
+
+        subnet_waiter = self.ec2client.get_waiter('subnet_available')
+        # sleep for 1s before checking its state
+        time.sleep(1)
+        subnet_waiter.wait(SubnetIds=subnet_ids.values())
+        logging.info("subnet(s) created")
+
+        logging.info("adding tags to newly created subnet(s)")
+        self.ec2client.create_tags(
+            Resources=subnet_ids.values(),
+            Tags=[{
+                "Key": "Task_name",
+                'Value': task_name
+            }])
+        return subnet_ids
+
+    def create_subnet(self, vpc_id, zone, node_count, task_name):
+        return self.create_subnets(vpc_id, [zone], node_count,
+                                   task_name)[zone]
+
+    def _create(self, vpc_id, zone, cidr, prefix):
+        # creates the subnet for a reserved block, picking another one if
+        # the block turns out to be taken
+        attempt = 0
+        while True:
+            logging.info("trying to create subnet %s in %s" % (cidr, zone))
+            try:
+                subnet_desc = self.ec2client.create_subnet(
+                    CidrBlock=str(cidr),
+                    VpcId=vpc_id,
+                    AvailabilityZone=zone)
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code not in CONFLICT_ERRORS or \
+                        attempt >= self.conflict_retries:
+                    self.release(vpc_id, cidr)
+                    raise
+                attempt += 1
+                logging.info("subnet %s is taken (%s), reloading free space"
+                             % (cidr, code))
+                with self.lock:
+                    # the reloaded space leaves the conflicting block out
+                    self.reserved[vpc_id].remove(cidr)
+                    self.conflicts.setdefault(vpc_id, {})[cidr] = time.time()
+                    self.spaces.pop(vpc_id, None)
+                cidr = self.reserve(vpc_id, prefix)[0]
+                continue
+            self._created(vpc_id, cidr)
+            return subnet_desc["Subnet"]["SubnetId"]
@@ -0,0 +1,307 @@
+import csv
+import itertools
+import logging
+import math
+import random
+import time
+
+import requests
+
+from train_command import TrainCommand
+
+
+class _Choice(object):
+    def __init__(self, values):
+        self.values = values
+
+    def grid(self):
+        return self.values
+
+    def sample(self, rng):
+        return rng.choice(self.values)
+
+
+class _Range(object):
+    def __init__(self, low, high, log=False):
+        self.integer = _is_int(low) and _is_int(high)
+        self.low = float(low)
+        self.high = float(high)
+        self.log = log
+        if self.low > self.high:
+            raise ValueError("empty range %s~%s" % (low, high))
+        if log and self.low <= 0:
+            raise ValueError("log range has to be positive: %s~%s" %
+                             (low, high))
+
+    def grid(self):
+        raise ValueError("ranges can only be sampled, use --sweep_mode random"
+                         " or list the values with |")
+
+    def sample(self, rng):
+        if self.log:
+            value = math.exp(
+                rng.uniform(math.log(self.low), math.log(self.high)))
+        else:
+            value = rng.uniform(self.low, self.high)
+        if self.integer:
+            return str(int(round(value)))
+        return "%g" % value
+
+
+def _is_int(value):
+    try:
+        int(value)
+        return True
+    except ValueError:
+        return False
+
+
+def parse_space(spec):
+    # same key:value segments as TrainCommand, with the value being either
+    # alternatives or a range:
+    #   batch_size:32|64|128    one of the listed values
+    #   dropout:0.1~0.5         uniform in the range, integers if both ends are
+    #   lr:0.0001~0.1:log       log-uniform in the range
+    space = {}
+    for seg in spec.split(","):
+        if not seg.strip():
+            continue
+        parts = [p.strip() for p in seg.split(":")]
+        if len(parts) < 2 or not parts[0]:
+            raise ValueError("expected key:values in sweep space, got %s" %
+                             seg)
+        key, values = parts[0], parts[1]
+        if "~" in values:
+            low, high = values.split("~", 1)
+            space[key] = _Range(low, high, log="log" in parts[2:])
+        else:
+            space[key] = _Choice(values.split("|"))
+    if not space:
+        raise ValueError("sweep space is empty")
+    return space
+
+
+def generate_trials(space, mode="grid", count=0, seed=None):
+    # list of {parameter: value} dicts
+    keys = sorted(space)
+    if mode == "grid":
+        trials = [
+            dict(zip(keys, values))
+            for values in itertools.product(*[space[k].grid() for k in keys])
+        ]
+        return trials[:count] if count else trials
+    if mode == "random":
+        if not count:
+            raise ValueError("random sweeps need a trial count")
+        rng = random.Random(seed)
+        return [
+            dict((k, space[k].sample(rng)) for k in keys)
+            for _ in xrange(count)
+        ]
+    raise ValueError("unknown sweep mode %s" % mode)
+
+
+class Sweep(object):
+    # runs every trial as a task on one master, which keeps at most its
+    # max_running_tasks of them running. a trial whose recent metric is
+    # still worse than stop_threshold after grace_period seconds of running
+    # is stopped by tearing it down. results() gives one row per trial.
+    def __init__(self,
+                 master_url,
+                 name,
+                 trainer_command,
+                 trials,
+                 metric="",
+                 goal="min",
+                 stop_threshold=None,
+                 grace_period=300,
+                 window=120,
+                 poll_interval=30,
+                 teardown_timeout=1800):
+        if goal not in ("min", "max"):
+            raise ValueError("sweep goal has to be min or max")
+        self.master_url = master_url
+        self.name = name
+        self.metric = metric
+        self.goal = goal
+        self.stop_threshold = stop_threshold
+        self.grace_period = grace_period
+        self.window = window
+        self.poll_interval = poll_interval
+        self.teardown_timeout = teardown_timeout
+
+        self.trials = []
+        for i, params in enumerate(trials):
+            command = TrainCommand(trainer_command)
+            command.update(params)
+            self.trials.append({
+                "name": "%s_%d" % (name, i),
+                "params": params,
+                "trainer_command": command.unparse(),
+                "state": "pending",
+                "running_since": None,
+                "stopped_early": False
+            })
+
+    def _request(self, method, path, retries=10, **kwargs):
+        # the master may still be starting up, or briefly busy
+        for attempt in xrange(retries):
+            try:
+                return requests.request(
+                    method, self.master_url + path, timeout=30, **kwargs)
+            except requests.exceptions.RequestException as e:
+                if attempt == retries - 1:
+                    raise
+                logging.info("master not reachable (%s), retrying" % e)
+                time.sleep(min(30, 2**attempt))
+
+    def _query_metric(self, trial, agg, since=None):
+        params = {"key": self.metric, "agg": agg}
+        if since is not None:
+            params["since"] = since
+        response = self._request(
+            "GET", "/tasks/%s/metrics" % trial["name"], params=params)
+        if response.status_code != 200:
+            # nothing reported yet
+            return None
+        return response.json().get("value")
+
+    def _is_worse(self, value):
+        if self.goal == "min":
+            return value > self.stop_threshold
+        return value < self.stop_threshold
+
+    def submit(self):
+        for trial in self.trials:
+            response = self._request(
+                "POST",
+                "/tasks",
+                json={
+                    "task_name": trial["name"],
+                    "trainer_command": trial["trainer_command"]
+                })
+            if response.status_code != 201:
+                raise Exception("could not submit trial %s: %s" %
+                                (trial["name"], response.text))
+            trial["state"] = "queued"
+            logging.info("trial %s submitted with %s" %
+                         (trial["name"], trial["params"]))
+
+    def _check_early_stop(self, trial):
+        if (not self.metric or self.stop_threshold is None or
+                trial["stopped_early"] or trial["running_since"] is None or
+                time.time() - trial["running_since"] < self.grace_period):
+            return
+        # metrics are timestamped by the master, go by its clock
+        master_now = trial["started_at"] + (
+            time.time() - trial["running_since"])
+        value = self._query_metric(trial, "mean",
+                                   since=master_now - self.window)
+        if value is None or not self._is_worse(value):
+            return
+        logging.info("trial %s has %s %g, worse than %g, stopping it" %
+                     (trial["name"], self.metric, value, self.stop_threshold))
+        self._request("POST", "/tasks/%s/cleanup" % trial["name"])
+        trial["stopped_early"] = True
+
+    def wait(self):
+        trials = dict((t["name"], t) for t in self.trials)
+        while True:
+            tasks = self._request("GET", "/tasks").json()
+            unfinished = 0
+            for task in tasks:
+                trial = trials.get(task["name"])
+                if trial is None or trial["state"] in ("done", "failed"):
+                    continue
+                trial["state"] = task["state"]
+                if task["state"] == "running":
+                    if trial["running_since"] is None:
+                        trial["running_since"] = time.time()
+                        trial["started_at"] = task["started_at"]
+                    self._check_early_stop(trial)
+                elif task["state"] in ("done", "failed"):
+                    self._finish(trial, task)
+                    continue
+                unfinished += 1
+            if not unfinished:
+                break
+            time.sleep(self.poll_interval)
+
+    def _finish(self, trial, task):
+        trial["error"] = task.get("error")
+        trial["seconds"] = round(
+            task.get("finished_at", 0) - task.get("started_at", 0), 1)
+        if self.metric:
+            trial["best"] = self._query_metric(trial, self.goal)
+            trial["last"] = self._query_metric(trial, "last")
+        logging.info("trial %s %s%s" %
+                     (trial["name"], task["state"], " (stopped early)"
+                      if trial["stopped_early"] else ""))
+
+    def wait_for_teardown(self):
+        # trial instances are torn down (or released to the warm pool) by
+        # the master in the background
+        deadline = time.time() + self.teardown_timeout
+        for trial in self.trials:
+            while time.time() < deadline:
+                status = self._request(
+                    "GET", "/tasks/%s/cleanup" % trial["name"]).json()
+                if status.get("state") in ("done", "failed"):
+                    break
+                time.sleep(self.poll_interval)
+
+    def results(self):
+        # one row per trial, best trial first
+        rows = []
+        for trial in self.trials:
+            row = dict(trial["params"])
+            row.update({
+                "trial": trial["name"],
+                "state": "stopped" if trial["stopped_early"] else
+                trial["state"],
+                "seconds": trial.get("seconds")
+            })
+            if self.metric:
+                row["best_" + self.metric] = trial.get("best")
+                row["last_" + self.metric] = trial.get("last")
+            rows.append(row)
+        if self.metric:
+            key = "best_" + self.metric
+
+            def rank(row):
+                if row[key] is None:
+                    return (1, 0)
+                return (0, row[key] if self.goal == "min" else -row[key])
+
+            rows.sort(key=rank)
+        return rows
+
+    def columns(self):
+        params = sorted(set(k for t in self.trials for k in t["params"]))
+        columns = ["trial"] + params + ["state", "seconds"]
+        if self.metric:
+            columns += ["best_" + self.metric, "last_" + self.metric]
+        return columns
+
+    def format_table(self):
+        columns = self.columns()
+        rows = [[("" if r.get(c) is None else str(r.get(c))) for c in columns]
+                for r in self.results()]
+        widths = [
+            max([len(c)] + [len(row[i]) for row in rows])
+            for i, c in enumerate(columns)
+        ]
+        lines = [
+            "  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip()
+        ]
+        for row in rows:
+            lines.append("  ".join(
+                v.ljust(w) for v, w in zip(row, widths)).rstrip())
+        return "\n".join(lines)
+
+    def write_csv(self, path):
+        with open(path, "w") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=self.columns())
+            writer.writeheader()
+            for row in self.results():
+                writer.writerow(row)
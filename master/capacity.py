@@ -0,0 +1,294 @@
+import base64
+import contextlib
+import copy
+import json
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+MARKETS = {
+    "on-demand": ("on-demand", ),
+    "spot": ("spot", ),
+    "spot-fallback": ("spot", "on-demand")
+}
+
+# error codes meaning an instance type has no capacity in a zone right now,
+# the next instance type or zone is tried
+CAPACITY_ERRORS = ("InsufficientInstanceCapacity", "InsufficientCapacity",
+                   "InsufficientHostCapacity", "SpotMaxPriceTooLow",
+                   "MaxSpotInstanceCountExceeded", "Unsupported",
+                   "UnfulfillableCapacity")
+
+# prints the notice once the instance metadata has one, spot nodes get two
+# minutes of warning before they are reclaimed
+INTERRUPTION_WATCH_CMD = (
+    "while true; do "
+    "TOKEN=$(curl -s -m 2 -X PUT "
+    "-H 'X-aws-ec2-metadata-token-ttl-seconds: 300' "
+    "http://169.254.169.254/latest/api/token); "
+    "NOTICE=$(curl -sf -m 2 -H \"X-aws-ec2-metadata-token: $TOKEN\" "
+    "http://169.254.169.254/latest/meta-data/spot/instance-action) && "
+    "{ echo \"SPOT_INTERRUPTION $NOTICE\"; exit 0; }; "
+    "sleep %d; done")
+
+INTERRUPTION_PREFIX = "SPOT_INTERRUPTION "
+
+
+def parse_interruption_notice(line):
+    # the notice printed by INTERRUPTION_WATCH_CMD, None for any other line
+    if not line.startswith(INTERRUPTION_PREFIX):
+        return None
+    notice = line[len(INTERRUPTION_PREFIX):].strip()
+    try:
+        return json.loads(notice)
+    except ValueError:
+        return {"notice": notice}
+
+
+def _error_code(error):
+    return error.response.get("Error", {}).get("Code", "")
+
+
+def _split(value):
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+@contextlib.contextmanager
+def _retrying():
+    yield
+
+
+class CapacityStrategy(object):
+    # decides where and how instances of one role are launched. options are
+    # (zone, instance type) pairs, the first zone with every instance type,
+    # then the next zone, so nodes stay close to the pservers when they
+    # can. each market is tried over all options before the next one, e.g.
+    # spot everywhere and then on-demand everywhere. with use_fleet one ec2
+    # fleet instant request per market covers every option at once.
+    #
+    # subnet_for_zone(zone) -> subnet id to launch into in that zone
+    # fail_fast() -> context in which ec2 calls raise capacity errors without
+    #   retrying them, used for every attempt but the last so the next
+    #   option is tried right away
+    def __init__(self,
+                 ec2client,
+                 task_name,
+                 instance_types,
+                 zones,
+                 subnet_for_zone,
+                 market="on-demand",
+                 spot_max_price="",
+                 use_fleet=False,
+                 fail_fast=_retrying):
+        if market not in MARKETS:
+            raise ValueError("unknown market %s, expected one of %s" %
+                             (market, "|".join(sorted(MARKETS))))
+        self.ec2client = ec2client
+        self.task_name = task_name
+        self.instance_types = instance_types
+        self.zones = zones
+        self.subnet_for_zone = subnet_for_zone
+        self.markets = MARKETS[market]
+        self.spot_max_price = spot_max_price
+        self.use_fleet = use_fleet
+        self.fail_fast = fail_fast
+
+        self.lock = threading.Lock()
+        self.launch_templates = {}
+
+    @classmethod
+    def from_args(cls, ec2client, args, subnet_for_zone, fail_fast=_retrying):
+        # trainer capacity as configured on the command line
+        instance_types = [args.trainer_instance_type] + [
+            t for t in _split(args.trainer_fallback_instance_types)
+            if t != args.trainer_instance_type
+        ]
+        zones = [args.availability_zone] + [
+            z for z in _split(args.fallback_availability_zones)
+            if z != args.availability_zone
+        ]
+        return cls(ec2client,
+                   args.task_name,
+                   instance_types,
+                   zones,
+                   subnet_for_zone,
+                   market=args.trainer_market,
+                   spot_max_price=args.spot_max_price,
+                   use_fleet=args.use_ec2_fleet,
+                   fail_fast=fail_fast)
+
+    def options(self):
+        return [(zone, instance_type)
+                for zone in self.zones
+                for instance_type in self.instance_types]
+
+    def launch(self, spec, count, min_count):
+        # spec holds the run_instances arguments apart from the count,
+        # instance type, placement and market. returns the launched
+        # instances, raises the last capacity error if no option had any.
+        attempts = []
+        for market in self.markets:
+            if self.use_fleet:
+                attempts.append((market, None))
+            else:
+                attempts.extend(
+                    (market, option) for option in self.options())
+        last_error = None
+        for index, (market, option) in enumerate(attempts):
+            last = index == len(attempts) - 1
+            try:
+                with _retrying() if last else self.fail_fast():
+                    if option is None:
+                        return self._launch_fleet(spec, market, count)
+                    zone, instance_type = option
+                    return self._run_instances(spec, market, zone,
+                                               instance_type, count,
+                                               min_count)
+            except ClientError as e:
+                if _error_code(e) not in CAPACITY_ERRORS:
+                    raise
+                if option is None:
+                    logging.info("no %s capacity from ec2 fleet: %s" %
+                                 (market, e))
+                else:
+                    logging.info("no %s capacity for %d %s in %s: %s" %
+                                 (market, count, instance_type, zone,
+                                  _error_code(e)))
+                last_error = e
+        raise last_error
+
+    def _run_instances(self, spec, market, zone, instance_type, count,
+                       min_count):
+        request = copy.deepcopy(spec)
+        request.update(
+            InstanceType=instance_type,
+            MaxCount=count,
+            MinCount=min_count,
+            Placement={"AvailabilityZone": zone})
+        request["NetworkInterfaces"][0]["SubnetId"] = self.subnet_for_zone(
+            zone)
+        if market == "spot":
+            spot_options = {
+                "SpotInstanceType": "one-time",
+                "InstanceInterruptionBehavior": "terminate"
+            }
+            if self.spot_max_price:
+                spot_options["MaxPrice"] = self.spot_max_price
+            request["InstanceMarketOptions"] = {
+                "MarketType": "spot",
+                "SpotOptions": spot_options
+            }
+            # one-time spot instances can not be stopped
+            request["InstanceInitiatedShutdownBehavior"] = "terminate"
+        response = self.ec2client.run_instances(**request)
+        logging.info("%d %s %s instance(s) launched in %s" %
+                     (len(response["Instances"]), market, instance_type,
+                      zone))
+        return response["Instances"]
+
+    def _launch_template(self, spec, market):
+        # ec2 fleet only launches from templates, one per task, role and
+        # market, tagged with the task so teardown deletes it
+        role = [
+            t["Value"] for t in spec["TagSpecifications"][0]["Tags"]
+            if t["Key"] == "Role"
+        ][0]
+        with self.lock:
+            if (role, market) in self.launch_templates:
+                return self.launch_templates[(role, market)]
+            interface = dict(spec["NetworkInterfaces"][0])
+            interface.pop("SubnetId", None)
+            interface["Groups"] = list(interface["Groups"])
+            # one-time spot instances can not be stopped, on-demand ones
+            # keep the spec's behaviour so the warm pool can stop them
+            shutdown_behavior = spec.get("InstanceInitiatedShutdownBehavior",
+                                         "stop")
+            if market == "spot":
+                shutdown_behavior = "terminate"
+            response = self.ec2client.create_launch_template(
+                LaunchTemplateName="%s-%s-%s" % (self.task_name, role.lower(),
+                                                 market),
+                LaunchTemplateData={
+                    "ImageId": spec["ImageId"],
+                    "KeyName": spec["KeyName"],
+                    "UserData": base64.b64encode(spec.get("UserData", "")),
+                    "InstanceInitiatedShutdownBehavior": shutdown_behavior,
+                    "NetworkInterfaces": [interface],
+                    "TagSpecifications": spec["TagSpecifications"]
+                })
+            template_id = response["LaunchTemplate"]["LaunchTemplateId"]
+            self.ec2client.create_tags(
+                Resources=[template_id],
+                Tags=[{
+                    "Key": "Task_name",
+                    "Value": self.task_name
+                }])
+            self.launch_templates[(role, market)] = template_id
+            return template_id
+
+    def _launch_fleet(self, spec, market, count):
+        overrides = []
+        for priority, (zone, instance_type) in enumerate(self.options()):
+            override = {
+                "InstanceType": instance_type,
+                "SubnetId": self.subnet_for_zone(zone),
+                "Priority": float(priority)
+            }
+            if market == "spot" and self.spot_max_price:
+                override["MaxPrice"] = self.spot_max_price
+            overrides.append(override)
+        response = self.ec2client.create_fleet(
+            Type="instant",
+            LaunchTemplateConfigs=[{
+                "LaunchTemplateSpecification": {
+                    "LaunchTemplateId": self._launch_template(spec, market),
+                    "Version": "$Latest"
+                },
+                "Overrides": overrides
+            }],
+            TargetCapacitySpecification={
+                "TotalTargetCapacity": count,
+                "DefaultTargetCapacityType": market
+            },
+            SpotOptions={"AllocationStrategy":
+                         "capacity-optimized-prioritized"},
+            OnDemandOptions={"AllocationStrategy": "prioritized"})
+        # only ids come back, which is all the readiness wait needs
+        instances = []
+        for launched in response.get("Instances", []):
+            for instance_id in launched["InstanceIds"]:
+                instances.append({
+                    "InstanceId": instance_id,
+                    "InstanceType": launched["InstanceType"],
+                    "InstanceLifecycle": launched.get("Lifecycle", market)
+                })
+        if not instances:
+            errors = response.get("Errors") or [{}]
+            raise ClientError({
+                "Error": {
+                    "Code": errors[0].get("ErrorCode",
+                                          "InsufficientInstanceCapacity"),
+                    "Message": errors[0].get("ErrorMessage", "")
+                }
+            }, "CreateFleet")
+        logging.info("%d of %d %s instance(s) launched by ec2 fleet %s" %
+                     (len(instances), count, market, response["FleetId"]))
+        return instances
+
+
+def is_spot_interruption(ec2client, instance_id):
+    # whether the instance was reclaimed by ec2, for nodes that went away
+    # before their interruption notice was seen
+    try:
+        response = ec2client.describe_instances(InstanceIds=[instance_id])
+    except ClientError:
+        logging.exception("could not describe %s" % instance_id)
+        return False
+    for reservation in response["Reservations"]:
+        for instance in reservation["Instances"]:
+            if instance.get("StateReason", {}).get("Code") in (
+                    "Server.SpotInstanceTermination",
+                    "Server.SpotInstanceShutdown"):
+                return True
+    return False
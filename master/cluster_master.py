@@ -2,22 +2,42 @@
 import argparse
 import os
 import json
-import math
 import time
 import threading
 import logging
 import copy
-import csv
+import socket
 import sys
+import urlparse
 
-import netaddr
 import boto3
 import namesgenerator
-import paramiko
 
 from train_command import TrainCommand
-
-from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from provisioner import BatchProvisioner, Deferred, iter_ready_instances
+from ssh_pool import SSHSessionManager
+from log_writer import LogWriter
+from log_mux import ChannelHandle, LogMultiplexer
+from metrics_store import MetricsStore, QueryError
+
+from http_util import ThreadingHTTPServer, send_file
+from log_tail import LogTailer, RingLogHandler
+from teardown import get_teardown, teardown_status
+from ec2_cache import CachingEC2Client
+from ec2_throttle import LATENCY_BUCKETS, ThrottledEC2Client
+from warm_pool import WarmPool
+from image_prepull import ImagePrepuller
+from task_scheduler import DuplicateTaskError, TaskScheduler
+from tracing import Tracer
+from trainer_supervisor import TrainerSupervisor
+from health import HealthMonitor
+from stragglers import StragglerDetector
+from prometheus import CONTENT_TYPE, MetricFamily, render
+from capacity import (CapacityStrategy, INTERRUPTION_WATCH_CMD,
+                      is_spot_interruption, parse_interruption_notice)
+from subnet_allocator import SubnetAllocator
+
+from BaseHTTPServer import BaseHTTPRequestHandler
 
 
 # You must have aws_access_key_id, aws_secret_access_key, region set in
@@ -92,6 +112,173 @@ parser.add_argument(
 parser.add_argument(
     '--pserver_count', type=int, default=1, help="Pserver count")
 
+parser.add_argument(
+    '--batch_trainer_provisioning',
+    type=str2bool,
+    default=False,
+    help="launch all trainers with batched run_instances calls instead of one call per trainer"
+)
+
+parser.add_argument(
+    '--trainer_launch_chunk_size',
+    type=int,
+    default=0,
+    help="max trainers per run_instances call in batched mode, 0 for all in one call"
+)
+
+parser.add_argument(
+    '--trainer_launch_retries',
+    type=int,
+    default=3,
+    help="how many times to retry launching the trainer shortfall in batched mode"
+)
+
+parser.add_argument(
+    '--stream_instance_readiness',
+    type=str2bool,
+    default=True,
+    help="kick off each node as soon as it passes status checks instead of waiting for the whole batch"
+)
+
+parser.add_argument(
+    '--pipelined_bring_up',
+    type=str2bool,
+    default=False,
+    help="launch pservers and trainers at the same time, trainers only wait for pserver ips before kickoff"
+)
+
+parser.add_argument(
+    '--trainer_market',
+    type=str,
+    default="on-demand",
+    help="on-demand|spot|spot-fallback, capacity trainers are launched on, spot-fallback asks for on-demand when no spot capacity is left"
+)
+
+parser.add_argument(
+    '--trainer_fallback_instance_types',
+    type=str,
+    default="",
+    help="comma separated instance types tried in order when trainer_instance_type has no capacity"
+)
+
+parser.add_argument(
+    '--fallback_availability_zones',
+    type=str,
+    default="",
+    help="comma separated zones trainers are launched in when availability_zone has no capacity, a subnet is created in each one used"
+)
+
+parser.add_argument(
+    '--spot_max_price',
+    type=str,
+    default="",
+    help="max hourly price for spot trainers, empty for up to the on-demand price"
+)
+
+parser.add_argument(
+    '--use_ec2_fleet',
+    type=str2bool,
+    default=False,
+    help="launch trainers with one ec2 fleet instant request over all instance types and zones instead of trying them one by one"
+)
+
+parser.add_argument(
+    '--spot_interruption_poll_interval',
+    type=int,
+    default=5,
+    help="seconds between spot trainers checking for an interruption notice")
+
+parser.add_argument(
+    '--spot_replacements',
+    type=int,
+    default=3,
+    help="how many times a trainer reclaimed by spot is replaced under the same index"
+)
+
+parser.add_argument(
+    '--trainer_relaunches',
+    type=int,
+    default=2,
+    help="how many times a trainer that exits non-zero is relaunched on a new instance under the same index before the cluster is torn down"
+)
+
+parser.add_argument(
+    '--health_probe_interval',
+    type=int,
+    default=30,
+    help="seconds between health probes of running nodes over ssh, 0 to disable"
+)
+
+parser.add_argument(
+    '--health_probe_workers',
+    type=int,
+    default=8,
+    help="threads probing nodes, however many nodes the task has"
+)
+
+parser.add_argument(
+    '--stall_timeout',
+    type=int,
+    default=600,
+    help="seconds a running trainer may print nothing before it counts as stalled"
+)
+
+parser.add_argument(
+    '--straggler_gpu_ratio',
+    type=float,
+    default=0.5,
+    help="a trainer whose gpu utilisation is below this ratio of the median over all trainers is a straggler"
+)
+
+parser.add_argument(
+    '--stalled_trainer_action',
+    type=str,
+    default="report",
+    help="report|relaunch|cleanup, what to do with a stalled trainer besides reporting it"
+)
+
+parser.add_argument(
+    '--straggler_window',
+    type=int,
+    default=120,
+    help="seconds of recent metrics lines each trainer's throughput is computed over"
+)
+
+parser.add_argument(
+    '--straggler_z_threshold',
+    type=float,
+    default=1.5,
+    help="standard deviations a trainer must be slower than the fleet by to count as a straggler"
+)
+
+parser.add_argument(
+    '--straggler_median_ratio',
+    type=float,
+    default=1.25,
+    help="how many times slower than the median of the other trainers a trainer must be to count as a straggler, in fleets too small for --straggler_z_threshold"
+)
+
+parser.add_argument(
+    '--progress_metric_keys',
+    type=str,
+    default="",
+    help="comma separated metrics keys that count up, e.g. step,examples, whose rate per second is compared between trainers"
+)
+
+parser.add_argument(
+    '--throughput_metric_keys',
+    type=str,
+    default="",
+    help="comma separated metrics keys that already are throughputs, e.g. examples_per_sec, compared between trainers"
+)
+
+parser.add_argument(
+    '--allow_trainer_scaling',
+    type=str2bool,
+    default=False,
+    help="allow POST /trainers to change the trainer count of a running task, only for training that copes with trainers joining and leaving"
+)
+
 parser.add_argument(
     '--pserver_bash_file',
     type=str,
@@ -111,13 +298,29 @@ parser.add_argument(
     '--trainer_command', type=str, default="", help="trainer start command")
 
 parser.add_argument(
-    '--action', type=str, default="serve", help="create|cleanup|serve")
+    '--action',
+    type=str,
+    default="serve",
+    help="create|cleanup|serve|scheduler, scheduler only runs tasks submitted with POST /tasks"
+)
 
 parser.add_argument('--pem_path', type=str, help="private key file")
 
 parser.add_argument(
     '--pserver_port', type=str, default="5436", help="pserver port")
 
+parser.add_argument(
+    '--ssh_keepalive_interval',
+    type=int,
+    default=30,
+    help="seconds between ssh keepalive packets, 0 to disable")
+
+parser.add_argument(
+    '--ssh_connect_retries',
+    type=int,
+    default=10,
+    help="how many times to retry connecting to a node's sshd")
+
 parser.add_argument(
     '--docker_image', type=str, default="busybox", help="training docker image")
 
@@ -133,6 +336,117 @@ parser.add_argument(
     default="**metrics_data: ",
     help="key string to identify metrics data")
 
+parser.add_argument(
+    '--log_flush_interval',
+    type=float,
+    default=1.0,
+    help="max seconds node log lines stay buffered before being written")
+
+parser.add_argument(
+    '--log_fsync_interval',
+    type=float,
+    default=5.0,
+    help="min seconds between fsyncs of node log files, 0 to fsync on every flush"
+)
+
+parser.add_argument(
+    '--log_flush_bytes',
+    type=int,
+    default=65536,
+    help="buffered node log bytes that trigger an early flush")
+
+parser.add_argument(
+    '--log_queue_size',
+    type=int,
+    default=10000,
+    help="max node log lines waiting to be written")
+
+parser.add_argument(
+    '--multiplex_node_logs',
+    type=str2bool,
+    default=True,
+    help="read all node output from one thread instead of two threads per node"
+)
+
+parser.add_argument(
+    '--echo_node_logs',
+    type=str2bool,
+    default=True,
+    help="whether to repeat every node log line in master.log")
+
+parser.add_argument(
+    '--log_tail_lines',
+    type=int,
+    default=1000,
+    help="lines kept in memory per log for /tail watchers")
+
+parser.add_argument(
+    '--ec2_cache_ttl',
+    type=float,
+    default=2.0,
+    help="seconds ec2 describe results are shared between threads, 0 to disable"
+)
+
+parser.add_argument(
+    '--ec2_api_rate',
+    type=float,
+    default=10,
+    help="max ec2 api calls per second shared by all threads")
+
+parser.add_argument(
+    '--ec2_api_burst',
+    type=int,
+    default=20,
+    help="ec2 api calls allowed in a burst above the rate")
+
+parser.add_argument(
+    '--warm_pool',
+    type=str,
+    default="",
+    help="name of a warm instance pool to claim nodes from and release them to instead of terminating, empty to disable"
+)
+
+parser.add_argument(
+    '--warm_pool_size',
+    type=int,
+    default=16,
+    help="max instances kept in the warm pool")
+
+parser.add_argument(
+    '--warm_pool_idle_ttl',
+    type=int,
+    default=3600,
+    help="seconds a warm pool instance may stay idle before it is terminated"
+)
+
+parser.add_argument(
+    '--warm_pool_stop',
+    type=str2bool,
+    default=True,
+    help="stop instances released to the warm pool instead of leaving them running idle"
+)
+
+parser.add_argument(
+    '--prepull_image',
+    type=str2bool,
+    default=True,
+    help="pull the training docker image on each node as soon as it is reachable, before kickoff"
+)
+
+parser.add_argument(
+    '--registry_mirror',
+    type=str,
+    default="",
+    help="host:port of a docker registry mirror nodes should pull through, e.g. one running on the master"
+)
+
+parser.add_argument(
+    '--max_running_tasks',
+    type=int,
+    default=4,
+    help="how many tasks this master runs at the same time, further tasks are queued"
+)
+
 parser.add_argument(
     '--no_clean_up',
     type=str2bool,
@@ -145,9 +459,12 @@ parser.add_argument(
     default=False,
     help="is client activly stays online")
 
+
 args = parser.parse_args()
 
-ec2client = boto3.client('ec2')
+ec2_api = ThrottledEC2Client(
+    boto3.client('ec2'), rate=args.ec2_api_rate, burst=args.ec2_api_burst)
+ec2client = CachingEC2Client(ec2_api, ttl=args.ec2_cache_ttl)
 
 args.log_path = os.path.join(os.path.dirname(__file__), "logs/")
 
@@ -162,100 +479,21 @@ else:
         level=logging.INFO,
         format='%(asctime)s %(message)s')
 
-log_files = ["master.log"]
-
-metrics = {}
+log_tailer = LogTailer(args.log_tail_lines)
+tail_handler = RingLogHandler(log_tailer)
+tail_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+logging.getLogger().addHandler(tail_handler)
 
 metrics_csv_file_name = "metrics.csv"
-is_metrics_file_created = False
-
-
-def create_subnet():
-    # if no vpc id provided, list vpcs
-    logging.info("start creating subnet")
-    if not args.vpc_id:
-        logging.info("no vpc provided, trying to find the default one")
-        vpcs_desc = ec2client.describe_vpcs(
-            Filters=[{
-                "Name": "isDefault",
-                "Values": ["true", ]
-            }], )
-        if len(vpcs_desc["Vpcs"]) == 0:
-            raise ValueError('No default VPC')
-        args.vpc_id = vpcs_desc["Vpcs"][0]["VpcId"]
-        vpc_cidrBlock = vpcs_desc["Vpcs"][0]["CidrBlock"]
-
-        logging.info("default vpc fount with id %s and CidrBlock %s" %
-                     (args.vpc_id, vpc_cidrBlock))
-
-    if not vpc_cidrBlock:
-        logging.info("trying to find cidrblock for vpc")
-        vpcs_desc = ec2client.describe_vpcs(
-            Filters=[{
-                "Name": "vpc-id",
-                "Values": [args.vpc_id, ],
-            }], )
-        if len(vpcs_desc["Vpcs"]) == 0:
-            raise ValueError('No VPC found')
-        vpc_cidrBlock = vpcs_desc["Vpcs"][0]["CidrBlock"]
-        logging.info("cidrblock for vpc is %s" % vpc_cidrBlock)
-
-    # list subnets in vpc in order to create a new one
-
-    logging.info("trying to find ip blocks for new subnet")
-    subnets_desc = ec2client.describe_subnets(
-        Filters=[{
-            "Name": "vpc-id",
-            "Values": [args.vpc_id, ],
-        }], )
-
-    ips_taken = []
-    for subnet_dec in subnets_desc["Subnets"]:
-        ips_taken.append(subnet_dec["CidrBlock"])
-
-    ip_blocks_avaliable = netaddr.IPSet(
-        [vpc_cidrBlock]) ^ netaddr.IPSet(ips_taken)
-    # adding 10 addresses as buffer
-    cidr_prefix = 32 - math.ceil(
-        math.log(args.pserver_count + args.trainer_count + 10, 2))
-    if cidr_prefix <= 16:
-        raise ValueError('Too many nodes to fit in current VPC')
-
-    for ipnetwork in ip_blocks_avaliable.iter_cidrs():
-        try:
-            subnet_cidr = ipnetwork.subnet(int(cidr_prefix)).next()
-            logging.info("subnet ip block found %s" % (subnet_cidr))
-            break
-        except Exception:
-            pass
-
-    if not subnet_cidr:
-        raise ValueError(
-            'No avaliable subnet to fit required nodes in current VPC')
-
-    logging.info("trying to create subnet")
-    subnet_desc = ec2client.create_subnet(
-        CidrBlock=str(subnet_cidr),
-        VpcId=args.vpc_id,
-        AvailabilityZone=args.availability_zone)
-
-    subnet_id = subnet_desc["Subnet"]["SubnetId"]
 
-    subnet_waiter = ec2client.get_waiter('subnet_available')
-    # sleep for 1s before checking its state
-    time.sleep(1)
-    subnet_waiter.wait(SubnetIds=[subnet_id, ])
-
-    logging.info("subnet created")
-
-    logging.info("adding tags to newly created subnet")
-    ec2client.create_tags(
-        Resources=[subnet_id, ],
-        Tags=[{
-            "Key": "Task_name",
-            'Value': args.task_name
-        }])
-    return subnet_id
+# shared by all tasks of this master
+log_mux = LogMultiplexer().start()
+scheduler = TaskScheduler(args.max_running_tasks)
+# tasks picking subnet ranges in the same vpc at once would pick the same
+# one, they all reserve them from here
+subnet_allocator = SubnetAllocator(ec2client)
+# the task given on the command line, served on the paths without /tasks/
+default_task = None
 
 
 def generate_task_name():
@@ -271,117 +509,12 @@ def script_to_str(file_path):
     return text
 
 
-def run_instances(image_id, instance_type, count, role, cmd=""):
-    if count == 0:
-        return []
-    response = ec2client.run_instances(
-        ImageId=image_id,
-        InstanceType=instance_type,
-        MaxCount=count,
-        MinCount=count,
-        UserData=cmd,
-        DryRun=False,
-        InstanceInitiatedShutdownBehavior="stop",
-        KeyName=args.key_name,
-        Placement={'AvailabilityZone': args.availability_zone},
-        NetworkInterfaces=[{
-            'DeviceIndex': 0,
-            'SubnetId': args.subnet_id,
-            "AssociatePublicIpAddress": True,
-            'Groups': args.security_group_ids
-        }],
-        TagSpecifications=[{
-            'ResourceType': "instance",
-            'Tags': [{
-                "Key": 'Task_name',
-                "Value": args.task_name
-            }, {
-                "Key": 'Role',
-                "Value": role
-            }]
-        }])
-
-    instance_ids = []
-    for instance in response["Instances"]:
-        instance_ids.append(instance["InstanceId"])
-
-    if len(instance_ids) > 0:
-        logging.info(str(len(instance_ids)) + " instance(s) created")
-    else:
-        logging.info("no instance created")
-    #create waiter to make sure it's running
-
-    logging.info("waiting for instance to become accessible")
-    waiter = ec2client.get_waiter('instance_status_ok')
-    waiter.wait(
-        Filters=[{
-            "Name": "instance-status.status",
-            "Values": ["ok"]
-        }, {
-            "Name": "instance-status.reachability",
-            "Values": ["passed"]
-        # }, {
-          #  "Name": "instance-state-name",
-           # "Values": ["running"]
-        }],
-        InstanceIds=instance_ids)
-
-    instances_response = ec2client.describe_instances(InstanceIds=instance_ids)
-
-    return instances_response["Reservations"][0]["Instances"]
-
-
-def create_pservers():
-    try:
-        return run_instances(
-            image_id=args.pserver_image_id,
-            instance_type=args.pserver_instance_type,
-            count=args.pserver_count,
-            role="PSERVER", )
-    except Exception:
-        logging.exception("error while trying to create pservers")
-        cleanup(args.task_name)
-
-
-def save_metrics_data(str_msg):
-    #parse msg
-    logging.info("found metrics data, saving it to csv file")
-    global is_metrics_file_created
-    metrics_raw = str_msg.split(",")
-    with open(args.log_path + metrics_csv_file_name, 'a') as csvfile:
-        csv_fieldnames = []
-        csv_write_data = {}
-        for metric in metrics_raw:
-            metric_data = metric.split("=")
-            metric_key = metric_data[0].strip()
-            metric_val = float(metric_data[1].strip())
-            if not metric_key in metrics:
-                metrics[metric_key] = []
-            metric_repo = metrics[metric_key]
-            metric_repo.append(metric_val)
-            csv_fieldnames.append(metric_key)
-            csv_write_data[metric_key] = metric_val
-        writer = csv.DictWriter(csvfile, fieldnames=csv_fieldnames)
-        if not is_metrics_file_created:
-            writer.writeheader()
-            is_metrics_file_created = True
-        writer.writerow(csv_write_data)
-        logging.info("csv file appended")
-
-
-def log_to_file(source, filename):
-    if not filename in log_files:
-        log_files.append(filename)
-    with open(args.log_path + filename, "a") as log_file:
-        for line in iter(source.readline, ""):
-            logging.info(line)
-            log_file.write(line)
-            log_file.flush()
-            os.fsync(log_file.fileno())
-            if (line.startswith(args.metric_data_identifier)):
-                #found key data, trying to add to csv
-                line = line.replace(args.metric_data_identifier, "")
-                save_metrics_data(line)
+def node_name(log_filename):
+    # trainer_0_err.log -> trainer_0
+    name = log_filename[:-len(".log")]
+    if name.endswith("_err"):
+        name = name[:-len("_err")]
+    return name
 
 
 def parse_command(command_raw, defaults={}):
@@ -389,153 +522,6 @@ def parse_command(command_raw, defaults={}):
     return cmd.to_python_command()
 
 
-def create_trainers(kickoff_cmd, pserver_endpoints_str, pserver_ips_str):
-    def create_and_start_trainer(trainer_index):
-        logging.info("trainer " + str(trainer_index) + " is starting")
-
-        instance_response = run_instances(
-            image_id=args.trainer_image_id,
-            instance_type=args.trainer_instance_type,
-            count=1,
-            role="TRAINER", )[0]
-        trainer_ip = instance_response["PrivateIpAddress"]
-
-        logging.info("trainer " + str(trainer_index) + " started")
-
-        ssh_key = paramiko.RSAKey.from_private_key_file(args.pem_path)
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname=trainer_ip, username="ubuntu", pkey=ssh_key)
-
-        logging.info("trainer " + str(trainer_index) +
-                     " terminal connected via ssh")
-
-        env_map = {
-            "PSERVER_HOSTS": pserver_endpoints_str,
-            "PSERVERS": pserver_endpoints_str,
-            "TRAINER_INDEX": str(trainer_index),
-            "TASK_NAME": args.task_name,
-            "TRAINER_COUNT": args.trainer_count,
-            "TRAINERS": args.trainer_count,
-            "MASTER_ENDPOINT": args.master_server_ip + ":" + str(args.master_server_port),
-            "PADDLE_TRAINING_ROLE": "TRAINER",
-            "TRAINING_ROLE":"TRAINER",
-            "PADDLE_PSERVER_IPS": pserver_ips_str,
-            "PADDLE_PSERVER_PORT": args.pserver_port,
-            "PADDLE_TRAINERS": args.trainer_count,
-            "PADDLE_CURRENT_IP": trainer_ip,
-            "PADDLE_TRAINER_ID": str(trainer_index), 
-            "PADDLE_INIT_TRAINER_ID": str(trainer_index), 
-        }
-
-        cmd = kickoff_cmd.format(
-            COMMAND=parse_command(args.trainer_command, {"device": "GPU"}),
-            ENV=generate_env(env_map),
-            DOCKER_IMAGE=args.docker_image,
-        )
-        logging.info(cmd)
-
-        stdin, stdout, stderr = ssh_client.exec_command(command=cmd)
-
-        # read and save output log
-
-        logging.info("trainer " + str(trainer_index) +
-                     " command executed, keep fetching log")
-
-        stdout_thread = threading.Thread(
-            target=log_to_file,
-            args=(
-                stdout,
-                "trainer_" + str(trainer_index) + ".log", ))
-        stderr_thread = threading.Thread(
-            target=log_to_file,
-            args=(
-                stderr,
-                "trainer_" + str(trainer_index) + "_err.log", ))
-        stdout_thread.start()
-        stderr_thread.start()
-
-        stdout_thread.join()
-        stderr_thread.join()
-
-        return_code = stdout.channel.recv_exit_status()
-        if return_code != 0:
-            trainer_create_results[trainer_index] = {'has_error': True}
-            raise ValueError("trainer didn't finish with exit code 0")
-
-        ssh_client.close()
-
-    # multi thread starting trainer instance and run kickoff command
-
-    trainer_threads = []
-    trainer_create_results = {}
-    try:
-        for i in xrange(args.trainer_count):
-            logging.info("starting tread for trainer " + str(i))
-            trainer_thread = threading.Thread(
-                target=create_and_start_trainer, args=(i, ))
-            trainer_thread.start()
-            trainer_threads.append(trainer_thread)
-
-        for trainer_thread in trainer_threads:
-            trainer_thread.join()
-
-        for result in trainer_create_results:
-            if result["has_error"]:
-                logging.error(
-                    "error during trainer starting or training, destorying the while cluster "
-                )
-                cleanup(args.task_name)
-                break
-
-        logging.info("all trainers stopped")
-    except Exception, e:
-        logging.info(
-            "Training exception, clean up resources, please check log for more info"
-        )
-    finally:
-        cleanup(args.task_name)
-
-
-def cleanup(task_name):
-    if args.online_mode:
-        logging.info("online_mode:true, going to let client handle cleanup")
-        return
-    if args.no_clean_up:
-        logging.info("no clean up option set, going to leave the setup running")
-        return
-    #shutdown all ec2 instances
-    print("going to clean up " + task_name + " instances")
-    instances_response = ec2client.describe_instances(Filters=[{
-        "Name": "tag:Task_name",
-        "Values": [task_name]
-    }])
-
-    instance_ids = []
-    if len(instances_response["Reservations"]) > 0:
-        for reservation in instances_response["Reservations"]:
-            for instance in reservation["Instances"]:
-                instance_ids.append(instance["InstanceId"])
-
-        ec2client.terminate_instances(InstanceIds=instance_ids)
-
-        instance_termination_waiter = ec2client.get_waiter(
-            'instance_terminated')
-        instance_termination_waiter.wait(InstanceIds=instance_ids)
-
-    #delete the subnet created
-
-    subnet = ec2client.describe_subnets(Filters=[{
-        "Name": "tag:Task_name",
-        "Values": [task_name]
-    }])
-
-    if len(subnet["Subnets"]) > 0:
-        ec2client.delete_subnet(SubnetId=subnet["Subnets"][0]["SubnetId"])
-    # no subnet delete waiter, just leave it.
-    logging.info("Clearnup done")
-    return
-
 def generate_env(env_map):
     out_list = []
     for key, val in env_map.iteritems():
@@ -543,122 +529,1053 @@ def generate_env(env_map):
     return " ".join(out_list)
 
 
-def kickoff_pserver(host, pserver_endpoints_str, pserver_ips_str):
+def default_pem_path(task_args):
+    return os.path.expanduser("~") + "/" + task_args.key_name + ".pem"
+
+
+def create_warm_pool(task_args, ssh_sessions):
+    # the warm pool named by the task's arguments, or None. ssh_sessions
+    # reach the instances released while running.
+    if not task_args.warm_pool:
+        return None
+
+    def reset_instance(instance):
+        # a node released to the warm pool while running may still have the
+        # pserver container up
+        exit_code, _, stderr = ssh_sessions.run(
+            instance["PrivateIpAddress"],
+            "docker ps -q | xargs -r docker rm -f", timeout=120)
+        ssh_sessions.close(instance["PrivateIpAddress"])
+        if exit_code != 0:
+            raise Exception(stderr)
+
+    return WarmPool(
+        ec2client,
+        task_args.warm_pool,
+        max_size=task_args.warm_pool_size,
+        idle_ttl=task_args.warm_pool_idle_ttl,
+        stop_on_release=task_args.warm_pool_stop,
+        reset_instance=reset_instance)
+
+
+def cleanup_task(task_args):
+    # tears down a task started by another master process. only the
+    # teardown is needed, not the logs and streams a Task sets up.
+    ssh_sessions = SSHSessionManager(
+        task_args.pem_path or default_pem_path(task_args),
+        keepalive_interval=task_args.ssh_keepalive_interval,
+        connect_retries=task_args.ssh_connect_retries)
     try:
-        ssh_key = paramiko.RSAKey.from_private_key_file(args.pem_path)
-        ssh_client = paramiko.SSHClient()
-        ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh_client.connect(hostname=host, username="ubuntu", pkey=ssh_key)
-        env_map = {
-            "PSERVER_HOSTS": pserver_endpoints_str,
-            "PSERVERS": pserver_endpoints_str,
-            "PSERVER_PORT": args.pserver_port,
-            "TASK_NAME": args.task_name,
-            "TRAINER_COUNT": args.trainer_count,
-            "TRAINERS": args.trainer_count,
-            "TRAINER_INDEX": 0,
-            "SERVER_ENDPOINT": host + ":" + str(args.pserver_port),
-            "MASTER_ENDPOINT": args.master_server_ip + ":" +str(args.master_server_port),
-            "PADDLE_TRAINING_ROLE": "PSERVER",
-            "TRAINING_ROLE": "PSERVER",
-            "PADDLE_PSERVER_PORT": args.pserver_port,
-            "PADDLE_PSERVER_IPS": pserver_ips_str,
-            "PADDLE_TRAINERS": args.trainer_count,
-            "PADDLE_CURRENT_IP": host,
-            "PADDLE_TRAINER_ID": 0,
-        }
-
-        cmd = (script_to_str(args.pserver_bash_file)).format(
-            ENV=generate_env(env_map),
-            COMMAND=parse_command(args.pserver_command, {"device": "CPU"}),
-            DOCKER_IMAGE=args.docker_image,
-        )
-
-        logging.info(cmd)
-        stdin, stdout, stderr = ssh_client.exec_command(command=cmd)
-
-        stdout_thread = threading.Thread(
-            target=log_to_file, args=(
-                stdout,
-                "pserver_" + host + ".log", ))
-        stderr_thread = threading.Thread(
-            target=log_to_file, args=(
-                stderr,
-                "pserver_" + host + "_err.log", ))
-        stdout_thread.start()
-        stderr_thread.start()
-
-        stdout_thread.join()
-        stderr_thread.join()
-
-        return_code = stdout.channel.recv_exit_status()
-        logging.info(return_code)
-        if return_code != 0:
-            raise Exception("Error while kicking off pserver training process")
-    except Exception:
-        logging.exception("Error while kicking off pserver training process")
-        cleanup(args.task_name)
+        teardown = get_teardown(ec2client, task_args.task_name)
+        teardown.start(create_warm_pool(task_args, ssh_sessions))
+        return teardown.wait()
     finally:
-        ssh_client.close()
-
-
-def init_args():
-
-    if not args.task_name:
-        args.task_name = generate_task_name()
-        logging.info("task name generated %s" % (args.task_name))
-
-    if not args.pem_path:
-        args.pem_path = os.path.expanduser("~") + "/" + args.key_name + ".pem"
-    if args.security_group_id:
-        args.security_group_ids = (args.security_group_id, )
-
-    args.trainers_job_done_count = 0
-
-
-def create_cluster():
-
-    if not args.subnet_id:
-        logging.info("creating subnet for this task")
-        args.subnet_id = create_subnet()
-        logging.info("subnet %s created" % (args.subnet_id))
-
-    logging.info("creating pservers")
-    pserver_create_response = create_pservers()
-    logging.info("pserver created, collecting pserver ips")
-
-    pserver_endpoints = []
-    pserver_ips = []
-    for pserver in pserver_create_response:
-        pserver_endpoints.append(pserver["PrivateIpAddress"] + ":" + args.pserver_port)
-        pserver_ips.append(pserver["PrivateIpAddress"])
-
-    pserver_endpoints_str = ",".join(pserver_endpoints)
-
-    logging.info("kicking off pserver training process")
-    pserver_threads = []
-    for pserver in pserver_create_response:
-        pserver_thread = threading.Thread(
-            target=kickoff_pserver,
-            args=(pserver["PrivateIpAddress"], pserver_endpoints_str, ",".join(pserver_ips), ))
-        pserver_thread.daemon = True
-        pserver_thread.start()
-        pserver_threads.append(pserver_thread)
-
-    logging.info("all pserver training process started")
-
-    logging.info("creating trainers and kicking off trainer training process")
-    create_trainers(
-        kickoff_cmd=script_to_str(args.trainer_bash_file),
-        pserver_endpoints_str=pserver_endpoints_str,
-        pserver_ips_str=",".join(pserver_ips)
-    )
-
-    # pserver does not stop when training is finished, we are going to leave it
-    # for pserver_thread in pserver_threads:
-    #    pserver_thread.join()
+        ssh_sessions.close()
+
+
+class Task(object):
+    # one training cluster with its own arguments, nodes, logs, metrics and
+    # teardown. several tasks can run in one master process, they only share
+    # the ec2 clients and the log multiplexer. logs go to logs/<task_name>/,
+    # master.log there holds what this task logged.
+    def __init__(self, task_args):
+        self.args = copy.copy(task_args)
+        if not self.args.task_name:
+            self.args.task_name = generate_task_name()
+            logging.info("task name generated %s" % (self.args.task_name))
+        self.name = self.args.task_name
+
+        if not self.args.pem_path:
+            self.args.pem_path = default_pem_path(self.args)
+        if self.args.security_group_id:
+            self.args.security_group_ids = (self.args.security_group_id, )
+
+        self.args.trainers_job_done_count = 0
+
+        self.log_path = os.path.join(args.log_path, self.name, "")
+        if not os.path.isdir(self.log_path):
+            os.makedirs(self.log_path)
+        self.log_files = ["master.log"]
+        self.log_tailer = LogTailer(self.args.log_tail_lines)
+        # log file -> [bytes, lines] read from the nodes, each file is only
+        # updated by the one thread reading it
+        self.ingested = {}
+
+        # node name -> {"role", "ip", "state", "since"}, the state goes
+        # ready -> running -> exited or failed
+        self.nodes = {}
+        self.nodes_lock = threading.Lock()
+
+        # availability zone -> subnet of this task there, see subnet_for_zone
+        self.zone_subnets = {}
+        self.zone_subnets_lock = threading.Lock()
+        # capacity errors move on to the next fallback option right away
+        # instead of being retried by the throttling wrapper first
+        self.trainer_capacity = CapacityStrategy.from_args(
+            ec2client,
+            self.args,
+            self.subnet_for_zone,
+            fail_fast=lambda: ec2_api.capacity_retries(0))
+        # trainer ip -> spot interruption notice it printed
+        self.interruptions = {}
+        # trainer index -> instance it currently runs on
+        self.trainer_instances = {}
+        self.trainer_supervisor = None
+        # set once the task is being torn down
+        self.closed = False
+        # set when cleanup left the nodes running, their streams stay open
+        # until the task is cleaned up explicitly
+        self.left_running = False
+        self.close_lock = threading.Lock()
+        self.files_closed = False
+
+        # records also go to the master wide log through the root logger
+        self.logger = logging.getLogger("task." + self.name)
+        self.log_handlers = [
+            logging.FileHandler(self.log_path + "master.log"),
+            RingLogHandler(self.log_tailer)
+        ]
+        for handler in self.log_handlers:
+            handler.setFormatter(
+                logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(handler)
+
+        self.metrics_store = MetricsStore(self.log_path +
+                                          metrics_csv_file_name)
+        # step time between metrics lines is always compared, the keys only
+        # if trainers report them
+        self.stragglers = StragglerDetector(
+            window=self.args.straggler_window,
+            counter_keys=[
+                k.strip() for k in self.args.progress_metric_keys.split(",")
+                if k.strip()
+            ],
+            rate_keys=[
+                k.strip() for k in self.args.throughput_metric_keys.split(",")
+                if k.strip()
+            ],
+            z_threshold=self.args.straggler_z_threshold,
+            median_ratio=self.args.straggler_median_ratio)
+        self.tracer = Tracer(self.name)
+
+        self.ssh_sessions = SSHSessionManager(
+            self.args.pem_path,
+            keepalive_interval=self.args.ssh_keepalive_interval,
+            connect_retries=self.args.ssh_connect_retries)
+
+        self.health = None
+        if self.args.health_probe_interval > 0:
+            self.health = HealthMonitor(
+                self.ssh_sessions,
+                self.node_states,
+                interval=self.args.health_probe_interval,
+                stall_timeout=self.args.stall_timeout,
+                straggler_ratio=self.args.straggler_gpu_ratio,
+                probe_workers=self.args.health_probe_workers,
+                on_stalled=self.on_stalled,
+                logger=self.logger)
+
+        self.warm_pool = create_warm_pool(self.args, self.ssh_sessions)
+
+        self.image_prepuller = None
+        if self.args.prepull_image:
+            self.image_prepuller = ImagePrepuller(
+                self.ssh_sessions,
+                registry_mirror=self.args.registry_mirror,
+                tracer=self.tracer)
+
+        self.log_writer = LogWriter(
+            self.log_path,
+            queue_size=self.args.log_queue_size,
+            flush_bytes=self.args.log_flush_bytes,
+            flush_interval=self.args.log_flush_interval,
+            fsync_interval=self.args.log_fsync_interval,
+            echo=self.args.echo_node_logs).start()
+
+    def run(self):
+        try:
+            self.create_cluster()
+        finally:
+            if not self.left_running:
+                self.close()
+
+    def close(self):
+        # the task is over: ends its log streams, writer thread and health
+        # probes, and closes its files. the teardown goes on without them.
+        with self.close_lock:
+            if self.files_closed:
+                return
+            self.files_closed = True
+        if self.health:
+            self.health.stop()
+        self.ssh_sessions.close()
+        self.log_writer.close()
+        self.metrics_store.close()
+        for handler in self.log_handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+    def set_node_state(self, node, role, state, ip=None):
+        with self.nodes_lock:
+            info = self.nodes.setdefault(node, {"role": role})
+            info["state"] = state
+            info["since"] = time.time()
+            if ip:
+                info["ip"] = ip
+
+    def node_states(self):
+        with self.nodes_lock:
+            return dict((node, dict(info))
+                        for node, info in self.nodes.iteritems())
+
+    def status(self):
+        status = scheduler.status(self.name) or {}
+        status.update({
+            "name": self.name,
+            "subnet_id": self.args.subnet_id,
+            "pserver_count": self.args.pserver_count,
+            "trainer_count": self.args.trainer_count,
+            "spot_interruptions": dict(self.interruptions),
+            "trainers": self.trainer_supervisor.status()
+            if self.trainer_supervisor else [],
+            "health": self.health.report() if self.health else {},
+            "stragglers": self.stragglers.report()["stragglers"],
+            "cleanup": teardown_status(self.name)
+        })
+        return status
+
+    def create_subnet(self, availability_zone=None):
+        zone = availability_zone or self.args.availability_zone
+        return self.create_subnets([zone])[zone]
+
+    def create_subnets(self, zones):
+        # one subnet per zone, all big enough for the whole cluster
+        args = self.args
+        self.logger.info("start creating subnet(s) in %s" % ",".join(zones))
+        if not args.vpc_id:
+            args.vpc_id = subnet_allocator.default_vpc()
+        subnet_ids = subnet_allocator.create_subnets(
+            args.vpc_id, zones, args.pserver_count + args.trainer_count,
+            args.task_name)
+        self.logger.info("subnet(s) %s created" %
+                         ",".join(subnet_ids[zone] for zone in zones))
+        return subnet_ids
+
+    def subnet_for_zone(self, zone):
+        # the task's subnet is in availability_zone, trainers falling back to
+        # another zone get one there the first time it is used
+        with self.zone_subnets_lock:
+            if zone not in self.zone_subnets:
+                if zone == self.args.availability_zone:
+                    self.zone_subnets[zone] = self.args.subnet_id
+                else:
+                    self.logger.info("creating subnet in %s" % zone)
+                    with self.tracer.span("create_subnet", node="master",
+                                          zone=zone):
+                        self.zone_subnets[zone] = self.create_subnet(zone)
+            return self.zone_subnets[zone]
+
+    def launch_instances(self,
+                         image_id,
+                         instance_type,
+                         count,
+                         role,
+                         cmd="",
+                         min_count=None):
+        args = self.args
+        if count == 0:
+            return []
+        if min_count is None:
+            min_count = count
+        claimed = []
+        if self.warm_pool is not None:
+            with self.tracer.span("warm_pool_claim", role=role) as span:
+                claimed = self.warm_pool.claim(
+                    args.task_name,
+                    role,
+                    image_id,
+                    instance_type,
+                    count,
+                    vpc_id=args.vpc_id,
+                    key_name=args.key_name,
+                    security_group_id=args.security_group_id,
+                    availability_zone=args.availability_zone)
+                span["claimed"] = len(claimed)
+            if len(claimed) == count:
+                return claimed
+        launch_spec = dict(
+            ImageId=image_id,
+            UserData=cmd,
+            DryRun=False,
+            InstanceInitiatedShutdownBehavior="stop",
+            KeyName=args.key_name,
+            NetworkInterfaces=[{
+                'DeviceIndex': 0,
+                'SubnetId': args.subnet_id,
+                "AssociatePublicIpAddress": True,
+                'Groups': args.security_group_ids
+            }],
+            TagSpecifications=[{
+                'ResourceType': "instance",
+                'Tags': [{
+                    "Key": 'Task_name',
+                    "Value": args.task_name
+                }, {
+                    "Key": 'Role',
+                    "Value": role
+                }]
+            }, {
+                # teardown deletes the ones left unattached in its subnets
+                'ResourceType': "network-interface",
+                'Tags': [{
+                    "Key": 'Task_name',
+                    "Value": args.task_name
+                }]
+            }])
+        with self.tracer.span(
+                "run_instances", role=role, count=count - len(claimed)):
+            if role == "TRAINER":
+                # may fall back to other instance types, zones and markets
+                instances = self.trainer_capacity.launch(
+                    launch_spec, count - len(claimed),
+                    max(1, min_count - len(claimed)))
+            else:
+                instances = ec2client.run_instances(
+                    InstanceType=instance_type,
+                    MaxCount=count - len(claimed),
+                    MinCount=max(1, min_count - len(claimed)),
+                    Placement={'AvailabilityZone': args.availability_zone},
+                    **launch_spec)["Instances"]
+
+        if len(instances) > 0:
+            self.logger.info(str(len(instances)) + " instance(s) created")
+        else:
+            self.logger.info("no instance created")
+        return claimed + instances
+
+    def wait_for_instances(self, instance_ids):
+        if not instance_ids:
+            return []
+        #create waiter to make sure it's running
+
+        self.logger.info("waiting for instance to become accessible")
+        waiter = ec2client.get_waiter('instance_status_ok')
+        with self.tracer.span(
+                "instance_status_ok_waiter", count=len(instance_ids)):
+            waiter.wait(
+                Filters=[{
+                    "Name": "instance-status.status",
+                    "Values": ["ok"]
+                }, {
+                    "Name": "instance-status.reachability",
+                    "Values": ["passed"]
+                # }, {
+                  #  "Name": "instance-state-name",
+                   # "Values": ["running"]
+                }],
+                InstanceIds=instance_ids)
+
+        instances_response = ec2client.describe_instances(
+            InstanceIds=instance_ids)
+
+        # instances launched by different run_instances calls come back in
+        # different reservations, keep the order they were asked for
+        instances_by_id = {}
+        for reservation in instances_response["Reservations"]:
+            for instance in reservation["Instances"]:
+                instances_by_id[instance["InstanceId"]] = instance
+        return [
+            instances_by_id[i] for i in instance_ids if i in instances_by_id
+        ]
+
+    def ready_instances(self, instance_ids):
+        # iterable of instances, streamed as each one becomes accessible
+        if self.args.stream_instance_readiness:
+            return iter_ready_instances(ec2client, instance_ids)
+        return self.wait_for_instances(instance_ids)
+
+    def run_instances(self, image_id, instance_type, count, role, cmd=""):
+        if count == 0:
+            return []
+        instances = self.launch_instances(image_id, instance_type, count,
+                                          role, cmd)
+        with self.tracer.span("wait_ready", count=count):
+            return list(
+                self.ready_instances([i["InstanceId"] for i in instances]))
+
+    def create_pservers(self):
+        # only launches pservers, create_cluster kicks each one off once ready
+        try:
+            return self.launch_instances(
+                image_id=self.args.pserver_image_id,
+                instance_type=self.args.pserver_instance_type,
+                count=self.args.pserver_count,
+                role="PSERVER", )
+        except Exception:
+            self.logger.exception("error while trying to create pservers")
+            self.cleanup()
 
-    logging.info("all process ended")
+    def save_metrics_data(self, str_msg, node):
+        #parse msg
+        metric_values = []
+        for metric in str_msg.split(","):
+            metric_data = metric.split("=")
+            try:
+                metric_values.append((metric_data[0].strip(),
+                                      float(metric_data[1].strip())))
+            except (IndexError, ValueError):
+                self.logger.info("skipping malformed metrics data from %s: %s"
+                                 % (node, metric))
+        if metric_values:
+            now = time.time()
+            self.metrics_store.append(node, metric_values, now)
+            if node.startswith("trainer_"):
+                self.stragglers.observe(node, metric_values, now)
+
+    def handle_log_line(self, filename, line):
+        ingested = self.ingested.get(filename)
+        if ingested is None:
+            ingested = self.ingested[filename] = [0, 0]
+        ingested[0] += len(line)
+        ingested[1] += 1
+        self.log_writer.write(filename, line)
+        self.log_tailer.append(filename, line)
+        node = node_name(filename)
+        self.tracer.once("first_output", node)
+        if self.health:
+            self.health.saw_output(node)
+        if (line.startswith(self.args.metric_data_identifier)):
+            #found key data, trying to add to csv
+            line = line.replace(self.args.metric_data_identifier, "")
+            self.save_metrics_data(line, node)
+            self.tracer.once("first_metric", node)
+
+    def log_to_file(self, source, filename):
+        if not filename in self.log_files:
+            self.log_files.append(filename)
+        for line in iter(source.readline, ""):
+            self.handle_log_line(filename, line)
+
+    def follow_node_output(self, stdout, stderr, log_name, on_exit=None):
+        # saves stdout and stderr of a remote command to <log_name>.log and
+        # <log_name>_err.log, returns a ChannelHandle whose wait() gives the
+        # exit status once both streams are drained
+        stdout_file = log_name + ".log"
+        stderr_file = log_name + "_err.log"
+        for filename in (stdout_file, stderr_file):
+            if not filename in self.log_files:
+                self.log_files.append(filename)
+
+        if self.args.multiplex_node_logs:
+            return log_mux.add(stdout.channel, stdout_file, stderr_file,
+                               on_exit, self.handle_log_line)
+
+        handle = ChannelHandle(on_exit)
+
+        def follow():
+            stdout_thread = threading.Thread(
+                target=self.log_to_file, args=(stdout, stdout_file, ))
+            stderr_thread = threading.Thread(
+                target=self.log_to_file, args=(stderr, stderr_file, ))
+            stdout_thread.start()
+            stderr_thread.start()
+
+            stdout_thread.join()
+            stderr_thread.join()
+            handle.finish(stdout.channel.recv_exit_status())
+
+        follow_thread = threading.Thread(target=follow)
+        follow_thread.daemon = True
+        follow_thread.start()
+        return handle
+
+    def create_trainers(self, kickoff_cmd, pserver_hosts):
+        # pserver_hosts is a Deferred of (pserver_endpoints_str, pserver_ips_str)
+        args = self.args
+
+        def start_trainer(trainer_index, relaunch, on_exit):
+            self.logger.info("trainer " + str(trainer_index) + " is starting")
+            if relaunch:
+                # the old node may be what made it fail
+                self.stop_trainer(trainer_index)
+
+            if (trainer_provisioner and not relaunch and
+                    trainer_index < trainer_provisioner.count and
+                    trainer_index not in provisioned):
+                provisioned.add(trainer_index)
+                with self.tracer.span("wait_for_instance"):
+                    instance_response = trainer_provisioner.get(trainer_index)
+            else:
+                instance_response = self.run_instances(
+                    image_id=args.trainer_image_id,
+                    instance_type=args.trainer_instance_type,
+                    count=1,
+                    role="TRAINER", )[0]
+            self.trainer_instances[trainer_index] = instance_response
+            trainer_ip = instance_response["PrivateIpAddress"]
+            self.tracer.instant("instance_ready", ip=trainer_ip)
+            self.set_node_state("trainer_" + str(trainer_index), "TRAINER",
+                                "ready", trainer_ip)
+
+            self.logger.info("trainer " + str(trainer_index) + " started")
+
+            with self.tracer.span("ssh_connect"):
+                ssh_client = self.ssh_sessions.connect(trainer_ip)
+
+            self.logger.info("trainer " + str(trainer_index) +
+                             " terminal connected via ssh")
+            if instance_response.get("InstanceLifecycle") == "spot":
+                self.watch_interruption(trainer_ip,
+                                        "trainer_" + str(trainer_index))
+            self.prepull_image(trainer_ip, "trainer_" + str(trainer_index))
+
+            # in pipelined mode pservers may still be launching
+            with self.tracer.span("wait_for_pserver_ips"):
+                pserver_endpoints_str, pserver_ips_str = pserver_hosts.get()
+
+            env_map = {
+                "PSERVER_HOSTS": pserver_endpoints_str,
+                "PSERVERS": pserver_endpoints_str,
+                "TRAINER_INDEX": str(trainer_index),
+                "TASK_NAME": args.task_name,
+                "TRAINER_COUNT": args.trainer_count,
+                "TRAINERS": args.trainer_count,
+                "MASTER_ENDPOINT": args.master_server_ip + ":" + str(args.master_server_port),
+                "PADDLE_TRAINING_ROLE": "TRAINER",
+                "TRAINING_ROLE":"TRAINER",
+                "PADDLE_PSERVER_IPS": pserver_ips_str,
+                "PADDLE_PSERVER_PORT": args.pserver_port,
+                "PADDLE_TRAINERS": args.trainer_count,
+                "PADDLE_CURRENT_IP": trainer_ip,
+                "PADDLE_TRAINER_ID": str(trainer_index),
+                "PADDLE_INIT_TRAINER_ID": str(trainer_index),
+            }
+
+            cmd = kickoff_cmd.format(
+                COMMAND=parse_command(args.trainer_command, {"device": "GPU"}),
+                ENV=generate_env(env_map),
+                DOCKER_IMAGE=args.docker_image,
+            )
+            self.logger.info(cmd)
+
+            self.wait_for_image(trainer_ip)
+            if self.closed:
+                raise Exception("task is being torn down, not kicking off "
+                                "trainer %d" % trainer_index)
+            with self.tracer.span("exec_command"):
+                stdin, stdout, stderr = ssh_client.exec_command(command=cmd)
+
+            # read and save output log
+
+            self.logger.info("trainer " + str(trainer_index) +
+                             " command executed, keep fetching log")
+            self.set_node_state("trainer_" + str(trainer_index), "TRAINER",
+                                "running")
+
+            def on_trainer_exit(return_code):
+                self.ssh_sessions.close(trainer_ip)
+                interrupted = (return_code != 0 and
+                               self.was_interrupted(instance_response))
+                self.set_node_state("trainer_" + str(trainer_index),
+                                    "TRAINER", "exited" if return_code == 0
+                                    else "interrupted"
+                                    if interrupted else "failed")
+                if return_code != 0:
+                    self.logger.error("trainer " + str(trainer_index) +
+                                      " didn't finish with exit code 0")
+                on_exit(return_code, interrupted)
+
+            # the thread ends here, output is followed by the log multiplexer
+            self.follow_node_output(stdout, stderr,
+                                    "trainer_" + str(trainer_index),
+                                    on_trainer_exit)
+
+        # multi thread starting trainer instance and run kickoff command
+
+        trainer_provisioner = None
+        # indexes that already took their instance from the provisioner
+        provisioned = set()
+        try:
+            if args.batch_trainer_provisioning:
+                self.logger.info("launching %d trainers in batched mode" %
+                                 args.trainer_count)
+                trainer_provisioner = BatchProvisioner(
+                    launch=lambda count, min_count: self.launch_instances(
+                        image_id=args.trainer_image_id,
+                        instance_type=args.trainer_instance_type,
+                        count=count,
+                        role="TRAINER",
+                        min_count=min_count),
+                    wait=self.ready_instances,
+                    count=args.trainer_count,
+                    chunk_size=args.trainer_launch_chunk_size,
+                    max_retries=args.trainer_launch_retries).start()
+
+            # relaunches dead trainers under the same index and env
+            self.trainer_supervisor = TrainerSupervisor(
+                start_trainer,
+                self.stop_trainer,
+                args.trainer_count,
+                max_relaunches=args.trainer_relaunches,
+                max_replacements=args.spot_replacements,
+                logger=self.logger)
+            # torn down before trainers got going, e.g. pservers failed
+            if self.closed:
+                self.trainer_supervisor.stop()
+            self.trainer_supervisor.start().wait()
+
+            failed = self.trainer_supervisor.failed()
+            if failed:
+                self.logger.error(
+                    "trainer(s) %s failed for good, destroying the whole "
+                    "cluster" % ",".join(str(i) for i in failed))
+                self.cleanup()
+
+            self.logger.info("all trainers stopped")
+        except Exception, e:
+            self.logger.exception(
+                "Training exception, clean up resources, please check log for more info"
+            )
+        finally:
+            self.cleanup()
+
+    def stop_trainer(self, trainer_index):
+        # ends a trainer's command by terminating its instance
+        instance = self.trainer_instances.pop(trainer_index, None)
+        if instance is None:
+            return
+        self.ssh_sessions.close(instance["PrivateIpAddress"])
+        self.logger.info("terminating instance %s of trainer %d" %
+                         (instance["InstanceId"], trainer_index))
+        ec2client.terminate_instances(InstanceIds=[instance["InstanceId"]])
+
+    def scale_trainers(self, count):
+        # trainers started from now on are told the new count, running ones
+        # keep theirs, so this suits training that copes with trainers
+        # joining and leaving
+        if self.trainer_supervisor is None:
+            raise ValueError("trainers of %s are not running" % self.name)
+        if count < 1:
+            raise ValueError("trainer count must be at least 1")
+        self.args.trainer_count = count
+        added, removed = self.trainer_supervisor.scale(count)
+        self.logger.info("scaled trainers to %d, added %s, removed %s" %
+                         (count, added, removed))
+        return {"trainer_count": count, "added": added, "removed": removed}
+
+    def log_straggler_report(self):
+        report = self.stragglers.report()
+        for node, stats in sorted(report["nodes"].iteritems()):
+            self.logger.info("%s%s: %s" % (
+                node, " (straggler)" if stats["straggler"] else "", ", ".join(
+                    "%s %.4g z=%s" % (stat, entry["mean"], "%.2f" % entry["z"]
+                                      if "z" in entry else "-")
+                    for stat, entry in sorted(stats.iteritems())
+                    if stat != "straggler")))
+        self.logger.info("throughput stragglers over the last %ds: %s" %
+                         (report["window"], report["stragglers"]))
+
+    def on_stalled(self, node):
+        action = self.args.stalled_trainer_action
+        if action == "relaunch":
+            # the supervisor relaunches it once its command ends
+            self.stop_trainer(int(node[len("trainer_"):]))
+        elif action == "cleanup":
+            self.logger.error("%s stalled, destroying the whole cluster" %
+                              node)
+            self.cleanup()
+
+    def cleanup(self, wait=False):
+        # starts tearing down the task in the background, at most one
+        # teardown per task runs at a time however many threads call this
+        self.closed = True
+        if self.trainer_supervisor:
+            # trainers killed by the teardown are not to be relaunched
+            self.trainer_supervisor.stop()
+        if self.health:
+            self.health.stop()
+        if self.args.online_mode:
+            self.logger.info(
+                "online_mode:true, going to let client handle cleanup")
+            self.left_running = True
+            return
+        if self.args.no_clean_up:
+            self.logger.info(
+                "no clean up option set, going to leave the setup running")
+            self.left_running = True
+            return
+        self.left_running = False
+        teardown = get_teardown(ec2client, self.name)
+        if not teardown.start(self.warm_pool):
+            self.logger.info("cleanup of %s already in progress" % self.name)
+        # the nodes are going away, so are their streams
+        self.close()
+        if wait:
+            teardown.wait()
+        return teardown
+
+    def kickoff_pserver(self, host, pserver_endpoints_str, pserver_ips_str):
+        args = self.args
+        try:
+            with self.tracer.span("ssh_connect"):
+                ssh_client = self.ssh_sessions.connect(host)
+            self.prepull_image(host, "pserver_" + host)
+            env_map = {
+                "PSERVER_HOSTS": pserver_endpoints_str,
+                "PSERVERS": pserver_endpoints_str,
+                "PSERVER_PORT": args.pserver_port,
+                "TASK_NAME": args.task_name,
+                "TRAINER_COUNT": args.trainer_count,
+                "TRAINERS": args.trainer_count,
+                "TRAINER_INDEX": 0,
+                "SERVER_ENDPOINT": host + ":" + str(args.pserver_port),
+                "MASTER_ENDPOINT": args.master_server_ip + ":" +str(args.master_server_port),
+                "PADDLE_TRAINING_ROLE": "PSERVER",
+                "TRAINING_ROLE": "PSERVER",
+                "PADDLE_PSERVER_PORT": args.pserver_port,
+                "PADDLE_PSERVER_IPS": pserver_ips_str,
+                "PADDLE_TRAINERS": args.trainer_count,
+                "PADDLE_CURRENT_IP": host,
+                "PADDLE_TRAINER_ID": 0,
+            }
+
+            cmd = (script_to_str(args.pserver_bash_file)).format(
+                ENV=generate_env(env_map),
+                COMMAND=parse_command(args.pserver_command, {"device": "CPU"}),
+                DOCKER_IMAGE=args.docker_image,
+            )
+
+            self.logger.info(cmd)
+            self.wait_for_image(host)
+            with self.tracer.span("exec_command"):
+                stdin, stdout, stderr = ssh_client.exec_command(command=cmd)
+            self.set_node_state("pserver_" + host, "PSERVER", "running")
+
+            def on_pserver_exit(return_code):
+                self.ssh_sessions.close(host)
+                self.set_node_state("pserver_" + host, "PSERVER", "exited"
+                                    if return_code == 0 else "failed")
+                self.logger.info(return_code)
+                if return_code != 0:
+                    self.logger.error(
+                        "Error while kicking off pserver training process")
+                    self.cleanup()
+
+            self.follow_node_output(stdout, stderr, "pserver_" + host,
+                                    on_pserver_exit)
+        except Exception:
+            self.logger.exception(
+                "Error while kicking off pserver training process")
+            self.set_node_state("pserver_" + host, "PSERVER", "failed")
+            self.ssh_sessions.close(host)
+            self.cleanup()
+
+    def watch_interruption(self, host, node):
+        # spot nodes poll their instance metadata for an interruption notice
+        # and print it, it comes back over the pooled ssh connection. the
+        # watch ends with the connection once the node is done. its output
+        # is not a node's log, only the notice is looked for.
+        try:
+            ssh_client = self.ssh_sessions.connect(host)
+            stdin, stdout, stderr = ssh_client.exec_command(
+                command=INTERRUPTION_WATCH_CMD %
+                self.args.spot_interruption_poll_interval)
+        except Exception:
+            self.logger.exception("could not watch %s for spot interruptions"
+                                  % node)
+            return
+        def on_line(filename, line):
+            notice = parse_interruption_notice(line)
+            if notice is not None:
+                self.interruptions[host] = notice
+                self.tracer.instant("spot_interruption", node=node, **notice)
+                self.logger.info("%s (%s) got a spot interruption notice: %s"
+                                 % (node, host, notice))
+
+        log_mux.add(stdout.channel, node + "_spot.log",
+                    node + "_spot_err.log", line_handler=on_line)
+
+    def was_interrupted(self, instance):
+        if instance.get("InstanceLifecycle") != "spot":
+            return False
+        return (instance["PrivateIpAddress"] in self.interruptions or
+                is_spot_interruption(ec2client, instance["InstanceId"]))
+
+    def prepull_image(self, host, node):
+        if self.image_prepuller is not None:
+            self.image_prepuller.start(host, node, self.args.docker_image)
+
+    def wait_for_image(self, host):
+        if self.image_prepuller is None:
+            return
+        with self.tracer.span("wait_for_image"):
+            pulled = self.image_prepuller.wait(host)
+        if not pulled:
+            self.logger.info("image not pre-pulled on %s, kickoff will pull it"
+                             % host)
+
+    def create_cluster(self):
+        args = self.args
+
+        if not args.subnet_id:
+            self.logger.info("creating subnet for this task")
+            zones = [args.availability_zone]
+            if args.use_ec2_fleet:
+                # the fleet request spans all zones, their subnets are made
+                # up front as one set
+                zones = self.trainer_capacity.zones
+            with self.tracer.span("create_subnet", node="master"):
+                subnet_ids = self.create_subnets(zones)
+            args.subnet_id = subnet_ids[args.availability_zone]
+            with self.zone_subnets_lock:
+                self.zone_subnets.update(subnet_ids)
+            self.logger.info("subnet %s created" % (args.subnet_id))
+
+        if self.health:
+            self.health.start()
+
+        pserver_hosts = Deferred()
+        if args.pipelined_bring_up:
+            # trainer boot does not depend on pservers, only their kickoff
+            # command does, so start both fleets right away
+            self.logger.info(
+                "pipelined mode, creating trainers alongside pservers")
+            trainers_thread = threading.Thread(
+                target=self.create_trainers,
+                args=(script_to_str(args.trainer_bash_file), pserver_hosts, ))
+            trainers_thread.start()
+
+        self.logger.info("creating pservers")
+        pserver_create_response = self.create_pservers()
+        if pserver_create_response is None:
+            pserver_hosts.fail("pservers could not be created")
+            if args.pipelined_bring_up:
+                trainers_thread.join()
+            return
+        self.logger.info("pserver launched, collecting pserver ips")
+
+        # private ips are assigned at launch, no need to wait for status ok
+        pserver_endpoints = []
+        pserver_ips = []
+        for pserver in pserver_create_response:
+            pserver_endpoints.append(pserver["PrivateIpAddress"] + ":" + args.pserver_port)
+            pserver_ips.append(pserver["PrivateIpAddress"])
+
+        pserver_endpoints_str = ",".join(pserver_endpoints)
+        pserver_hosts.set((pserver_endpoints_str, ",".join(pserver_ips)))
+
+        self.logger.info(
+            "kicking off pserver training process as pservers become ready")
+        pserver_threads = []
+        try:
+            for pserver in self.ready_instances(
+                [p["InstanceId"] for p in pserver_create_response]):
+                self.tracer.instant(
+                    "instance_ready",
+                    node="pserver_" + pserver["PrivateIpAddress"])
+                self.set_node_state("pserver_" + pserver["PrivateIpAddress"],
+                                    "PSERVER", "ready",
+                                    pserver["PrivateIpAddress"])
+                pserver_thread = threading.Thread(
+                    target=self.kickoff_pserver,
+                    args=(pserver["PrivateIpAddress"], pserver_endpoints_str, ",".join(pserver_ips), ),
+                    name="pserver_" + pserver["PrivateIpAddress"])
+                pserver_thread.daemon = True
+                pserver_thread.start()
+                pserver_threads.append(pserver_thread)
+        except Exception:
+            self.logger.exception(
+                "error while waiting for pservers to become ready")
+            # trainers that did not get the endpoints yet fail instead
+            pserver_hosts.fail("pservers did not become ready")
+            self.cleanup()
+            if args.pipelined_bring_up:
+                trainers_thread.join()
+            return
+
+        self.logger.info("all pserver training process started")
+
+        if args.pipelined_bring_up:
+            trainers_thread.join()
+        else:
+            self.logger.info(
+                "creating trainers and kicking off trainer training process")
+            self.create_trainers(
+                kickoff_cmd=script_to_str(args.trainer_bash_file),
+                pserver_hosts=pserver_hosts)
+
+        # pserver does not stop when training is finished, we are going to
+        # leave it
+        # for pserver_thread in pserver_threads:
+        #    pserver_thread.join()
+
+        self.log_writer.flush()
+        self.metrics_store.flush()
+        self.logger.info("log writer stats: %s" % self.log_writer.stats())
+        self.logger.info("ec2 describe cache stats: %s" % ec2client.stats())
+        if self.image_prepuller:
+            self.logger.info("image pull times: %s" %
+                             self.image_prepuller.report())
+        self.logger.info("ec2 api throttling stats: %s" % ec2_api.stats())
+        self.tracer.save(self.log_path + "timeline.json")
+        self.logger.info("bring-up phases: %s" % self.tracer.summary())
+        if self.health:
+            health = self.health.report()
+            self.logger.info("unreachable: %s, stalled: %s, stragglers: %s" %
+                             (health["unreachable"], health["stalled"],
+                              health["stragglers"]))
+        self.log_straggler_report()
+        self.logger.info("all process ended")
+
+
+def all_tasks():
+    tasks = [scheduler.get(t["name"]) for t in scheduler.list()]
+    if default_task is not None and default_task not in tasks:
+        tasks.append(default_task)
+    return tasks
+
+
+def prometheus_metrics():
+    # master internals and the latest training metrics of every task in the
+    # prometheus text format
+    prefix = "paddle_aws_"
+    tasks = MetricFamily(prefix + "tasks", "gauge", "tasks by state")
+    task_states = {}
+    for task_status in scheduler.list():
+        task_states[task_status["state"]] = task_states.get(
+            task_status["state"], 0) + 1
+    for state, count in task_states.iteritems():
+        tasks.add(count, state=state)
+
+    nodes = MetricFamily(prefix + "nodes", "gauge",
+                         "nodes of a task by role and state")
+    ssh_connections = MetricFamily(
+        prefix + "ssh_connections", "gauge",
+        "pooled ssh connections to nodes by state")
+    ssh_reconnects = MetricFamily(prefix + "ssh_reconnects_total", "counter",
+                                  "ssh connections re-established")
+    ingested_bytes = MetricFamily(prefix + "log_ingested_bytes_total",
+                                  "counter", "bytes read from node streams")
+    ingested_lines = MetricFamily(prefix + "log_ingested_lines_total",
+                                  "counter", "lines read from node streams")
+    queue_depth = MetricFamily(prefix + "log_writer_queue_depth", "gauge",
+                               "lines waiting to be written to log files")
+    queue_full_waits = MetricFamily(
+        prefix + "log_writer_queue_full_waits_total", "counter",
+        "log lines that had to wait for room in the writer queue")
+    training_metric = MetricFamily(
+        prefix + "training_metric", "gauge",
+        "latest value of each metrics_data key reported by a node")
+    training_metric_time = MetricFamily(
+        prefix + "training_metric_timestamp_seconds", "gauge",
+        "when the latest value of each metrics_data key was reported")
+    throughput = MetricFamily(
+        prefix + "trainer_throughput", "gauge",
+        "rolling mean of each throughput stat of a trainer")
+    throughput_z = MetricFamily(
+        prefix + "trainer_throughput_zscore", "gauge",
+        "z-score of each throughput stat of a trainer against all trainers")
+    for task in all_tasks():
+        node_counts = {}
+        for info in task.node_states().values():
+            key = (info["role"], info["state"])
+            node_counts[key] = node_counts.get(key, 0) + 1
+        for (role, state), count in node_counts.iteritems():
+            nodes.add(count, task=task.name, role=role, state=state)
+        ssh_stats = task.ssh_sessions.stats()
+        ssh_connections.add(
+            ssh_stats["connections"], task=task.name, state="active")
+        ssh_connections.add(
+            ssh_stats["dropped_connections"], task=task.name, state="dropped")
+        ssh_reconnects.add(ssh_stats["reconnects"], task=task.name)
+        for stream, (byte_count, line_count) in task.ingested.items():
+            ingested_bytes.add(byte_count, task=task.name, stream=stream)
+            ingested_lines.add(line_count, task=task.name, stream=stream)
+        writer_stats = task.log_writer.stats()
+        queue_depth.add(writer_stats["queue_depth"], task=task.name)
+        queue_full_waits.add(writer_stats["queue_full_waits"], task=task.name)
+        for (node, key), (timestamp, value) in \
+                task.metrics_store.latest_values().iteritems():
+            training_metric.add(value, task=task.name, node=node, key=key)
+            training_metric_time.add(
+                timestamp, task=task.name, node=node, key=key)
+        for node, stats in task.stragglers.report()["nodes"].iteritems():
+            for stat, entry in stats.iteritems():
+                if stat == "straggler":
+                    continue
+                throughput.add(
+                    entry["mean"], task=task.name, node=node, stat=stat)
+                if "z" in entry:
+                    throughput_z.add(
+                        entry["z"], task=task.name, node=node, stat=stat)
+
+    channels = MetricFamily(prefix + "log_channels", "gauge",
+                            "node command channels being followed")
+    channels.add(log_mux.channel_count())
+
+    api_stats = ec2_api.stats()
+    api_calls = MetricFamily(prefix + "ec2_api_calls_total", "counter",
+                             "ec2 api calls by operation")
+    api_retries = MetricFamily(prefix + "ec2_api_retries_total", "counter",
+                               "ec2 api calls retried after an error")
+    api_throttled = MetricFamily(
+        prefix + "ec2_api_throttle_errors_total", "counter",
+        "ec2 api calls rejected for exceeding the request limit")
+    api_server_errors = MetricFamily(
+        prefix + "ec2_api_server_errors_total", "counter",
+        "ec2 api calls that failed on the api's side")
+    api_failed = MetricFamily(prefix + "ec2_api_failed_calls_total",
+                              "counter", "ec2 api calls that gave up")
+    for operation, counts in api_stats["operations"].iteritems():
+        api_calls.add(counts.get("calls", 0), operation=operation)
+        api_retries.add(counts.get("retries", 0), operation=operation)
+        api_throttled.add(
+            counts.get("throttle_errors", 0), operation=operation)
+        api_server_errors.add(
+            counts.get("server_errors", 0), operation=operation)
+        api_failed.add(counts.get("failed_calls", 0), operation=operation)
+    api_latency = MetricFamily(prefix + "ec2_api_call_duration_seconds",
+                               "histogram",
+                               "latency of single ec2 api attempts")
+    for operation, (counts, total) in \
+            ec2_api.latency_histograms().iteritems():
+        api_latency.add_histogram(
+            LATENCY_BUCKETS, counts, total, operation=operation)
+    api_rate = MetricFamily(prefix + "ec2_api_rate", "gauge",
+                            "current ec2 api calls per second allowed")
+    api_rate.add(api_stats["current_rate"])
+
+    cache_stats = ec2client.stats()
+    cache_lookups = MetricFamily(prefix + "ec2_cache_lookups_total",
+                                 "counter", "ec2 describe lookups by result")
+    for result in ("hits", "misses", "coalesced"):
+        cache_lookups.add(cache_stats[result], result=result)
+
+    return render([
+        tasks, nodes, ssh_connections, ssh_reconnects, channels,
+        ingested_bytes, ingested_lines, queue_depth, queue_full_waits,
+        api_calls, api_retries, api_throttled, api_server_errors, api_failed,
+        api_latency,
+        api_rate, cache_lookups, training_metric, training_metric_time,
+        throughput, throughput_z
+    ])
+
+
+def task_args_from_json(overrides):
+    # arguments for a task submitted over http: the master's own arguments
+    # with the given flags parsed on top, so they are converted and
+    # validated the same way as on the command line
+    task_args = copy.copy(args)
+    task_args.task_name = ""
+    task_args.subnet_id = ""
+    argv = []
+    for key, value in sorted(overrides.iteritems()):
+        argv.extend(["--" + key, str(value)])
+    try:
+        return parser.parse_args(argv, namespace=task_args)
+    except SystemExit:
+        # argparse has already printed what was wrong
+        raise ValueError("invalid task arguments %s" % " ".join(argv))
 
 
 def start_server(args):
@@ -669,7 +1586,160 @@ def start_server(args):
             self.end_headers()
 
         def do_HEAD(self):
-            self._set_headers()
+            parsed_path = urlparse.urlparse(self.path)
+            if parsed_path.path in ("/status", "/master_logs") or \
+                    "/log/" in parsed_path.path:
+                self.do_GET()
+            else:
+                self._set_headers()
+
+        def _resolve(self, path):
+            # /tasks/<name>/<route> -> (task, /<route>), other paths are
+            # served for the task given on the command line
+            if path.startswith("/tasks/"):
+                name, _, route = path[len("/tasks/"):].partition("/")
+                return scheduler.get(name), "/" + route
+            return default_task, path
+
+        def _send_log(self, log_path, log_file_name, query_string):
+            # supports Range headers and ?offset= for incremental reads
+            params = dict(urlparse.parse_qsl(query_string))
+            try:
+                offset = int(params.get("offset", 0))
+            except ValueError:
+                offset = 0
+            send_file(self,
+                      log_path + os.path.basename(log_file_name),
+                      offset=max(0, offset))
+
+        def _send_json(self, data, code=200):
+            body = json.dumps(data, separators=(",", ":"))
+            self.send_response(code)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_tail(self, tailer, log_file_name, query_string):
+            # /tail/<log>?cursor=N&timeout=S long-polls for lines after the
+            # cursor, with ?stream=1 or Accept: text/event-stream the
+            # response stays open and pushes lines as server-sent events
+            params = dict(urlparse.parse_qsl(query_string))
+            ring = tailer.ring(os.path.basename(log_file_name))
+            if ring is None:
+                self.do_404()
+                return
+            try:
+                cursor = params.get("cursor",
+                                    self.headers.get("Last-Event-ID"))
+                cursor = int(cursor) if cursor is not None else None
+                timeout = min(float(params.get("timeout", 30)), 300)
+            except ValueError as e:
+                self._send_json({"error": str(e)}, code=400)
+                return
+            if params.get("stream") or "text/event-stream" in self.headers.get(
+                    "Accept", ""):
+                self._stream_tail(ring, cursor)
+                return
+            lines, cursor, dropped = ring.read(cursor, timeout)
+            self._send_json({
+                "cursor": cursor,
+                "dropped": dropped,
+                "lines": lines
+            })
+
+        def _stream_tail(self, ring, cursor):
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            try:
+                while True:
+                    lines, cursor, dropped = ring.read(cursor, timeout=15)
+                    if dropped:
+                        self.wfile.write("event: dropped\ndata: %d\n\n" %
+                                         dropped)
+                    if not lines:
+                        # lets us notice clients that went away
+                        self.wfile.write(": keepalive\n\n")
+                    first_seq = cursor - len(lines)
+                    for i, line in enumerate(lines):
+                        self.wfile.write("id: %d\ndata: %s\n\n" %
+                                         (first_seq + i + 1, line.rstrip("\n")))
+                    self.wfile.flush()
+            except socket.error:
+                logging.info("tail watcher disconnected")
+
+        def do_metrics(self, task, query_string):
+            # /metrics?key=...&since=...&node=...&agg=mean|p50|p99&window=...
+            params = dict(urlparse.parse_qsl(query_string))
+            if "key" not in params:
+                self._send_json(task.metrics_store.describe())
+                return
+            try:
+                since = params.get("since")
+                window = params.get("window")
+                result = task.metrics_store.query(
+                    params["key"],
+                    since=float(since) if since else None,
+                    node=params.get("node"),
+                    agg=params.get("agg"),
+                    window=float(window) if window else None)
+            except (QueryError, ValueError) as e:
+                self._send_json({"error": str(e)}, code=400)
+                return
+            self._send_json(result)
+
+        def do_submit(self):
+            # POST /tasks with a json object of flags, e.g.
+            # {"trainer_count": 4, "trainer_command": "..."}
+            try:
+                content_length = int(self.headers['Content-Length'])
+                overrides = json.loads(self.rfile.read(content_length) or
+                                       "{}")
+                task_args = task_args_from_json(overrides)
+                if not task_args.key_name or not task_args.security_group_id:
+                    raise ValueError(
+                        "key_name and security_group_id are required")
+                if not task_args.task_name:
+                    task_args.task_name = generate_task_name()
+                # the name is held while the task is built, a task that
+                # does not make it into the scheduler is closed again
+                scheduler.reserve(task_args.task_name)
+                task = None
+                try:
+                    task = Task(task_args)
+                    scheduler.submit(task, reserved=True)
+                except Exception:
+                    scheduler.release(task_args.task_name)
+                    if task is not None:
+                        task.close()
+                    raise
+            except DuplicateTaskError as e:
+                self._send_json({"error": str(e)}, code=409)
+                return
+            except (AttributeError, TypeError, ValueError) as e:
+                self._send_json({"error": str(e)}, code=400)
+                return
+            self._send_json(task.status(), code=201)
+
+        def do_scale(self, task):
+            # POST /trainers with {"count": N}
+            if not task.args.allow_trainer_scaling:
+                self._send_json({
+                    "error": "trainer scaling is not enabled for this task"
+                }, code=403)
+                return
+            try:
+                content_length = int(self.headers['Content-Length'])
+                request = json.loads(self.rfile.read(content_length) or "{}")
+                if "count" not in request:
+                    raise ValueError("count is required")
+                result = task.scale_trainers(int(request["count"]))
+            except (TypeError, ValueError) as e:
+                self._send_json({"error": str(e)}, code=400)
+                return
+            self._send_json(result)
 
         def do_404(self):
             self.send_response(404)
@@ -680,51 +1750,120 @@ def start_server(args):
 
         def do_GET(self):
 
-            request_path = self.path
-            if request_path == "/status" or request_path == "/master_logs":
-                self._set_headers()
+            parsed_path = urlparse.urlparse(self.path)
+            request_path = parsed_path.path
+            # master wide paths
+            if request_path in ("/status", "/master_logs", "/log/master.log"):
                 logging.info("Received request to return status")
-                with open(args.log_path + "master.log", "r") as logfile:
-                    self.wfile.write(logfile.read().strip())
+                self._send_log(args.log_path, "master.log", parsed_path.query)
+                return
+            elif request_path == "/tail/master.log":
+                self.do_tail(log_tailer, "master.log", parsed_path.query)
+                return
+            elif request_path == "/tasks":
+                self._send_json(scheduler.list())
+                return
+            elif request_path == "/prometheus":
+                # /metrics is the json query api, point scrapers here
+                body = prometheus_metrics()
+                self.send_response(200)
+                self.send_header('Content-type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            elif request_path == "/ec2_stats":
+                self._send_json({
+                    "cache": ec2client.stats(),
+                    "throttle": ec2_api.stats()
+                })
+                return
+
+            task, request_path = self._resolve(request_path)
+            if task is None:
+                self.do_404()
+            elif request_path == "/":
+                self._send_json(task.status())
+            elif request_path == "/metrics":
+                self.do_metrics(task, parsed_path.query)
+            elif request_path in ("/status", "/master_logs"):
+                self._send_log(task.log_path, "master.log", parsed_path.query)
+            elif request_path == "/cleanup":
+                self._send_json(teardown_status(task.name))
+            elif request_path == "/timeline":
+                # chrome trace json, ?format=summary for totals per phase
+                params = dict(urlparse.parse_qsl(parsed_path.query))
+                if params.get("format") == "summary":
+                    self._send_json(task.tracer.summary())
+                else:
+                    self._send_json(task.tracer.to_chrome_trace())
+            elif request_path == "/trainers":
+                self._send_json(task.trainer_supervisor.status()
+                                if task.trainer_supervisor else [])
+            elif request_path == "/health":
+                self._send_json(task.health.report() if task.health else {})
+            elif request_path == "/stragglers":
+                self._send_json(task.stragglers.report())
+            elif request_path == "/image_pulls":
+                self._send_json(task.image_prepuller.report()
+                                if task.image_prepuller else {})
             elif request_path == "/list_logs" or request_path == "/logs":
                 self._set_headers()
-                self.wfile.write("\n".join(log_files))
-            elif "/log/" in request_path:
-                self._set_headers()
-                log_file_path = request_path.replace("/log/", "")
-                logging.info("requesting log file path is" + args.log_path +
+                self.wfile.write("\n".join(task.log_files))
+            elif request_path.startswith("/tail/"):
+                self.do_tail(task.log_tailer,
+                             request_path.replace("/tail/", "", 1),
+                             parsed_path.query)
+            elif request_path.startswith("/log/"):
+                log_file_path = request_path.replace("/log/", "", 1)
+                logging.info("requesting log file path is" + task.log_path +
                              log_file_path)
-                with open(args.log_path + log_file_path, "r") as logfile:
-                    self.wfile.write(logfile.read().strip())
+                self._send_log(task.log_path, log_file_path,
+                               parsed_path.query)
             else:
                 self.do_404()
 
         def do_POST(self):
 
-            request_path = self.path
+            request_path = urlparse.urlparse(self.path).path
+            if request_path == "/tasks":
+                self.do_submit()
+                return
+
+            task, request_path = self._resolve(request_path)
+            if task is None:
+                self.do_404()
 
-            if request_path == "/save_data":
+            elif request_path == "/save_data":
                 self._set_headers()
                 logging.info("Received request to save data")
                 self.wfile.write("DATA SAVED!")
                 content_length = int(self.headers['Content-Length'])
                 post_data = self.rfile.read(content_length)
-                if args.task_name:
-                    with open(args.task_name + ".txt", "a") as text_file:
-                        text_file.write(post_data + "\n")
+                with open(task.name + ".txt", "a") as text_file:
+                    text_file.write(post_data + "\n")
+
+            elif request_path == "/trainers":
+                self.do_scale(task)
 
             elif request_path == "/cleanup":
-                self._set_headers()
-                logging.info("Received request to cleanup cluster")
-                args.no_clean_up = False
-                cleanup(args.task_name)
-                self.wfile.write("cleanup in progress")
+                logging.info("Received request to cleanup cluster " +
+                             task.name)
+                task.args.no_clean_up = False
+                teardown = task.cleanup()
+                if teardown is None:
+                    # the client tears the nodes down, stop following them
+                    task.close()
+                    self._set_headers()
+                    self.wfile.write("cleanup left to client")
+                else:
+                    self._send_json(teardown.status())
 
             else:
                 self.do_404()
 
     server_address = ('', args.master_server_port)
-    httpd = HTTPServer(server_address, S)
+    httpd = ThreadingHTTPServer(server_address, S)
     logging.info("HTTP server is starting")
     httpd.serve_forever()
 
@@ -742,14 +1881,14 @@ if __name__ == "__main__":
         logging.info("going to create cluster")
         if not args.key_name or not args.security_group_id:
             raise ValueError("key_name and security_group_id are required")
-        init_args()
-        create_cluster()
+        default_task = Task(args)
+        default_task.run()
     elif args.action == "cleanup":
         logging.info("going to cleanup cluster")
         if not args.task_name:
             raise ValueError("task_name is required")
-        cleanup(args.task_name)
-    elif args.action == "serve":
+        cleanup_task(args)
+    elif args.action in ("serve", "scheduler"):
         # serve mode
         if not args.master_server_ip:
             raise ValueError(
@@ -757,13 +1896,14 @@ if __name__ == "__main__":
 
         logging.info("going to start serve and create cluster")
 
-        init_args()
-
         logging.info("starting server in another thread")
         server_thread = threading.Thread(target=start_server, args=(args, ))
         server_thread.start()
 
-        create_cluster()
+        # more tasks can be submitted with POST /tasks, at most
+        # max_running_tasks of them run at the same time
+        if args.action == "serve" and args.key_name:
+            default_task = scheduler.submit(Task(args))
         server_thread.join()
     elif args.action == "test":
-        print("test stopped")
\ No newline at end of file
+        print("test stopped")
@@ -0,0 +1,259 @@
+import logging
+import threading
+import time
+import Queue
+
+from ssh_pool import ConnectInProgress
+
+# one line each: load average, cpu count, the cpu line of /proc/stat, then
+# utilization.gpu,memory.used per gpu if the node has any
+PROBE_CMD = ("cat /proc/loadavg; grep -c ^processor /proc/cpuinfo; "
+             "head -1 /proc/stat; "
+             "nvidia-smi --query-gpu=utilization.gpu,memory.used "
+             "--format=csv,noheader,nounits 2>/dev/null || true")
+
+
+def parse_probe(output):
+    # -> {"load", "cpus", "cpu_times", "gpu_util", "gpu_memory_mb", "gpus"}
+    lines = [l.strip() for l in output.splitlines() if l.strip()]
+    cpu_times = [int(v) for v in lines[2].split()[1:]]
+    gpus = []
+    for line in lines[3:]:
+        try:
+            util, memory = [float(v) for v in line.split(",")]
+        except ValueError:
+            continue
+        gpus.append((util, memory))
+    return {
+        "load": float(lines[0].split()[0]),
+        "cpus": int(lines[1]),
+        # (busy, total) jiffies, idle and iowait count as not busy
+        "cpu_times": (sum(cpu_times) - sum(cpu_times[3:5]), sum(cpu_times)),
+        "gpus": len(gpus),
+        "gpu_util": sum(g[0] for g in gpus) / len(gpus) if gpus else None,
+        "gpu_memory_mb": sum(g[1] for g in gpus) if gpus else None
+    }
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class HealthMonitor(object):
+    # probes every running node of a task over its pooled ssh connection
+    # every `interval` seconds for load, cpu and gpu utilisation, and keeps
+    # the age of the last log line seen from each node. flags:
+    #   unreachable - max_failures probes in a row failed
+    #   stalled     - a trainer printed nothing for stall_timeout seconds
+    #   straggler   - a trainer's gpu utilisation is below straggler_ratio
+    #                 of the median over all trainers
+    # on_stalled(node) is called once for each node that becomes stalled.
+    #
+    # a probe connects once with connect_timeout, without the retries of the
+    # pool, and skips a node another thread is still connecting to, so a
+    # dead node fails fast. probes run on probe_workers threads kept for the
+    # monitor's lifetime, however many nodes there are. a cycle waits for its
+    # probes at most probe_timeout + connect_timeout, a node whose probe is
+    # still queued or running is not probed again until it ends.
+    #
+    # nodes() -> {node: {"role", "ip", "state"}} as kept by the task
+    def __init__(self,
+                 ssh_sessions,
+                 nodes,
+                 interval=30,
+                 probe_timeout=20,
+                 connect_timeout=5,
+                 stall_timeout=600,
+                 straggler_ratio=0.5,
+                 max_failures=3,
+                 probe_workers=8,
+                 on_stalled=None,
+                 logger=logging):
+        self.ssh_sessions = ssh_sessions
+        self.nodes = nodes
+        self.interval = interval
+        self.probe_timeout = probe_timeout
+        self.connect_timeout = connect_timeout
+        self.stall_timeout = stall_timeout
+        self.straggler_ratio = straggler_ratio
+        self.max_failures = max_failures
+        self.on_stalled = on_stalled
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.health = {}
+        self.last_output = {}
+        self.probing = set()
+        # notified whenever a probe ends
+        self.probed = threading.Condition(self.lock)
+        self.probe_queue = Queue.Queue()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="health")
+        self.thread.daemon = True
+        self.workers = []
+        for i in xrange(probe_workers):
+            worker = threading.Thread(
+                target=self._work, name="health_probe_%d" % i)
+            worker.daemon = True
+            self.workers.append(worker)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        for _ in self.workers:
+            self.probe_queue.put(None)
+
+    def saw_output(self, node):
+        # called for every log line, a plain dict write is enough
+        self.last_output[node] = time.time()
+
+    def report(self):
+        now = time.time()
+        with self.lock:
+            nodes = dict((node, dict(health))
+                         for node, health in self.health.iteritems())
+        for node, health in nodes.iteritems():
+            health.pop("cpu_times", None)
+            if node in self.last_output:
+                health["last_output_age"] = round(
+                    now - self.last_output[node], 1)
+        return {
+            "nodes": nodes,
+            "unreachable": sorted(n for n, h in nodes.iteritems()
+                                  if h.get("unreachable")),
+            "stalled": sorted(n for n, h in nodes.iteritems()
+                              if h.get("stalled")),
+            "stragglers": sorted(n for n, h in nodes.iteritems()
+                                 if h.get("straggler"))
+        }
+
+    def probe(self, node, host):
+        started = time.time()
+        with self.lock:
+            health = self.health.setdefault(node, {"failures": 0})
+            previous = health.get("cpu_times")
+        try:
+            exit_code, stdout, stderr = self.ssh_sessions.run(
+                host,
+                PROBE_CMD,
+                timeout=self.probe_timeout,
+                retries=0,
+                connect_timeout=self.connect_timeout,
+                blocking=False)
+            if exit_code != 0:
+                raise Exception(stderr.strip() or "exit code %d" % exit_code)
+            result = parse_probe(stdout)
+        except ConnectInProgress:
+            # e.g. the kickoff waiting for sshd, not a failure
+            return
+        except Exception as e:
+            with self.lock:
+                health["failures"] += 1
+                health["alive"] = False
+                health["error"] = str(e)
+                health["unreachable"] = health["failures"] >= \
+                    self.max_failures
+            return
+        busy, total = result["cpu_times"]
+        if previous and total > previous[1]:
+            # utilisation since the last probe
+            result["cpu_util"] = round(
+                100.0 * (busy - previous[0]) / (total - previous[1]), 1)
+        with self.lock:
+            health.update(result)
+            health.update(
+                host=host,
+                alive=True,
+                failures=0,
+                unreachable=False,
+                error=None,
+                probed_at=started,
+                probe_seconds=round(time.time() - started, 3))
+
+    def _check(self, running):
+        # marks stalled trainers and stragglers among running trainers
+        now = time.time()
+        newly_stalled = []
+        with self.lock:
+            trainers = [
+                node for node, info in running.iteritems()
+                if info["role"] == "TRAINER" and node in self.health
+            ]
+            utils = [
+                self.health[node]["gpu_util"] for node in trainers
+                if self.health[node].get("gpu_util") is not None
+            ]
+            median = _median(utils) if len(utils) >= 2 else None
+            for node in trainers:
+                health = self.health[node]
+                # counted from the kickoff for nodes that printed nothing
+                # yet, or were relaunched since
+                last_output = max(
+                    self.last_output.get(node, 0), running[node]["since"])
+                stalled = now - last_output > self.stall_timeout
+                if stalled and not health.get("stalled"):
+                    newly_stalled.append(node)
+                health["stalled"] = stalled
+                health["straggler"] = (
+                    median is not None and
+                    health.get("gpu_util") is not None and
+                    health["gpu_util"] < self.straggler_ratio * median)
+        for node in newly_stalled:
+            self.logger.error("%s printed nothing for %ds, it looks stalled"
+                              % (node, self.stall_timeout))
+            if self.on_stalled:
+                try:
+                    self.on_stalled(node)
+                except Exception:
+                    self.logger.exception("error handling stalled %s" % node)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            running = dict((node, info)
+                           for node, info in self.nodes().iteritems()
+                           if info["state"] == "running" and info.get("ip"))
+            # nodes that are gone keep their last health, minus the flags
+            with self.lock:
+                for node, health in self.health.iteritems():
+                    if node not in running:
+                        health.update(stalled=False, straggler=False)
+            probes = set()
+            with self.lock:
+                for node, info in running.iteritems():
+                    if node in self.probing:
+                        continue
+                    self.probing.add(node)
+                    probes.add(node)
+                    self.probe_queue.put((node, info["ip"]))
+                deadline = time.time() + self.probe_timeout + \
+                    self.connect_timeout
+                while probes & self.probing and time.time() < deadline:
+                    self.probed.wait(deadline - time.time())
+            self._check(running)
+
+    def _work(self):
+        while True:
+            item = self.probe_queue.get()
+            if item is None:
+                return
+            node, host = item
+            try:
+                if not self.stopped.is_set():
+                    self.probe(node, host)
+            except Exception:
+                self.logger.exception("error probing %s" % node)
+            finally:
+                with self.lock:
+                    self.probing.discard(node)
+                    self.probed.notify_all()
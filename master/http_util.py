@@ -0,0 +1,127 @@
+import os
+import re
+import zlib
+import SocketServer
+
+from BaseHTTPServer import HTTPServer
+
+CHUNK_SIZE = 64 * 1024
+
+_range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, HTTPServer):
+    # one thread per request, so a slow client downloading a large log
+    # doesn't block /status or /cleanup
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RangeError(ValueError):
+    pass
+
+
+def parse_range(range_header, size):
+    # returns (start, end) inclusive for a single "bytes=" range
+    match = _range_pattern.match(range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        raise RangeError("unsupported range %s" % range_header)
+    start, end = match.group(1), match.group(2)
+    if start == "":
+        # suffix range, the last N bytes
+        length = int(end)
+        if length == 0:
+            raise RangeError("empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = int(end) if end else size - 1
+    if start >= size or end < start:
+        raise RangeError("range %s not satisfiable for size %d" %
+                         (range_header, size))
+    return start, min(end, size - 1)
+
+
+def accepts_gzip(handler):
+    accept_encoding = handler.headers.get("Accept-Encoding", "")
+    return "gzip" in [e.split(";")[0].strip() for e in accept_encoding.split(",")]
+
+
+class GzipStream(object):
+    # incremental gzip encoder writing to a file-like object
+    def __init__(self, out):
+        self.out = out
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.out.write(compressed)
+
+    def flush(self):
+        self.out.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.out.flush()
+
+    def close(self):
+        self.out.write(self.compressor.flush())
+        self.out.flush()
+
+
+def send_file(handler, path, offset=0, content_type="text/plain"):
+    # streams path in chunks, honouring a Range header or a starting byte
+    # offset, gzipped if the client accepts it. X-Next-Offset tells the
+    # client where to continue from next time.
+    try:
+        log_file = open(path, "rb")
+    except IOError:
+        handler.send_response(404)
+        handler.send_header("Content-type", "text/plain")
+        handler.end_headers()
+        handler.wfile.write("NO SUCH FILE")
+        return
+    with log_file:
+        size = os.fstat(log_file.fileno()).st_size
+        status = 200
+        start, end = min(offset, size), size - 1
+        range_header = handler.headers.get("Range")
+        if range_header:
+            try:
+                start, end = parse_range(range_header, size)
+            except RangeError:
+                handler.send_response(416)
+                handler.send_header("Content-Range", "bytes */%d" % size)
+                handler.end_headers()
+                return
+            status = 206
+        length = max(0, end - start + 1)
+        use_gzip = accepts_gzip(handler) and length > 0
+
+        handler.send_response(status)
+        handler.send_header("Content-type", content_type)
+        handler.send_header("Accept-Ranges", "bytes")
+        handler.send_header("X-Next-Offset", str(start + length))
+        if status == 206:
+            handler.send_header("Content-Range",
+                                "bytes %d-%d/%d" % (start, end, size))
+        if use_gzip:
+            # length unknown up front, the body ends when the connection
+            # closes
+            handler.send_header("Content-Encoding", "gzip")
+            handler.send_header("Vary", "Accept-Encoding")
+        else:
+            handler.send_header("Content-Length", str(length))
+        handler.end_headers()
+        if handler.command == "HEAD":
+            return
+
+        out = GzipStream(handler.wfile) if use_gzip else handler.wfile
+        log_file.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = log_file.read(min(CHUNK_SIZE, remaining))
+            if not data:
+                break
+            out.write(data)
+            remaining -= len(data)
+        if use_gzip:
+            out.close()
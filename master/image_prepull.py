@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+# merges a registry mirror into the node's docker daemon config and restarts
+# docker, so docker hub pulls go through the mirror
+MIRROR_SETUP_CMD = (
+    "sudo python3 -c \"import json, os; "
+    "p = '/etc/docker/daemon.json'; "
+    "c = json.load(open(p)) if os.path.exists(p) else {}; "
+    "m = 'http://{MIRROR}'; "
+    "c['registry-mirrors'] = [m] + [x for x in c.get('registry-mirrors', []) if x != m]; "
+    "c['insecure-registries'] = ['{MIRROR}'] + [x for x in c.get('insecure-registries', []) if x != '{MIRROR}']; "
+    "json.dump(c, open(p, 'w'))\" "
+    "&& (sudo systemctl restart docker || sudo service docker restart)")
+
+
+class ImagePrepuller(object):
+    # pulls the training image on each node as soon as it is reachable over
+    # ssh, so the pull overlaps with the rest of the bring-up instead of
+    # being charged to the kickoff command. records how long each node took.
+    def __init__(self,
+                 ssh_sessions,
+                 registry_mirror="",
+                 timeout=1800,
+                 tracer=None):
+        self.ssh_sessions = ssh_sessions
+        self.tracer = tracer
+        self.registry_mirror = registry_mirror
+        self.timeout = timeout
+        self.pulls = {}
+        self.lock = threading.Lock()
+
+    def start(self, host, node, image):
+        with self.lock:
+            if host in self.pulls:
+                return
+            pull = {
+                "node": node,
+                "image": image,
+                "state": "pulling",
+                "started_at": time.time(),
+                "event": threading.Event()
+            }
+            self.pulls[host] = pull
+        pull_thread = threading.Thread(
+            target=self._pull, args=(host, pull, image))
+        pull_thread.daemon = True
+        pull_thread.start()
+
+    def wait(self, host, timeout=None):
+        # True if the image is on the node, False if the pull failed or was
+        # never started; kickoff goes ahead either way and docker run pulls
+        # whatever is missing
+        with self.lock:
+            pull = self.pulls.get(host)
+        if pull is None:
+            return False
+        if not pull["event"].wait(timeout):
+            return False
+        return pull["state"] == "done"
+
+    def report(self):
+        with self.lock:
+            return dict((pull["node"], dict(
+                (k, v) for k, v in pull.iteritems() if k != "event"))
+                        for pull in self.pulls.values())
+
+    def _pull(self, host, pull, image):
+        try:
+            if self.registry_mirror:
+                exit_code, _, stderr = self.ssh_sessions.run(
+                    host,
+                    MIRROR_SETUP_CMD.replace("{MIRROR}", self.registry_mirror),
+                    timeout=120)
+                if exit_code != 0:
+                    logging.info("could not point %s at registry mirror: %s" %
+                                 (pull["node"], stderr.strip()))
+            exit_code, _, stderr = self.ssh_sessions.run(
+                host, "docker pull " + image, timeout=self.timeout)
+            pull["state"] = "done" if exit_code == 0 else "failed"
+            if exit_code != 0:
+                pull["error"] = stderr.strip()[-500:]
+        except Exception as e:
+            pull["state"] = "failed"
+            pull["error"] = str(e)
+        finished_at = time.time()
+        pull["seconds"] = round(finished_at - pull["started_at"], 1)
+        if self.tracer is not None:
+            self.tracer.add(
+                "image_pull",
+                pull["started_at"],
+                finished_at,
+                node=pull["node"],
+                state=pull["state"])
+        logging.info("image pull on %s %s after %.1fs" %
+                     (pull["node"], pull["state"], pull["seconds"]))
+        pull["event"].set()
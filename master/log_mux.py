@@ -0,0 +1,146 @@
+import logging
+import os
+import select
+import threading
+
+
+class ChannelHandle(object):
+    # completion of one remote command, wait() returns its exit status once
+    # the exit callback has run
+    def __init__(self, on_exit=None):
+        self.on_exit = on_exit
+        self.exit_status = None
+        self.event = threading.Event()
+
+    def finish(self, exit_status):
+        self.exit_status = exit_status
+        if self.on_exit:
+            try:
+                self.on_exit(exit_status)
+            except Exception:
+                logging.exception("error in channel exit callback")
+        self.event.set()
+
+    def wait(self, timeout=None):
+        self.event.wait(timeout)
+        return self.exit_status
+
+
+class _Stream(object):
+    def __init__(self, channel, stdout_name, stderr_name, handle,
+                 line_handler):
+        self.channel = channel
+        self.stdout_name = stdout_name
+        self.stderr_name = stderr_name
+        self.handle = handle
+        self.line_handler = line_handler
+        self.stdout_partial = ""
+        self.stderr_partial = ""
+
+
+class LogMultiplexer(object):
+    # reads stdout and stderr of every node's paramiko channel from a single
+    # thread. channels are polled through their fileno() pipes and split into
+    # lines, which are passed to line_handler(filename, line), or to the
+    # handler given for that channel.
+    def __init__(self, line_handler=None, read_size=32768, poll_timeout=1.0):
+        self.line_handler = line_handler
+        self.read_size = read_size
+        self.poll_timeout = poll_timeout
+
+        self.streams = {}
+        self.new_streams = []
+        self.lock = threading.Lock()
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def add(self,
+            channel,
+            stdout_name,
+            stderr_name,
+            on_exit=None,
+            line_handler=None):
+        handle = ChannelHandle(on_exit)
+        with self.lock:
+            self.new_streams.append(
+                _Stream(channel, stdout_name, stderr_name, handle,
+                        line_handler or self.line_handler))
+        os.write(self.wakeup_w, "x")
+        return handle
+
+    def channel_count(self):
+        with self.lock:
+            return len(self.streams) + len(self.new_streams)
+
+    def _emit(self, stream, filename, partial, data):
+        lines = (partial + data).split("\n")
+        for line in lines[:-1]:
+            stream.line_handler(filename, line + "\n")
+        return lines[-1]
+
+    def _drain(self, stream):
+        channel = stream.channel
+        while channel.recv_ready():
+            stream.stdout_partial = self._emit(
+                stream, stream.stdout_name, stream.stdout_partial,
+                channel.recv(self.read_size))
+        while channel.recv_stderr_ready():
+            stream.stderr_partial = self._emit(
+                stream, stream.stderr_name, stream.stderr_partial,
+                channel.recv_stderr(self.read_size))
+
+    def _is_done(self, channel):
+        return (channel.exit_status_ready() and
+                (channel.closed or channel.eof_received) and
+                not channel.recv_ready() and not channel.recv_stderr_ready())
+
+    def _finish(self, stream):
+        if stream.stdout_partial:
+            stream.line_handler(stream.stdout_name, stream.stdout_partial)
+        if stream.stderr_partial:
+            stream.line_handler(stream.stderr_name, stream.stderr_partial)
+        stream.handle.finish(stream.channel.recv_exit_status())
+
+    def _register_new(self, poller):
+        with self.lock:
+            new_streams, self.new_streams = self.new_streams, []
+        for stream in new_streams:
+            fd = stream.channel.fileno()
+            self.streams[fd] = stream
+            poller.register(fd, select.POLLIN)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self.wakeup_r, select.POLLIN)
+        while True:
+            self._register_new(poller)
+            events = poller.poll(self.poll_timeout * 1000)
+            ready_fds = set()
+            for fd, _ in events:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                else:
+                    ready_fds.add(fd)
+            # exit status may arrive without new data, so every channel is
+            # checked for completion on each round, not only readable ones
+            for fd, stream in self.streams.items():
+                try:
+                    if fd in ready_fds:
+                        self._drain(stream)
+                    if self._is_done(stream.channel):
+                        self._drain(stream)
+                        poller.unregister(fd)
+                        del self.streams[fd]
+                        self._finish(stream)
+                except Exception:
+                    logging.exception("error while reading from channel %s" %
+                                      stream.stdout_name)
+                    poller.unregister(fd)
+                    del self.streams[fd]
+                    stream.handle.finish(-1)
@@ -0,0 +1,85 @@
+import collections
+import logging
+import threading
+import time
+
+
+class LogRing(object):
+    # the last `capacity` lines of one log. every line gets a sequence
+    # number, watchers keep the number of the next line they want as their
+    # cursor and block until it arrives.
+    def __init__(self, capacity=1000):
+        self.lines = collections.deque(maxlen=capacity)
+        self.next_seq = 0
+        self.cond = threading.Condition()
+
+    def append(self, line):
+        with self.cond:
+            self.lines.append(line)
+            self.next_seq += 1
+            self.cond.notify_all()
+
+    def read(self, cursor=None, timeout=30, max_lines=None):
+        # returns (lines, next_cursor, dropped). cursor None means only
+        # lines arriving from now on, a negative cursor means that many lines
+        # of backlog. dropped counts lines that fell out of the ring before
+        # the watcher got to them.
+        deadline = time.time() + timeout
+        with self.cond:
+            if cursor is None:
+                cursor = self.next_seq
+            elif cursor < 0:
+                cursor = max(0, self.next_seq + cursor)
+            while cursor >= self.next_seq:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return [], self.next_seq, 0
+                self.cond.wait(remaining)
+            first_seq = self.next_seq - len(self.lines)
+            dropped = max(0, first_seq - cursor)
+            start = max(cursor, first_seq) - first_seq
+            end = len(self.lines)
+            if max_lines is not None:
+                end = min(end, start + max_lines)
+            lines = [self.lines[i] for i in xrange(start, end)]
+            return lines, first_seq + end, dropped
+
+
+class LogTailer(object):
+    # one ring per log file, fed by the log reader as lines arrive so any
+    # number of /tail watchers are served from memory instead of disk. rings
+    # are only made for logs that got a line, watchers can not add any.
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    def ring(self, filename):
+        # the ring of a log, None if it has none yet
+        with self.lock:
+            return self.rings.get(filename)
+
+    def create_ring(self, filename):
+        with self.lock:
+            if filename not in self.rings:
+                self.rings[filename] = LogRing(self.capacity)
+            return self.rings[filename]
+
+    def append(self, filename, line):
+        self.create_ring(filename).append(line)
+
+
+class RingLogHandler(logging.Handler):
+    # mirrors master log records into a ring so master.log can be tailed too
+    def __init__(self, tailer, filename="master.log"):
+        logging.Handler.__init__(self)
+        self.ring = tailer.create_ring(filename)
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+            if not line.endswith("\n"):
+                line += "\n"
+            self.ring.append(line)
+        except Exception:
+            self.handleError(record)
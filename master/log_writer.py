@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+import time
+import Queue
+
+# queued by close(), the writer thread writes what is left and ends
+_STOP = object()
+
+
+class LogWriter(object):
+    # single writer thread for all node log streams. readers only enqueue
+    # lines, the writer coalesces them per file and flushes by size or time,
+    # fsyncing at most once per fsync_interval.
+    def __init__(self,
+                 log_path,
+                 queue_size=10000,
+                 flush_bytes=64 * 1024,
+                 flush_interval=1.0,
+                 fsync_interval=5.0,
+                 echo=True,
+                 stats_interval=60):
+        self.log_path = log_path
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.echo = echo
+        self.stats_interval = stats_interval
+
+        self.files = {}
+        self.unsynced = set()
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_flush = time.time()
+        self.last_fsync = time.time()
+        self.last_stats = time.time()
+
+        self.counters = {
+            "lines_queued": 0,
+            "lines_written": 0,
+            "bytes_written": 0,
+            "flushes": 0,
+            "fsyncs": 0,
+            # writes that found the queue full and had to wait, if this
+            # keeps growing the writer is falling behind
+            "queue_full_waits": 0,
+            "max_queue_depth": 0,
+            # lines that came in after close()
+            "lines_dropped": 0,
+        }
+        self.counters_lock = threading.Lock()
+
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _put(self, item):
+        # False if the writer is closed. a put waiting on a full queue looks
+        # at closed again every so often, the writer thread may have ended
+        # meanwhile.
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(item)
+            return True
+        except Queue.Full:
+            with self.counters_lock:
+                self.counters["queue_full_waits"] += 1
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def write(self, filename, line):
+        # lines of streams still open after close() are dropped
+        queued = self._put((filename, line))
+        with self.counters_lock:
+            self.counters["lines_queued" if queued else "lines_dropped"] += 1
+
+    def flush(self, timeout=None):
+        # blocks until everything queued so far is written and fsynced
+        deadline = time.time() + timeout if timeout is not None else None
+        done = threading.Event()
+        if not self._put((None, done)):
+            return
+        # the writer thread ends without seeing a marker queued as it closes
+        while not done.wait(0.5):
+            if not self.thread.is_alive():
+                return
+            if deadline is not None and time.time() > deadline:
+                return
+
+    def stats(self):
+        with self.counters_lock:
+            stats = dict(self.counters)
+        stats["queue_depth"] = self.queue.qsize()
+        stats["open_files"] = len(self.files)
+        return stats
+
+    def close(self):
+        # writes everything queued so far, closes the files and ends the
+        # writer thread
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put((None, _STOP))
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _open(self, filename):
+        if filename not in self.files:
+            self.files[filename] = open(
+                os.path.join(self.log_path, filename), "a")
+        return self.files[filename]
+
+    def _write_pending(self, force_fsync=False):
+        now = time.time()
+        do_fsync = force_fsync or now - self.last_fsync >= self.fsync_interval
+        lines_written = 0
+        for filename, lines in self.pending.iteritems():
+            if not lines:
+                continue
+            log_file = self._open(filename)
+            log_file.write("".join(lines))
+            log_file.flush()
+            lines_written += len(lines)
+            self.unsynced.add(filename)
+        if do_fsync:
+            for filename in self.unsynced:
+                os.fsync(self.files[filename].fileno())
+            self.unsynced = set()
+
+        with self.counters_lock:
+            self.counters["lines_written"] += lines_written
+            self.counters["bytes_written"] += self.pending_bytes
+            self.counters["flushes"] += 1
+            if do_fsync:
+                self.counters["fsyncs"] += 1
+
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_flush = now
+        if do_fsync:
+            self.last_fsync = now
+
+    def _run(self):
+        while True:
+            timeout = max(0.01,
+                          self.flush_interval - (time.time() - self.last_flush))
+            try:
+                filename, line = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                filename, line = None, None
+
+            if line is _STOP:
+                self._write_pending(force_fsync=True)
+                for log_file in self.files.values():
+                    log_file.close()
+                self.files = {}
+                return
+
+            if filename is None and line is not None:
+                # flush marker
+                self._write_pending(force_fsync=True)
+                line.set()
+                continue
+
+            if filename is not None:
+                depth = self.queue.qsize()
+                if depth > self.counters["max_queue_depth"]:
+                    with self.counters_lock:
+                        self.counters["max_queue_depth"] = depth
+                if self.echo:
+                    logging.info(line)
+                self.pending.setdefault(filename, []).append(line)
+                self.pending_bytes += len(line)
+
+            if (self.pending_bytes >= self.flush_bytes or
+                    time.time() - self.last_flush >= self.flush_interval):
+                if self.pending:
+                    self._write_pending()
+                else:
+                    self.last_flush = time.time()
+
+            if (self.stats_interval and
+                    time.time() - self.last_stats >= self.stats_interval):
+                self.last_stats = time.time()
+                if self.counters["lines_queued"]:
+                    logging.info("log writer stats: %s" % self.stats())
@@ -0,0 +1,318 @@
+import csv
+import math
+import os
+import threading
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGGREGATIONS = ("mean", "min", "max", "sum", "count", "last")
+
+
+class QueryError(ValueError):
+    pass
+
+
+def _percentile(sorted_values, q):
+    # linear interpolation between closest ranks, same as numpy's default
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100.0
+    low = int(math.floor(rank))
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (
+        rank - low)
+
+
+def parse_agg(agg):
+    if agg in AGGREGATIONS:
+        return agg
+    if agg.startswith("p"):
+        try:
+            q = float(agg[1:])
+        except ValueError:
+            q = -1
+        if 0 <= q <= 100:
+            return agg
+    raise QueryError("unknown aggregation %s, use one of %s or p0-p100" %
+                     (agg, "|".join(AGGREGATIONS)))
+
+
+def aggregate(values, agg):
+    # values is a numpy array when numpy is available, a list otherwise
+    if len(values) == 0:
+        return None
+    if agg == "count":
+        return len(values)
+    if agg == "last":
+        return float(values[-1])
+    if numpy is not None:
+        if agg.startswith("p"):
+            return float(numpy.percentile(values, float(agg[1:])))
+        return float(getattr(numpy, agg)(values))
+    if agg == "mean":
+        return sum(values) / len(values)
+    if agg == "min":
+        return min(values)
+    if agg == "max":
+        return max(values)
+    if agg == "sum":
+        return sum(values)
+    return _percentile(sorted(values), float(agg[1:]))
+
+
+class MetricSeries(object):
+    # one metric key, stored as parallel typed arrays instead of lists of
+    # python floats
+    def __init__(self):
+        self.timestamps = array('d')
+        self.values = array('d')
+        self.node_ids = array('i')
+
+    def append(self, timestamp, value, node_id):
+        self.timestamps.append(timestamp)
+        self.values.append(value)
+        self.node_ids.append(node_id)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class MetricsStore(object):
+    # thread safe, append-only store for **metrics_data lines. every row is
+    # tagged with the node it came from and the time it was received.
+    #
+    # the csv schema is timestamp,node followed by one column per metric key
+    # in the order keys were first seen. existing columns never move; when a
+    # new key shows up the file is rewritten once with the wider header,
+    # otherwise rows are only appended, in batches.
+    def __init__(self, csv_path, batch_size=100, flush_interval=5.0):
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.columns = []
+        self.series = {}
+        self.nodes = []
+        self.node_ids = {}
+        self.latest = {}
+
+        self.pending_rows = []
+        self.last_flush = time.time()
+        self.csv_file = None
+        self.csv_columns = None
+        # once closed, rows are only kept in memory
+        self.closed = False
+        self.lock = threading.RLock()
+
+    def _node_id(self, node):
+        if node not in self.node_ids:
+            self.node_ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.node_ids[node]
+
+    def append(self, node, values, timestamp=None):
+        # values is a list of (key, float) pairs
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            node_id = self._node_id(node)
+            for key, value in values:
+                if key not in self.series:
+                    self.series[key] = MetricSeries()
+                    self.columns.append(key)
+                self.series[key].append(timestamp, value, node_id)
+                self.latest[(node, key)] = (timestamp, value)
+            if self.closed:
+                return
+            self.pending_rows.append((timestamp, node, dict(values)))
+            if (len(self.pending_rows) >= self.batch_size or
+                    time.time() - self.last_flush >= self.flush_interval):
+                self.flush()
+
+    def keys(self):
+        with self.lock:
+            return list(self.columns)
+
+    def describe(self):
+        with self.lock:
+            return {
+                "keys": list(self.columns),
+                "nodes": list(self.nodes),
+                "counts": dict((k, len(v)) for k, v in self.series.iteritems())
+            }
+
+    def get_series(self, key):
+        with self.lock:
+            return self.series.get(key)
+
+    def _snapshot(self, key):
+        # copies of the series arrays so queries don't hold the lock
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                raise QueryError("no metric named %s" % key)
+            return (array('d', series.timestamps), array('d', series.values),
+                    array('i', series.node_ids), dict(self.node_ids))
+
+    def query(self, key, since=None, node=None, agg=None, window=None):
+        # returns a json friendly dict, either the raw points
+        # [[timestamp, node, value], ...], a single aggregated value, or one
+        # aggregated value per time window [[window_start, value, count], ...]
+        timestamps, values, node_ids, node_id_map = self._snapshot(key)
+        if agg is not None:
+            agg = parse_agg(agg)
+        if window is not None and window <= 0:
+            raise QueryError("window has to be positive")
+        if window is not None and agg is None:
+            agg = "mean"
+        node_id = None
+        if node is not None:
+            if node not in node_id_map:
+                raise QueryError("no metrics from node %s" % node)
+            node_id = node_id_map[node]
+        node_names = dict((v, k) for k, v in node_id_map.iteritems())
+
+        if numpy is not None:
+            timestamps = numpy.frombuffer(timestamps, dtype=numpy.float64)
+            values = numpy.frombuffer(values, dtype=numpy.float64)
+            node_ids = numpy.frombuffer(node_ids, dtype=numpy.intc)
+            mask = numpy.ones(len(values), dtype=bool)
+            if since is not None:
+                mask &= timestamps >= since
+            if node_id is not None:
+                mask &= node_ids == node_id
+            timestamps = timestamps[mask]
+            values = values[mask]
+            node_ids = node_ids[mask]
+        else:
+            selected = [
+                i for i in xrange(len(values))
+                if (since is None or timestamps[i] >= since) and
+                (node_id is None or node_ids[i] == node_id)
+            ]
+            timestamps = [timestamps[i] for i in selected]
+            values = [values[i] for i in selected]
+            node_ids = [node_ids[i] for i in selected]
+
+        result = {"key": key, "count": len(values)}
+        if node is not None:
+            result["node"] = node
+        if agg is None:
+            result["points"] = [[
+                round(float(t), 3), node_names[int(n)], float(v)
+            ] for t, n, v in zip(timestamps, node_ids, values)]
+        elif window is None:
+            result["agg"] = agg
+            result["value"] = aggregate(values, agg)
+        else:
+            result["agg"] = agg
+            result["window"] = window
+            result["windows"] = self._aggregate_windows(timestamps, values,
+                                                        agg, window)
+        return result
+
+    def _aggregate_windows(self, timestamps, values, agg, window):
+        windows = []
+        if len(values) == 0:
+            return windows
+        if numpy is not None:
+            buckets = numpy.floor(timestamps / window)
+            order = numpy.argsort(buckets, kind="mergesort")
+            buckets = buckets[order]
+            values = values[order]
+            starts = numpy.flatnonzero(
+                numpy.concatenate(([True], buckets[1:] != buckets[:-1])))
+            ends = numpy.append(starts[1:], len(values))
+            for start, end in zip(starts, ends):
+                windows.append([
+                    float(buckets[start] * window),
+                    aggregate(values[start:end], agg), int(end - start)
+                ])
+            return windows
+        grouped = {}
+        for t, v in zip(timestamps, values):
+            grouped.setdefault(math.floor(t / window), []).append(v)
+        for bucket in sorted(grouped):
+            windows.append([
+                bucket * window, aggregate(grouped[bucket], agg),
+                len(grouped[bucket])
+            ])
+        return windows
+
+    def latest_values(self):
+        # {(node, key): (timestamp, value)} of the last value seen per node
+        with self.lock:
+            return dict(self.latest)
+
+    def _row(self, timestamp, node, values):
+        row = ["%.3f" % timestamp, node]
+        for key in self.csv_columns:
+            value = values.get(key)
+            row.append("" if value is None else repr(value))
+        return row
+
+    def _load_header(self):
+        # keep appending to a file left by a previous run if it has the same
+        # layout, move anything else out of the way
+        self.csv_columns = []
+        if not os.path.exists(self.csv_path):
+            return
+        with open(self.csv_path, "rb") as old_file:
+            header = next(csv.reader(old_file), [])
+        if header[:2] == ["timestamp", "node"]:
+            self.csv_columns = header[2:]
+        else:
+            os.rename(self.csv_path, self.csv_path + ".old")
+
+    def _rewrite_with_header(self, columns):
+        # called only when the schema grows, pads existing rows with empty
+        # cells for the new columns
+        old_rows = []
+        if self.csv_file is not None:
+            self.csv_file.close()
+            self.csv_file = None
+        if os.path.exists(self.csv_path):
+            with open(self.csv_path, "rb") as old_file:
+                old_rows = list(csv.reader(old_file))[1:]
+        self.csv_columns = columns
+        width = 2 + len(self.csv_columns)
+        tmp_path = self.csv_path + ".tmp"
+        with open(tmp_path, "wb") as tmp_file:
+            writer = csv.writer(tmp_file)
+            writer.writerow(["timestamp", "node"] + self.csv_columns)
+            for row in old_rows:
+                writer.writerow(row + [""] * (width - len(row)))
+        os.rename(tmp_path, self.csv_path)
+
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.time()
+            if not self.pending_rows:
+                return
+            if self.csv_columns is None:
+                self._load_header()
+            new_columns = [
+                c for c in self.columns if c not in self.csv_columns
+            ]
+            if new_columns or not os.path.exists(self.csv_path):
+                self._rewrite_with_header(self.csv_columns + new_columns)
+            if self.csv_file is None:
+                self.csv_file = open(self.csv_path, "ab")
+            writer = csv.writer(self.csv_file)
+            for timestamp, node, values in self.pending_rows:
+                writer.writerow(self._row(timestamp, node, values))
+            self.csv_file.flush()
+            self.pending_rows = []
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.closed = True
+            if self.csv_file is not None:
+                self.csv_file.close()
+                self.csv_file = None
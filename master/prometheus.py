@@ -0,0 +1,64 @@
+import math
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace("\"", "\\\""))
+
+
+def _format_value(value):
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    value = float(value)
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (k, _escape(v))
+                             for k, v in sorted(labels.iteritems()))
+
+
+class MetricFamily(object):
+    # one metric in the prometheus text exposition format, with its samples
+    def __init__(self, name, metric_type, help_text):
+        self.name = name
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.samples = []
+
+    def add(self, value, suffix="", **labels):
+        self.samples.append((self.name + suffix, labels, value))
+        return self
+
+    def add_histogram(self, buckets, counts, total, **labels):
+        # counts are per bucket, not cumulative, with one more for +Inf
+        cumulative = 0
+        for bound, count in zip(list(buckets) + [float("inf")], counts):
+            cumulative += count
+            bucket_labels = dict(labels, le=_format_value(bound))
+            self.add(cumulative, "_bucket", **bucket_labels)
+        self.add(total, "_sum", **labels)
+        self.add(cumulative, "_count", **labels)
+        return self
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text.replace("\n", " ")),
+            "# TYPE %s %s" % (self.name, self.metric_type)
+        ]
+        for name, labels, value in self.samples:
+            lines.append("%s%s %s" % (name, _format_labels(labels),
+                                      _format_value(value)))
+        return "\n".join(lines)
+
+
+def render(families):
+    return "\n".join(f.render() for f in families) + "\n"
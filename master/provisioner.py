@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# error codes worth another run_instances attempt instead of failing the task
+RETRYABLE_LAUNCH_ERRORS = ("InsufficientInstanceCapacity",
+                           "InstanceLimitExceeded", "RequestLimitExceeded",
+                           "Unavailable", "InternalError")
+
+
+class ProvisionError(Exception):
+    pass
+
+
+class Deferred(object):
+    # a value produced once by one thread and waited on by many, e.g. the
+    # pserver endpoints trainers need right before their kickoff command
+    def __init__(self, value=None):
+        self.value = value
+        self.error = None
+        self.event = threading.Event()
+        if value is not None:
+            self.event.set()
+
+    def set(self, value):
+        self.value = value
+        self.event.set()
+
+    def fail(self, error):
+        # also after set(), later get() calls raise instead of returning a
+        # value that is no good any more
+        self.error = error
+        self.event.set()
+
+    def get(self, timeout=None):
+        if not self.event.wait(timeout):
+            raise ProvisionError("timed out waiting for deferred value")
+        if self.error is not None:
+            raise ProvisionError(self.error)
+        return self.value
+
+
+class BatchProvisioner(object):
+    # launches `count` instances with as few run_instances calls as possible
+    # and hands them out by slot index, so each trainer thread can block on
+    # its own instance instead of issuing its own RunInstances call.
+    #
+    # launch(count, min_count) -> list of instance dicts, not waited on
+    # wait(instance_ids) -> iterable of instance dicts, each one yielded once
+    #   its status is ok, either all at once or streamed one by one
+    def __init__(self,
+                 launch,
+                 wait,
+                 count,
+                 chunk_size=0,
+                 max_retries=3,
+                 retry_interval=10):
+        self.launch = launch
+        self.wait = wait
+        self.count = count
+        self.chunk_size = chunk_size if chunk_size > 0 else count
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+
+        self.instances = [None] * count
+        self.errors = [None] * count
+        self.events = [threading.Event() for _ in xrange(count)]
+        self.threads = []
+
+    def start(self):
+        for start in xrange(0, self.count, self.chunk_size):
+            slots = range(start, min(start + self.chunk_size, self.count))
+            chunk_thread = threading.Thread(
+                target=self._provision_chunk, args=(slots, ))
+            chunk_thread.daemon = True
+            chunk_thread.start()
+            self.threads.append(chunk_thread)
+        return self
+
+    def get(self, index, timeout=None):
+        # blocks until the instance for this slot is ready
+        if not self.events[index].wait(timeout):
+            raise ProvisionError("timed out waiting for instance %d" % index)
+        if self.errors[index] is not None:
+            raise ProvisionError("instance %d could not be provisioned: %s" %
+                                 (index, self.errors[index]))
+        return self.instances[index]
+
+    def join(self):
+        for chunk_thread in self.threads:
+            chunk_thread.join()
+
+    def _launch_with_retries(self, wanted):
+        # run_instances may return fewer instances than MaxCount when
+        # capacity is short, keep asking for the shortfall
+        launched = []
+        attempt = 0
+        while len(launched) < wanted:
+            shortfall = wanted - len(launched)
+            try:
+                launched.extend(self.launch(shortfall, 1))
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code", "")
+                if code not in RETRYABLE_LAUNCH_ERRORS:
+                    raise
+                logging.info("run_instances for %d instance(s) failed with %s" %
+                             (shortfall, code))
+            if len(launched) >= wanted:
+                break
+            attempt += 1
+            if attempt > self.max_retries:
+                break
+            logging.info("%d of %d instance(s) launched, retrying shortfall "
+                         "in %ds" % (len(launched), wanted,
+                                     self.retry_interval * attempt))
+            time.sleep(self.retry_interval * attempt)
+        return launched
+
+    def _provision_chunk(self, slots):
+        pending_slots = list(slots)
+        try:
+            launched = self._launch_with_retries(len(slots))
+            if launched:
+                # one shared waiter for the whole chunk, slots are handed out
+                # in the order instances become ready
+                for instance in self.wait([i["InstanceId"] for i in launched]):
+                    slot = pending_slots.pop(0)
+                    self.instances[slot] = instance
+                    self.events[slot].set()
+            error = "only %d of %d instance(s) became ready" % (
+                len(slots) - len(pending_slots), len(slots))
+        except Exception as e:
+            logging.exception("error while provisioning instances")
+            error = e
+
+        for slot in pending_slots:
+            self.errors[slot] = error
+            self.events[slot].set()
+
+
+def iter_ready_instances(ec2client,
+                         instance_ids,
+                         poll_interval=5,
+                         timeout=1200):
+    # yields instance descriptions one by one as soon as each instance passes
+    # its status checks, polling describe_instance_status in bulk instead of
+    # blocking on a waiter for the whole batch
+    pending = list(instance_ids)
+    deadline = time.time() + timeout
+    while pending:
+        ready_ids = []
+        for start in xrange(0, len(pending), 100):
+            try:
+                response = ec2client.describe_instance_status(
+                    InstanceIds=pending[start:start + 100],
+                    IncludeAllInstances=True)
+            except ClientError as e:
+                # freshly launched instances may not be visible yet
+                if e.response.get("Error", {}).get(
+                        "Code") != "InvalidInstanceID.NotFound":
+                    raise
+                continue
+            for status in response["InstanceStatuses"]:
+                state = status["InstanceState"]["Name"]
+                if state in ("shutting-down", "terminated", "stopping",
+                             "stopped"):
+                    raise ProvisionError("instance %s is %s" %
+                                         (status["InstanceId"], state))
+                if status["InstanceStatus"]["Status"] == "ok":
+                    ready_ids.append(status["InstanceId"])
+
+        if ready_ids:
+            logging.info("%d instance(s) became accessible, %d pending" %
+                         (len(ready_ids), len(pending) - len(ready_ids)))
+            instances_response = ec2client.describe_instances(
+                InstanceIds=ready_ids)
+            for reservation in instances_response["Reservations"]:
+                for instance in reservation["Instances"]:
+                    pending.remove(instance["InstanceId"])
+                    yield instance
+
+        if not pending:
+            break
+        if time.time() > deadline:
+            raise ProvisionError("instance(s) %s not accessible after %ds" %
+                                 (",".join(pending), timeout))
+        time.sleep(poll_interval)
@@ -0,0 +1,163 @@
+import logging
+import socket
+import threading
+import time
+
+import paramiko
+
+
+class ConnectInProgress(Exception):
+    # another thread is connecting to the host, raised instead of waiting
+    # for it when asked not to block
+    pass
+
+
+class SSHSessionManager(object):
+    # keeps one authenticated ssh connection per host and opens every
+    # kickoff, log tail or probe as a separate channel on it. the private key
+    # is parsed once and shared by all connections.
+    def __init__(self,
+                 pem_path,
+                 username="ubuntu",
+                 keepalive_interval=30,
+                 connect_retries=10,
+                 retry_interval=2,
+                 max_retry_interval=30,
+                 connect_timeout=20):
+        self.pem_path = pem_path
+        self.username = username
+        self.keepalive_interval = keepalive_interval
+        self.connect_retries = connect_retries
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.connect_timeout = connect_timeout
+
+        self.pkey = None
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.host_locks = {}
+        self.reconnects = 0
+
+    def _load_key(self):
+        with self.lock:
+            if self.pkey is None:
+                self.pkey = paramiko.RSAKey.from_private_key_file(
+                    self.pem_path)
+            return self.pkey
+
+    def _host_lock(self, host):
+        with self.lock:
+            if host not in self.host_locks:
+                self.host_locks[host] = threading.Lock()
+            return self.host_locks[host]
+
+    def _is_alive(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def _connect_with_retries(self, host, port, retries=None, timeout=None):
+        if retries is None:
+            retries = self.connect_retries
+        if timeout is None:
+            timeout = self.connect_timeout
+        pkey = self._load_key()
+        interval = self.retry_interval
+        attempt = 0
+        while True:
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(
+                    hostname=host,
+                    port=port,
+                    username=self.username,
+                    pkey=pkey,
+                    timeout=timeout,
+                    allow_agent=False,
+                    look_for_keys=False)
+                break
+            except (socket.error, paramiko.SSHException) as e:
+                # sshd may not be up yet right after status checks pass
+                client.close()
+                attempt += 1
+                if attempt > retries:
+                    raise
+                logging.info("ssh connect to %s failed (%s), retrying in %ds" %
+                             (host, e, interval))
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_retry_interval)
+        if self.keepalive_interval:
+            client.get_transport().set_keepalive(self.keepalive_interval)
+        return client
+
+    def connect(self, host, port=22, retries=None, connect_timeout=None,
+                blocking=True):
+        # returns the pooled client for host, reconnecting if the transport
+        # has dropped. retries and connect_timeout override the pool's
+        # connect policy, and with blocking=False ConnectInProgress is raised
+        # rather than waiting on another thread connecting to the host.
+        client = self.clients.get(host)
+        if client is not None and self._is_alive(client):
+            return client
+        host_lock = self._host_lock(host)
+        if not host_lock.acquire(blocking):
+            raise ConnectInProgress(host)
+        try:
+            client = self.clients.get(host)
+            if client is not None and self._is_alive(client):
+                return client
+            if client is not None:
+                logging.info("ssh connection to %s dropped, reconnecting" %
+                             host)
+                client.close()
+                with self.lock:
+                    self.reconnects += 1
+            client = self._connect_with_retries(host, port, retries,
+                                                connect_timeout)
+            self.clients[host] = client
+            return client
+        finally:
+            host_lock.release()
+
+    def exec_command(self, host, command, get_pty=False):
+        # every call opens a new channel on the shared transport
+        return self.connect(host).exec_command(
+            command=command, get_pty=get_pty)
+
+    def open_session(self, host, **connect_args):
+        return self.connect(host, **connect_args).get_transport(
+        ).open_session()
+
+    def run(self, host, command, timeout=30, **connect_args):
+        # short-lived command such as a health probe, returns
+        # (exit_code, stdout, stderr). connect_args go to connect().
+        channel = self.open_session(host, **connect_args)
+        try:
+            channel.settimeout(timeout)
+            channel.exec_command(command)
+            stdout = channel.makefile("r").read()
+            stderr = channel.makefile_stderr("r").read()
+            return channel.recv_exit_status(), stdout, stderr
+        finally:
+            channel.close()
+
+    def stats(self):
+        with self.lock:
+            clients = self.clients.values()
+            reconnects = self.reconnects
+        active = sum(1 for client in clients if self._is_alive(client))
+        return {
+            "connections": active,
+            "dropped_connections": len(clients) - active,
+            "reconnects": reconnects
+        }
+
+    def close(self, host=None):
+        with self.lock:
+            if host is None:
+                hosts = self.clients.keys()
+            else:
+                hosts = [host]
+            clients = [self.clients.pop(h) for h in hosts if h in self.clients]
+        for client in clients:
+            client.close()
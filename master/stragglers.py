@@ -0,0 +1,166 @@
+import collections
+import math
+import threading
+import time
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+class RollingStats(object):
+    # mean of the values added in the last `window` seconds, kept up to date
+    # as values come and go instead of being recomputed
+    def __init__(self, window):
+        self.window = window
+        self.samples = collections.deque()
+        self.total = 0.0
+
+    def add(self, timestamp, value):
+        self.samples.append((timestamp, value))
+        self.total += value
+        self.expire(timestamp)
+
+    def expire(self, now):
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.total -= self.samples.popleft()[1]
+
+    def mean(self):
+        if not self.samples:
+            return None
+        return self.total / len(self.samples)
+
+
+class StragglerDetector(object):
+    # per node throughput over the last `window` seconds, updated as each
+    # metrics line arrives:
+    #   step_time      - seconds between two metrics lines of a node
+    #   <key>_per_sec  - how fast a counter key such as step or examples
+    #                    grows, for each of counter_keys
+    #   <key>          - rolling mean of keys that already are throughputs,
+    #                    such as examples_per_sec, for each of rate_keys
+    # report() gives each node's z-score per stat against all nodes, a node
+    # slower than the fleet by more than z_threshold standard deviations in
+    # any stat, and by at least min_slowdown of the fleet mean so a tight
+    # fleet does not turn noise into stragglers, is a straggler. fewer than
+    # min_nodes nodes give no z-scores. with n nodes no z-score gets above
+    # sqrt(n - 1), so in fleets too small to reach z_threshold a node is a
+    # straggler instead when it is slower than the median of the other
+    # nodes by more than median_ratio, e.g. three trainers.
+    def __init__(self,
+                 window=120,
+                 counter_keys=(),
+                 rate_keys=(),
+                 z_threshold=1.5,
+                 min_slowdown=0.05,
+                 min_nodes=3,
+                 median_ratio=1.25):
+        self.window = window
+        self.counter_keys = counter_keys
+        self.rate_keys = rate_keys
+        self.z_threshold = z_threshold
+        self.min_slowdown = min_slowdown
+        self.min_nodes = min_nodes
+        self.median_ratio = median_ratio
+
+        self.lock = threading.Lock()
+        # node -> stat -> RollingStats
+        self.stats = {}
+        # node -> time of its last metrics line
+        self.last_seen = {}
+        # (node, key) -> (time, value) of the last counter value
+        self.last_counters = {}
+
+    def observe(self, node, values, timestamp=None):
+        # values is a list of (key, float) pairs from one metrics line
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            stats = self.stats.setdefault(node, {})
+            last_seen = self.last_seen.get(node)
+            self.last_seen[node] = timestamp
+            # a gap longer than the window is a pause, e.g. a relaunch
+            if last_seen is not None and \
+                    0 < timestamp - last_seen <= self.window:
+                self._add(stats, "step_time", timestamp,
+                          timestamp - last_seen)
+            for key, value in values:
+                if key in self.rate_keys:
+                    self._add(stats, key, timestamp, value)
+                if key in self.counter_keys:
+                    last = self.last_counters.get((node, key))
+                    self.last_counters[(node, key)] = (timestamp, value)
+                    # a counter going down means the trainer was relaunched
+                    if last and timestamp > last[0] and value >= last[1]:
+                        self._add(stats, key + "_per_sec", timestamp,
+                                  (value - last[1]) / (timestamp - last[0]))
+
+    def _add(self, stats, stat, timestamp, value):
+        if stat not in stats:
+            stats[stat] = RollingStats(self.window)
+        stats[stat].add(timestamp, value)
+
+    def report(self):
+        now = time.time()
+        means = {}
+        with self.lock:
+            for node, stats in self.stats.iteritems():
+                for stat, rolling in stats.iteritems():
+                    rolling.expire(now)
+                    mean = rolling.mean()
+                    if mean is not None:
+                        means.setdefault(stat, {})[node] = mean
+            nodes = dict((node, {"straggler": False}) for node in self.stats)
+
+        fleet = {}
+        for stat, by_node in means.iteritems():
+            count = len(by_node)
+            fleet_mean = sum(by_node.values()) / count
+            std = math.sqrt(
+                sum((v - fleet_mean)**2 for v in by_node.values()) / count)
+            fleet[stat] = {
+                "nodes": count,
+                "mean": fleet_mean,
+                "std": std
+            }
+            # a longer step time is slower, a higher rate is faster
+            slower = 1 if stat == "step_time" else -1
+            small_fleet = math.sqrt(count - 1) <= self.z_threshold
+            for node, mean in by_node.iteritems():
+                entry = {
+                    "mean": mean,
+                    "vs_fleet": mean / fleet_mean if fleet_mean else None
+                }
+                if count >= self.min_nodes:
+                    entry["z"] = (mean - fleet_mean) / std if std else 0.0
+                    if small_fleet:
+                        others = _median([
+                            v for n, v in by_node.iteritems() if n != node
+                        ])
+                        entry["vs_median"] = mean / others if others else None
+                        # times slower than the others, a rate of 0 is
+                        # infinitely slower
+                        if slower == 1:
+                            slowdown = mean / others if others else 0.0
+                        else:
+                            slowdown = others / mean if mean else float("inf")
+                        straggler = slowdown > self.median_ratio
+                    else:
+                        straggler = (slower * entry["z"] > self.z_threshold
+                                     and slower * (mean - fleet_mean) >
+                                     self.min_slowdown * abs(fleet_mean))
+                    if straggler:
+                        nodes[node]["straggler"] = True
+                nodes[node][stat] = entry
+        return {
+            "window": self.window,
+            "z_threshold": self.z_threshold,
+            "fleet": fleet,
+            "nodes": nodes,
+            "stragglers": sorted(n for n, s in nodes.iteritems()
+                                 if s["straggler"])
+        }
@@ -0,0 +1,108 @@
+import logging
+import threading
+import time
+
+
+class DuplicateTaskError(Exception):
+    pass
+
+
+class TaskScheduler(object):
+    # runs submitted tasks in submission order, at most max_running of them
+    # at a time, each in its own thread. a task is anything with a `name`
+    # and a blocking `run()`.
+    def __init__(self, max_running=4):
+        self.max_running = max_running
+        self.lock = threading.Lock()
+        self.tasks = {}
+        # names held by reserve() for tasks still being built
+        self.reserved = set()
+        self.order = []
+        self.queued = []
+        self.running = set()
+        self.progress = {}
+
+    def reserve(self, name):
+        # holds the name for a task about to be built, so two submissions of
+        # one name can not both get through. submit() or release() it after.
+        with self.lock:
+            if name in self.tasks or name in self.reserved:
+                raise DuplicateTaskError("task %s already exists" % name)
+            self.reserved.add(name)
+
+    def release(self, name):
+        with self.lock:
+            self.reserved.discard(name)
+
+    def submit(self, task, reserved=False):
+        # reserved says the caller holds the task's name from reserve()
+        with self.lock:
+            if task.name in self.tasks or (task.name in self.reserved and
+                                           not reserved):
+                raise DuplicateTaskError("task %s already exists" % task.name)
+            self.reserved.discard(task.name)
+            self.tasks[task.name] = task
+            self.order.append(task.name)
+            self.queued.append(task)
+            self.progress[task.name] = {
+                "state": "queued",
+                "submitted_at": time.time()
+            }
+        logging.info("task %s queued" % task.name)
+        self._start_next()
+        return task
+
+    def get(self, name):
+        with self.lock:
+            return self.tasks.get(name)
+
+    def status(self, name):
+        with self.lock:
+            if name not in self.progress:
+                return None
+            return dict(self.progress[name])
+
+    def list(self):
+        with self.lock:
+            return [
+                dict(self.progress[name], name=name) for name in self.order
+            ]
+
+    def wait(self, timeout=None):
+        # blocks until every submitted task has finished
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with self.lock:
+                if not self.queued and not self.running:
+                    return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(1)
+
+    def _start_next(self):
+        with self.lock:
+            to_start = []
+            while self.queued and len(self.running) < self.max_running:
+                task = self.queued.pop(0)
+                self.running.add(task.name)
+                self.progress[task.name].update(
+                    state="running", started_at=time.time())
+                to_start.append(task)
+        for task in to_start:
+            task_thread = threading.Thread(target=self._run, args=(task, ))
+            task_thread.start()
+
+    def _run(self, task):
+        logging.info("task %s started" % task.name)
+        state, error = "done", None
+        try:
+            task.run()
+        except Exception as e:
+            logging.exception("task %s failed" % task.name)
+            state, error = "failed", str(e)
+        with self.lock:
+            self.running.discard(task.name)
+            self.progress[task.name].update(
+                state=state, error=error, finished_at=time.time())
+        logging.info("task %s %s" % (task.name, state))
+        self._start_next()
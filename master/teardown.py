@@ -0,0 +1,257 @@
+import logging
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+_teardowns = {}
+_teardowns_lock = threading.Lock()
+# seconds a finished teardown's status is kept around
+FINISHED_RETENTION = 3600
+
+
+def _prune_finished():
+    # called with _teardowns_lock held, a master serving many tasks would
+    # keep every teardown otherwise
+    now = time.time()
+    for task_name, teardown in _teardowns.items():
+        finished_at = teardown.status().get("finished_at")
+        if (teardown.done.is_set() and finished_at and
+                now - finished_at > FINISHED_RETENTION):
+            del _teardowns[task_name]
+
+
+def get_teardown(ec2client, task_name, **kwargs):
+    # one shared teardown per task, however many threads ask for it
+    with _teardowns_lock:
+        _prune_finished()
+        if task_name not in _teardowns:
+            _teardowns[task_name] = Teardown(ec2client, task_name, **kwargs)
+        return _teardowns[task_name]
+
+
+def find_teardown(task_name):
+    # the teardown of a task if one was ever asked for, without creating it
+    with _teardowns_lock:
+        return _teardowns.get(task_name)
+
+
+def teardown_status(task_name):
+    teardown = find_teardown(task_name)
+    return teardown.status() if teardown else {"state": "idle"}
+
+
+class Teardown(object):
+    # terminates every instance tagged with the task name in bulk, then
+    # deletes every tagged subnet as soon as its network interfaces have
+    # drained. it works from the tags on each run, so whatever a previous
+    # run left behind is picked up again.
+    def __init__(self,
+                 ec2client,
+                 task_name,
+                 poll_interval=10,
+                 timeout=1800):
+        self.ec2client = ec2client
+        self.task_name = task_name
+        self.warm_pool = None
+        self.pool_subnets = set()
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.done = threading.Event()
+        self.progress = {"state": "idle"}
+
+    def start(self, warm_pool=None):
+        # returns False if a teardown for this task is already running.
+        # instances the warm pool has room for are released into it instead
+        # of being terminated.
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.warm_pool = warm_pool
+            self.done.clear()
+            self._update(
+                state="running",
+                phase="starting",
+                started_at=time.time(),
+                finished_at=None,
+                error=None)
+            # not a daemon, the process should not exit half way through
+            self.thread = threading.Thread(target=self._run)
+            self.thread.start()
+            return True
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout)
+        return self.status()
+
+    def status(self):
+        with self.lock:
+            return dict(self.progress)
+
+    def _update(self, **kwargs):
+        self.progress.update(kwargs)
+
+    def _tag_filter(self):
+        return [{"Name": "tag:Task_name", "Values": [self.task_name]}]
+
+    def _live_instances(self):
+        instances_response = self.ec2client.describe_instances(Filters=
+            self._tag_filter() + [{
+                "Name": "instance-state-name",
+                "Values": [
+                    "pending", "running", "shutting-down", "stopping",
+                    "stopped"
+                ]
+            }])
+        instances = []
+        for reservation in instances_response["Reservations"]:
+            instances.extend(reservation["Instances"])
+        return instances
+
+    def _terminate_instances(self):
+        instances = self._live_instances()
+        released_ids = []
+        if self.warm_pool is not None:
+            with self.lock:
+                self._update(phase="releasing instances to warm pool")
+            released_ids = self.warm_pool.release(instances)
+        instance_ids = [
+            i["InstanceId"] for i in instances
+            if i["InstanceId"] not in released_ids
+        ]
+        # subnets the released instances keep running in
+        self.pool_subnets = set(
+            i["SubnetId"] for i in instances
+            if i["InstanceId"] in released_ids and i.get("SubnetId"))
+        with self.lock:
+            self._update(phase="terminating instances",
+                         instances_released=len(released_ids),
+                         instances_terminating=len(instance_ids))
+        for start in xrange(0, len(instance_ids), 500):
+            self.ec2client.terminate_instances(
+                InstanceIds=instance_ids[start:start + 500])
+        logging.info("%d instance(s) of %s terminating" %
+                     (len(instance_ids), self.task_name))
+        return set(instance_ids)
+
+    def _delete_launch_templates(self):
+        # left by trainers launched through ec2 fleet
+        templates = self.ec2client.describe_launch_templates(
+            Filters=self._tag_filter())
+        for template in templates["LaunchTemplates"]:
+            self.ec2client.delete_launch_template(
+                LaunchTemplateId=template["LaunchTemplateId"])
+            logging.info("launch template %s of %s deleted" %
+                         (template["LaunchTemplateName"], self.task_name))
+
+    def _subnet_users(self, subnet_id, terminating_ids):
+        # (our interfaces still draining, other interfaces). unattached
+        # interfaces tagged for the task are deleted, untagged ones count
+        # as other interfaces, nothing will ever drain them.
+        interfaces = self.ec2client.describe_network_interfaces(Filters=[{
+            "Name": "subnet-id",
+            "Values": [subnet_id]
+        }])
+        draining, foreign = 0, 0
+        for interface in interfaces["NetworkInterfaces"]:
+            instance_id = interface.get("Attachment", {}).get("InstanceId")
+            if instance_id:
+                if instance_id in terminating_ids:
+                    draining += 1
+                else:
+                    foreign += 1
+            elif (interface.get("Status") == "available" and
+                  {"Key": "Task_name", "Value": self.task_name} in
+                  interface.get("TagSet", [])):
+                self._delete_interface(interface["NetworkInterfaceId"])
+            else:
+                foreign += 1
+        return draining, foreign
+
+    def _delete_interface(self, interface_id):
+        try:
+            self.ec2client.delete_network_interface(
+                NetworkInterfaceId=interface_id)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if code != "InvalidNetworkInterfaceID.NotFound":
+                raise
+        logging.info("network interface %s of %s deleted" %
+                     (interface_id, self.task_name))
+
+    def _delete_subnets(self, terminating_ids):
+        subnets = self.ec2client.describe_subnets(Filters=self._tag_filter())
+        pending = [s["SubnetId"] for s in subnets["Subnets"]]
+        deleted = []
+        skipped = []
+        handed_over = [s for s in pending if s in self.pool_subnets]
+        if handed_over:
+            # deleted by the pool once its instances leave them
+            self.warm_pool.adopt_subnets(handed_over)
+            pending = [s for s in pending if s not in handed_over]
+        deadline = time.time() + self.timeout
+        while pending:
+            with self.lock:
+                self._update(
+                    phase="deleting subnets",
+                    subnets_pending=list(pending),
+                    subnets_deleted=list(deleted))
+            for subnet_id in list(pending):
+                draining, foreign = self._subnet_users(subnet_id,
+                                                       terminating_ids)
+                if foreign:
+                    # e.g. the master itself, or an interface someone made
+                    # by hand, leave it for the next run
+                    logging.info("subnet %s still used by %d other "
+                                 "interface(s), leaving it" %
+                                 (subnet_id, foreign))
+                    pending.remove(subnet_id)
+                    skipped.append(subnet_id)
+                    continue
+                if draining:
+                    continue
+                try:
+                    self.ec2client.delete_subnet(SubnetId=subnet_id)
+                except ClientError as e:
+                    code = e.response.get("Error", {}).get("Code")
+                    if code == "DependencyViolation":
+                        continue
+                    if code != "InvalidSubnetID.NotFound":
+                        raise
+                logging.info("subnet %s of %s deleted" %
+                             (subnet_id, self.task_name))
+                pending.remove(subnet_id)
+                deleted.append(subnet_id)
+            if not pending:
+                break
+            if time.time() > deadline:
+                raise RuntimeError("subnet(s) %s still in use after %ds" %
+                                   (",".join(pending), self.timeout))
+            time.sleep(self.poll_interval)
+        with self.lock:
+            self._update(
+                subnets_pending=[],
+                subnets_deleted=deleted,
+                subnets_skipped=skipped,
+                subnets_handed_to_pool=handed_over)
+
+    def _run(self):
+        logging.info("going to clean up " + self.task_name + " instances")
+        try:
+            terminating_ids = self._terminate_instances()
+            self._delete_launch_templates()
+            self._delete_subnets(terminating_ids)
+            with self.lock:
+                self._update(state="done", phase="done")
+            logging.info("Clearnup done")
+        except Exception as e:
+            logging.exception("error while cleaning up %s" % self.task_name)
+            with self.lock:
+                self._update(state="failed", error=str(e))
+        finally:
+            with self.lock:
+                self._update(finished_at=time.time())
+            self.done.set()
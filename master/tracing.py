@@ -0,0 +1,136 @@
+import contextlib
+import json
+import threading
+import time
+
+
+class Tracer(object):
+    # timed spans of one task's bring-up, e.g. subnet creation, run_instances,
+    # waiting for status checks, ssh connect, kickoff and first output of
+    # each node. every span is drawn on a lane, the node it belongs to or
+    # else the thread that recorded it. exported as chrome trace json, which
+    # chrome://tracing and perfetto can open.
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.events = []
+        self.lanes = {}
+        self.seen = set()
+
+    def _lane(self, node):
+        if node is None:
+            node = threading.current_thread().name
+        with self.lock:
+            if node not in self.lanes:
+                self.lanes[node] = len(self.lanes) + 1
+            return self.lanes[node]
+
+    def add(self, name, start, end, node=None, **args):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int((start - self.started) * 1e6),
+            "dur": int((end - start) * 1e6),
+            "pid": 1,
+            "tid": self._lane(node),
+            "args": args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, node=None, **args):
+        start = time.time()
+        try:
+            yield args
+        except Exception as e:
+            args["error"] = str(e)
+            raise
+        finally:
+            self.add(name, start, time.time(), node, **args)
+
+    def instant(self, name, node=None, **args):
+        event = {
+            "name": name,
+            "ph": "i",
+            "s": "t",
+            "ts": int((time.time() - self.started) * 1e6),
+            "pid": 1,
+            "tid": self._lane(node),
+            "args": args
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def once(self, name, node, **args):
+        # instant event recorded only the first time for a node, cheap to
+        # call for every log line
+        key = (name, node)
+        if key in self.seen:
+            return
+        with self.lock:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+        self.instant(name, node, **args)
+
+    def to_chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+            lanes = dict(self.lanes)
+        metadata = [{
+            "name": "process_name",
+            "ph": "M",
+            "pid": 1,
+            "args": {
+                "name": self.name
+            }
+        }]
+        for lane, tid in lanes.iteritems():
+            metadata.append({
+                "name": "thread_name",
+                "ph": "M",
+                "pid": 1,
+                "tid": tid,
+                "args": {
+                    "name": lane
+                }
+            })
+        return {
+            "traceEvents": metadata + events,
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "task": self.name,
+                "started_at": self.started
+            }
+        }
+
+    def summary(self):
+        # per span name: count, total, max and end of the last one in
+        # seconds since the task started
+        phases = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            phase = phases.setdefault(event["name"], {
+                "count": 0,
+                "total_seconds": 0.0,
+                "max_seconds": 0.0,
+                "last_end_seconds": 0.0
+            })
+            phase["count"] += 1
+            duration = event.get("dur", 0) / 1e6
+            phase["total_seconds"] += duration
+            phase["max_seconds"] = max(phase["max_seconds"], duration)
+            phase["last_end_seconds"] = max(phase["last_end_seconds"],
+                                            event["ts"] / 1e6 + duration)
+        for phase in phases.values():
+            for key in phase:
+                if key != "count":
+                    phase[key] = round(phase[key], 3)
+        return phases
+
+    def save(self, path):
+        with open(path, "w") as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+
+# a trainer slot goes starting -> running -> exited, failed or removed. one
+# that dies goes back to starting while it has relaunches left, one the
+# cluster is scaled down by is removing until its command ends. once the
+# supervisor is stopped, a trainer that dies is stopped instead of relaunched
+# and one that comes up is stopping until its command ends.
+FINAL_STATES = ("exited", "failed", "removed", "stopped")
+
+
+class TrainerSupervisor(object):
+    # keeps one trainer per index running for a task.
+    #
+    # start_trainer(index, relaunch, on_exit) brings up the trainer with that
+    #   index and returns once its command runs, on_exit(return_code,
+    #   interrupted) is to be called when the command ends
+    # stop_trainer(index) ends the trainer of an index scaled away
+    #
+    # a trainer that exits non-zero or could not be started is brought up
+    # again under the same index, up to max_replacements times when spot
+    # reclaimed its instance and max_relaunches times otherwise, unless the
+    # supervisor was stopped since because the task is being torn down.
+    def __init__(self,
+                 start_trainer,
+                 stop_trainer,
+                 count,
+                 max_relaunches=2,
+                 max_replacements=3,
+                 logger=logging):
+        self.start_trainer = start_trainer
+        self.stop_trainer = stop_trainer
+        self.count = count
+        self.max_relaunches = max_relaunches
+        self.max_replacements = max_replacements
+        self.logger = logger
+
+        self.slots = {}
+        self.lock = threading.Condition()
+        self.stopped = False
+
+    def start(self):
+        with self.lock:
+            if not self.stopped:
+                for index in xrange(self.count):
+                    self._add(index)
+        return self
+
+    def stop(self):
+        # no trainer is brought up again from now on, the ones still being
+        # brought up are stopped as soon as they are
+        with self.lock:
+            self.stopped = True
+            self.lock.notify_all()
+
+    def status(self):
+        with self.lock:
+            return [dict(self.slots[i]) for i in sorted(self.slots)]
+
+    def failed(self):
+        with self.lock:
+            return sorted(i for i, slot in self.slots.iteritems()
+                          if slot["state"] == "failed")
+
+    def wait(self):
+        # until no trainer is running or being brought up
+        with self.lock:
+            while not all(slot["state"] in FINAL_STATES
+                          for slot in self.slots.values()):
+                # a timeout keeps the wait interruptible
+                self.lock.wait(1)
+
+    def scale(self, count):
+        # runs trainers 0 to count - 1, returns (added, removed) indexes
+        added, removed = [], []
+        with self.lock:
+            if self.stopped:
+                raise ValueError("trainers are being torn down")
+            if self.slots and all(slot["state"] in FINAL_STATES
+                                  for slot in self.slots.values()):
+                raise ValueError("trainers already finished")
+            self.count = count
+            for index, slot in sorted(self.slots.iteritems()):
+                if index >= count and slot["state"] in ("starting",
+                                                        "running"):
+                    slot["state"] = "removing"
+                    removed.append(index)
+            for index in xrange(count):
+                slot = self.slots.get(index)
+                if slot is None or slot["state"] in FINAL_STATES:
+                    self._add(index)
+                    added.append(index)
+            self.lock.notify_all()
+        for index in removed:
+            self.logger.info("scaling down, stopping trainer %d" % index)
+            try:
+                self.stop_trainer(index)
+            except Exception:
+                self.logger.exception("could not stop trainer %d" % index)
+        return added, removed
+
+    def _add(self, index):
+        generation = self.slots[index]["generation"] if index in \
+            self.slots else 0
+        self.slots[index] = {
+            "index": index,
+            "state": "starting",
+            "since": time.time(),
+            "relaunches": 0,
+            "replacements": 0,
+            "exit_code": None,
+            "generation": generation
+        }
+        self._launch(index, False)
+
+    def _launch(self, index, relaunch):
+        # the generation tells callbacks of a replaced trainer apart
+        self.slots[index]["generation"] += 1
+        trainer_thread = threading.Thread(
+            target=self._run,
+            args=(index, self.slots[index]["generation"], relaunch),
+            name="trainer_" + str(index))
+        trainer_thread.start()
+
+    def _run(self, index, generation, relaunch):
+        def on_exit(return_code, interrupted=False):
+            self._exited(index, generation, return_code, interrupted)
+
+        try:
+            self.start_trainer(index, relaunch, on_exit)
+        except Exception:
+            self.logger.exception("trainer %d could not be started" % index)
+            self._exited(index, generation, None, False)
+            return
+        with self.lock:
+            slot = self.slots[index]
+            if slot["generation"] != generation:
+                return
+            if slot["state"] == "starting":
+                slot["state"] = "running"
+                slot["since"] = time.time()
+            # scaled away or torn down while it was being brought up
+            if self.stopped and slot["state"] == "running":
+                slot["state"] = "stopping"
+            stop = slot["state"] in ("removing", "stopping")
+            reason = "scaling down" if slot["state"] == "removing" else \
+                "tearing down"
+        if stop:
+            self.logger.info("%s, stopping trainer %d" % (reason, index))
+            self.stop_trainer(index)
+
+    def _exited(self, index, generation, return_code, interrupted):
+        with self.lock:
+            slot = self.slots[index]
+            if slot["generation"] != generation:
+                return
+            slot["exit_code"] = return_code
+            slot["since"] = time.time()
+            relaunch = False
+            if slot["state"] == "removing":
+                slot["state"] = "removed"
+            elif return_code == 0:
+                slot["state"] = "exited"
+            elif self.stopped:
+                # killed by the teardown, not worth a new instance
+                slot["state"] = "stopped"
+            elif interrupted and slot["replacements"] < self.max_replacements:
+                slot["replacements"] += 1
+                relaunch = True
+            elif not interrupted and slot["relaunches"] < self.max_relaunches:
+                slot["relaunches"] += 1
+                relaunch = True
+            else:
+                slot["state"] = "failed"
+                self.logger.error("trainer %d failed with exit code %s and "
+                                  "has no relaunches left" %
+                                  (index, return_code))
+            if relaunch:
+                self.logger.info(
+                    "trainer %d %s with exit code %s, relaunching it "
+                    "(%d relaunches, %d spot replacements so far)" %
+                    (index, "was reclaimed by spot"
+                     if interrupted else "died", return_code,
+                     slot["relaunches"], slot["replacements"]))
+                slot["state"] = "starting"
+                self._launch(index, True)
+            self.lock.notify_all()
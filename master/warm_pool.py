@@ -0,0 +1,305 @@
+import logging
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+
+POOL_TAG = "Warm_pool"
+POOL_ROLE_TAG = "Pool_role"
+POOL_IDLE_SINCE_TAG = "Pool_idle_since"
+POOL_CLAIM_TAG = "Pool_claim"
+
+
+def _tags(instance):
+    return dict((t["Key"], t["Value"]) for t in instance.get("Tags", []))
+
+
+def _instances(response):
+    instances = []
+    for reservation in response["Reservations"]:
+        instances.extend(reservation["Instances"])
+    return instances
+
+
+class WarmPool(object):
+    # instances released by finished tasks are retagged into a named pool
+    # (stopped, or left running idle) instead of being terminated, and the
+    # next task claims matching ones before launching new instances. pool
+    # instances idle for longer than idle_ttl are terminated.
+    #
+    # released instances stay in the subnet of the task they ran for, so the
+    # task's teardown hands such subnets over to the pool, which deletes
+    # them once no instance is left in them.
+    #
+    # claims go through a tag with a random token that is read back after a
+    # moment, so two masters claiming at the same time don't both get the
+    # same instance.
+    def __init__(self,
+                 ec2client,
+                 pool_name,
+                 max_size=16,
+                 idle_ttl=3600,
+                 stop_on_release=True,
+                 reset_instance=None,
+                 claim_settle_time=1.0,
+                 start_timeout=300,
+                 start_poll_interval=3):
+        self.ec2client = ec2client
+        self.pool_name = pool_name
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.stop_on_release = stop_on_release
+        # called with an instance released while running, to stop whatever
+        # the last task left on it
+        self.reset_instance = reset_instance
+        self.claim_settle_time = claim_settle_time
+        # how long a claimed stopped instance may take to leave the stopped
+        # state after start_instances
+        self.start_timeout = start_timeout
+        self.start_poll_interval = start_poll_interval
+        self.lock = threading.Lock()
+
+    def _pool_instances(self, extra_filters=None):
+        filters = [{
+            "Name": "tag:" + POOL_TAG,
+            "Values": [self.pool_name]
+        }, {
+            "Name": "instance-state-name",
+            "Values": ["running", "stopped"]
+        }]
+        return _instances(
+            self.ec2client.describe_instances(
+                Filters=filters + (extra_filters or [])))
+
+    def reap(self):
+        # terminate pool instances idle for too long
+        now = time.time()
+        expired = []
+        for instance in self._pool_instances():
+            idle_since = _tags(instance).get(POOL_IDLE_SINCE_TAG)
+            try:
+                idle_since = float(idle_since)
+            except (TypeError, ValueError):
+                idle_since = 0
+            if now - idle_since > self.idle_ttl:
+                expired.append(instance["InstanceId"])
+        if expired:
+            logging.info("warm pool %s: terminating %d idle instance(s)" %
+                         (self.pool_name, len(expired)))
+            self.ec2client.terminate_instances(InstanceIds=expired)
+        self.delete_empty_subnets()
+        return expired
+
+    def adopt_subnets(self, subnet_ids):
+        # subnets of a finished task that still hold pool instances
+        self.ec2client.delete_tags(
+            Resources=subnet_ids, Tags=[{
+                "Key": "Task_name"
+            }])
+        self.ec2client.create_tags(
+            Resources=subnet_ids,
+            Tags=[{
+                "Key": POOL_TAG,
+                "Value": self.pool_name
+            }])
+        logging.info("warm pool %s: took over subnet(s) %s" %
+                     (self.pool_name, ",".join(subnet_ids)))
+
+    def delete_empty_subnets(self):
+        # adopted subnets whose instances all left, returns the deleted ids
+        subnets = self.ec2client.describe_subnets(Filters=[{
+            "Name": "tag:" + POOL_TAG,
+            "Values": [self.pool_name]
+        }])
+        deleted = []
+        for subnet in subnets["Subnets"]:
+            interfaces = self.ec2client.describe_network_interfaces(
+                Filters=[{
+                    "Name": "subnet-id",
+                    "Values": [subnet["SubnetId"]]
+                }])
+            if interfaces["NetworkInterfaces"]:
+                continue
+            try:
+                self.ec2client.delete_subnet(SubnetId=subnet["SubnetId"])
+            except ClientError as e:
+                code = e.response.get("Error", {}).get("Code")
+                if code == "DependencyViolation":
+                    continue
+                if code != "InvalidSubnetID.NotFound":
+                    raise
+            deleted.append(subnet["SubnetId"])
+        if deleted:
+            logging.info("warm pool %s: deleted empty subnet(s) %s" %
+                         (self.pool_name, ",".join(deleted)))
+        return deleted
+
+    def claim(self,
+              task_name,
+              role,
+              image_id,
+              instance_type,
+              count,
+              vpc_id=None,
+              key_name=None,
+              security_group_id=None,
+              availability_zone=None):
+        # returns up to count instances moved from the pool to task_name.
+        # the optional filters keep out instances the task could not reach
+        # or log in to.
+        if count <= 0:
+            return []
+        filters = [{
+            "Name": "tag:" + POOL_ROLE_TAG,
+            "Values": [role]
+        }, {
+            "Name": "image-id",
+            "Values": [image_id]
+        }, {
+            "Name": "instance-type",
+            "Values": [instance_type]
+        }]
+        for name, value in (("vpc-id", vpc_id), ("key-name", key_name),
+                            ("instance.group-id", security_group_id),
+                            ("availability-zone", availability_zone)):
+            if value:
+                filters.append({"Name": name, "Values": [value]})
+        with self.lock:
+            self.reap()
+            candidates = self._pool_instances(filters)
+            if not candidates:
+                return []
+            candidate_ids = [i["InstanceId"] for i in candidates[:count]]
+            token = "%s:%s" % (task_name, uuid.uuid4().hex)
+            self.ec2client.create_tags(
+                Resources=candidate_ids,
+                Tags=[{
+                    "Key": POOL_CLAIM_TAG,
+                    "Value": token
+                }])
+            time.sleep(self.claim_settle_time)
+            claimed = [
+                i for i in _instances(
+                    self.ec2client.describe_instances(
+                        InstanceIds=candidate_ids))
+                if _tags(i).get(POOL_CLAIM_TAG) == token
+            ]
+            if not claimed:
+                return []
+            claimed_ids = [i["InstanceId"] for i in claimed]
+            self.ec2client.delete_tags(
+                Resources=claimed_ids,
+                Tags=[{
+                    "Key": POOL_TAG
+                }, {
+                    "Key": POOL_ROLE_TAG
+                }, {
+                    "Key": POOL_IDLE_SINCE_TAG
+                }, {
+                    "Key": POOL_CLAIM_TAG
+                }])
+            self.ec2client.create_tags(
+                Resources=claimed_ids,
+                Tags=[{
+                    "Key": "Task_name",
+                    "Value": task_name
+                }, {
+                    "Key": "Role",
+                    "Value": role
+                }])
+            stopped_ids = [
+                i["InstanceId"] for i in claimed
+                if i["State"]["Name"] == "stopped"
+            ]
+            if stopped_ids:
+                self.ec2client.start_instances(InstanceIds=stopped_ids)
+        # waited for outside the lock, other claims and releases go on
+        if stopped_ids:
+            not_started = self._wait_started(stopped_ids)
+            if not_started:
+                # they are tagged for the task, its teardown gets them
+                logging.info("warm pool %s: %s did not start within %ds, not "
+                             "using them" % (self.pool_name,
+                                             ",".join(not_started),
+                                             self.start_timeout))
+                claimed = [
+                    i for i in claimed if i["InstanceId"] not in not_started
+                ]
+        logging.info("warm pool %s: claimed %d %s instance(s) for %s, %d of "
+                     "them stopped" % (self.pool_name, len(claimed), role,
+                                       task_name, len(stopped_ids)))
+        return claimed
+
+    def _wait_started(self, instance_ids):
+        # right after start_instances an instance may still be reported as
+        # stopped, which the caller's readiness check would take for a dead
+        # instance. returns the ids still not pending or running by the
+        # timeout.
+        deadline = time.time() + self.start_timeout
+        waiting = set(instance_ids)
+        while True:
+            for instance in _instances(
+                    self.ec2client.describe_instances(
+                        InstanceIds=list(waiting))):
+                if instance["State"]["Name"] in ("pending", "running"):
+                    waiting.discard(instance["InstanceId"])
+            if not waiting or time.time() > deadline:
+                return sorted(waiting)
+            time.sleep(self.start_poll_interval)
+
+    def release(self, instances):
+        # moves as many of the given instances into the pool as it has room
+        # for, returns the ids kept; the caller terminates the rest
+        with self.lock:
+            room = self.max_size - len(self._pool_instances())
+            # spot instances can not be stopped and may be reclaimed at any
+            # time, they are not worth keeping
+            keep = [
+                i for i in instances
+                if i["State"]["Name"] in ("running", "stopped") and
+                _tags(i).get("Role") and
+                i.get("InstanceLifecycle") != "spot"
+            ][:max(0, room)]
+            if not keep:
+                return []
+            for instance in list(keep):
+                if (self.reset_instance and not self.stop_on_release and
+                        instance["State"]["Name"] == "running"):
+                    try:
+                        self.reset_instance(instance)
+                    except Exception:
+                        logging.exception("could not reset %s, not keeping "
+                                          "it" % instance["InstanceId"])
+                        keep.remove(instance)
+            if not keep:
+                return []
+            now = str(int(time.time()))
+            for instance in keep:
+                self.ec2client.create_tags(
+                    Resources=[instance["InstanceId"]],
+                    Tags=[{
+                        "Key": POOL_TAG,
+                        "Value": self.pool_name
+                    }, {
+                        "Key": POOL_ROLE_TAG,
+                        "Value": _tags(instance)["Role"]
+                    }, {
+                        "Key": POOL_IDLE_SINCE_TAG,
+                        "Value": now
+                    }])
+            keep_ids = [i["InstanceId"] for i in keep]
+            self.ec2client.delete_tags(
+                Resources=keep_ids, Tags=[{
+                    "Key": "Task_name"
+                }])
+            if self.stop_on_release:
+                running_ids = [
+                    i["InstanceId"] for i in keep
+                    if i["State"]["Name"] == "running"
+                ]
+                if running_ids:
+                    self.ec2client.stop_instances(InstanceIds=running_ids)
+            logging.info("warm pool %s: kept %d instance(s)" %
+                         (self.pool_name, len(keep_ids)))
+            return keep_ids